@@ -6,17 +6,114 @@
 # Licence:  This file is a part of multibootusb package. You can redistribute it or modify
 # under the terms of GNU General Public License, v.2 or above
 
+import collections
+import fnmatch
 import os
 import platform
 import subprocess
-from . import config
+import time
 from . import gen
+from . import isodump3
+from . import progress
 
 if platform.system() == 'Windows':
     _7zip = gen.quote(gen.resource_path(os.path.join('data', 'tools', '7zip', '7z.exe')))
 else:
     _7zip = '7z'
 
+# An entry of an ISO as listed by iter_iso(). mtime is in seconds since the epoch.
+IsoEntry = collections.namedtuple('IsoEntry', ['path', 'size', 'is_dir', 'mtime'])
+
+# Number of 7z processes spawned since the last call to reset_spawn_count(),
+# leaving out the ones of progress.background() threads. Each of them is a
+# full scan of the ISO so this is a good cost indicator.
+spawn_count = 0
+
+
+def reset_spawn_count():
+    global spawn_count
+    spawn_count = 0
+
+
+def count_spawn():
+    global spawn_count
+    if not progress.in_background():
+        spawn_count += 1
+
+
+def match_path(path, pattern):
+    """
+    Check a path against a pattern the way "7z x -ssc- <pattern> -r" does.
+    The pattern matches the trailing components of the path, whatever the
+    depth, and case is ignored.
+    :param path: '/' separated path inside the archive
+    :param pattern: Wildcard pattern, '/' or '\\' separated
+    :return: True if the path matches
+    """
+    path_parts = path.lower().split('/')
+    pattern_parts = [p for p in pattern.lower().replace('\\', '/').split('/') if p]
+    if not pattern_parts or len(pattern_parts) > len(path_parts):
+        return False
+    return all(fnmatch.fnmatchcase(n, p) for n, p in
+               zip(path_parts[-len(pattern_parts):], pattern_parts))
+
+
+def _exclusion(pattern):
+    """
+    Parse a 7z exclusion switch. "-xr!P" (and "-x!P", which follows the
+    -r of the command) excludes whatever matches P at any depth, "-xr-!P"
+    only matches P from the root of the archive.
+    :return: Tuple of (wildcard, recursive) or None if pattern is not an exclusion
+    """
+    if not pattern.startswith('-x'):
+        return None
+    modifier, sep, wildcard = pattern[2:].partition('!')
+    if not sep:
+        return None
+    return wildcard, modifier != 'r-'
+
+
+def _match_from_root(path, pattern):
+    path_parts = path.lower().split('/')
+    pattern_parts = [p for p in pattern.lower().replace('\\', '/').split('/') if p]
+    return len(path_parts) == len(pattern_parts) and \
+        all(fnmatch.fnmatchcase(n, p) for n, p in zip(path_parts, pattern_parts))
+
+
+def select_paths(paths, patterns):
+    """
+    Select the paths "7z x <patterns> -r" would extract. A matching
+    directory brings everything below it, an excluded one (see _exclusion())
+    keeps everything below it out. Without any include pattern everything
+    not excluded is selected.
+    :param paths: '/' separated paths, parents listed before children
+    :param patterns: List of wildcard patterns and exclusion switches
+    :return: List of selected paths, in the given order
+    """
+    includes = []
+    excludes = []
+    for p in patterns:
+        exclusion = _exclusion(p)
+        if exclusion is None:
+            includes.append(p)
+        else:
+            excludes.append(exclusion)
+    selected = []
+    selected_dirs = set()
+    excluded_dirs = set()
+    for path in paths:
+        parent = path.rpartition('/')[0]
+        if parent in excluded_dirs or \
+                any(match_path(path, w) if recursive else _match_from_root(path, w)
+                    for w, recursive in excludes):
+            excluded_dirs.add(path)
+            continue
+        if not includes or parent in selected_dirs or \
+                any(match_path(path, p) for p in includes):
+            selected.append(path)
+            selected_dirs.add(path)
+    return selected
+
 
 def extract_iso(src, dst, pattern=None, suppress_out=True):
     """
@@ -56,7 +153,9 @@ def extract_iso(src, dst, pattern=None, suppress_out=True):
                ' -o' + dst + ' ' + pattern_str + ' -r' + suppress_out
     gen.log('Executing ==> ' + _cmd)
 
-    config.status_text = 'Status: Extracting ' + os.path.basename(src).strip()
+    progress.current().set_text('Status: Extracting ' +
+                                os.path.basename(src).strip())
+    count_spawn()
     with open(os.devnull, 'w') as devnull:
         subprocess.call(_cmd, stdin=devnull, stdout=devnull, stderr=devnull, shell=True)
 
@@ -77,23 +176,79 @@ def list_iso(iso_link, suppress_out=True, expose_exception=False):
     if not os.path.exists(iso_link):
         gen.log('Path to ISO link does not exist.')
         return False
-    else:
-        file_list = []
-        _cmd = _7zip + ' l ' + gen.quote(iso_link) + suppress_out
-        try:
-            _cmd_out = subprocess.check_output(_cmd, stderr=subprocess.PIPE, stdin=subprocess.DEVNULL,
-                                               shell=True).decode('utf-8', 'ignore').splitlines()
-        except Exception as e:
-            gen.log(e)
-            if expose_exception:
-                raise
-            _cmd_out = ''
-        for line in _cmd_out:
-            if '...' in line:
-                line = line.split()
-                _path = line[-1]
-                file_list.append(_path)
-        return file_list
+    try:
+        return [entry.path for entry in iter_iso(iso_link, suppress_out)]
+    except Exception as e:
+        gen.log(e)
+        if expose_exception:
+            raise
+        return []
+
+
+def iter_iso(iso_link, suppress_out=True):
+    """
+    Generator of the content of an ISO, read incrementally from "7z l -slt". Plain ISO9660 images are read
+    in-process instead. Stopping the iteration early terminates 7z.
+    :param iso_link: Path to ISO link
+    :param suppress_out: Option to suppress output to stdout. Default True.
+    :return: IsoEntry for each file and directory, in archive order
+    """
+    if suppress_out is True:
+        suppress_out = ' 2> nul' if platform.system() == 'Windows' else ' 2> /dev/null'
+    index = isodump3.iso9660_index(iso_link)
+    if index is not None:
+        # Plain ISO9660 image. Read its directories in-process and
+        # spare the 7z run. Paths match the ones 7z would print.
+        for path, (loc, size, flags, mtime) in index.items():
+            yield IsoEntry(path.replace('/', os.sep), size, bool(flags & 0x02), mtime)
+        return
+
+    _cmd = _7zip + ' l -slt ' + gen.quote(iso_link) + suppress_out
+    count_spawn()
+    proc = subprocess.Popen(_cmd, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL, shell=True)
+    try:
+        # Archive properties come first, entries follow a line of dashes.
+        in_entries = False
+        record = {}
+        for line in proc.stdout:
+            line = line.decode('utf-8', 'ignore').rstrip('\r\n')
+            if not in_entries:
+                in_entries = line.startswith('----------')
+                continue
+            if line:
+                key, sep, value = line.partition(' = ')
+                if sep:
+                    record[key] = value
+                continue
+            if 'Path' in record:
+                yield _slt_entry(record)
+            record = {}
+        if 'Path' in record:
+            yield _slt_entry(record)
+        returncode = proc.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, _cmd)
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+
+
+def _slt_entry(record):
+    """
+    Convert the properties of an entry printed by "7z l -slt" to an IsoEntry.
+    """
+    try:
+        size = int(record.get('Size') or 0)
+    except ValueError:
+        size = 0
+    is_dir = record.get('Folder') == '+' or record.get('Attributes', '').startswith('D')
+    try:
+        mtime = time.mktime(time.strptime(record.get('Modified', '')[:19], '%Y-%m-%d %H:%M:%S'))
+    except (ValueError, OverflowError):
+        mtime = 0
+    return IsoEntry(record['Path'], size, is_dir, mtime)
 
 
 def test_iso(iso_link, suppress_out=True):
@@ -121,6 +276,7 @@ def test_iso(iso_link, suppress_out=True):
 
     gen.log('Executing ==> ' + _cmd)
 
+    count_spawn()
     rc = subprocess.call(_cmd, shell=True)
 
     return bool(rc in [0, 1])
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     bootmenu.py
+# Purpose:  Module to keep the main syslinux.cfg and grub.cfg menus in memory and write them back once per operation
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import collections
+import contextlib
+import os
+import threading
+
+from . import gen
+
+# Files written along with a menu, with the same content.
+MIRRORS = {'syslinux.cfg': ['extlinux.cfg']}
+
+_lock = threading.RLock()
+# Path -> MenuFile of the menus loaded by the open transaction, if any.
+_menus = None
+_depth = 0
+
+
+class MenuFile:
+    """
+    Main menu of the USB disk, split into the distro blocks delimited by
+    '#start NAME' and '#end NAME' lines and the text in between them, in
+    file order and keyed by serial number. Blank lines following a block
+    belong to it. A name may have several blocks.
+    Adding or removing a distro block is O(1), the text is only joined
+    back when saving.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = collections.OrderedDict()
+        # Name -> serials of the blocks of the name.
+        self.blocks = {}
+        # Serial -> name of the block.
+        self.block_names = {}
+        self.serial = 0
+        self.dirty = False
+        try:
+            with open(path, 'r') as f:
+                self._add_text(f.read())
+        except (IOError, OSError):
+            pass
+
+    def __contains__(self, name):
+        return name in self.blocks
+
+    def names(self):
+        """
+        :return: Names of the blocks, in the order of their first block
+        """
+        names = []
+        for serial in self.segments:
+            name = self.block_names.get(serial)
+            if name is not None and self.blocks[name][0] == serial:
+                names.append(name)
+        return names
+
+    def text(self):
+        return ''.join(self.segments.values())
+
+    def append(self, text):
+        """
+        Add text as if appended to the file. Distro blocks in text replace
+        the ones of the same name, moving to the end of the menu.
+        """
+        if not text:
+            return
+        last = next(reversed(self.segments.values()), '\n')
+        if not last.endswith('\n'):
+            text = '\n' + text
+        self._add_text(text, replace=True)
+        self.dirty = True
+
+    def remove(self, name):
+        """
+        Remove all the blocks of a name.
+        :return: True if a block of the name was found
+        """
+        serials = self.blocks.pop(name, None)
+        if serials is None:
+            return False
+        for serial in serials:
+            del self.segments[serial]
+            del self.block_names[serial]
+        self.dirty = True
+        return True
+
+    def save(self):
+        """
+        Write the menu and its mirrors if it changed. Each file is written
+        to a temporary file renamed over it, so that an interrupted write
+        leaves the previous menu in place.
+        """
+        if not self.dirty:
+            return
+        text = self.text()
+        paths = [self.path] + [
+            os.path.join(os.path.dirname(self.path), mirror)
+            for mirror in MIRRORS.get(os.path.basename(self.path), [])]
+        for path in paths:
+            tmp_path = path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(text)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        self.dirty = False
+
+    def _add_text(self, text, replace=False):
+        lines = text.splitlines(True)
+        free = []
+        # Names text brings blocks of, which replace the ones there were.
+        replaced = set()
+        i = 0
+        while i < len(lines):
+            name = lines[i][len('#start '):].strip() \
+                if lines[i].startswith('#start ') else ''
+            end = '#end ' + name
+            j = i + 1
+            while name and j < len(lines) and lines[j].rstrip() != end:
+                j += 1
+            if not name or j == len(lines):
+                free.append(lines[i])
+                i += 1
+                continue
+            j += 1
+            while j < len(lines) and not lines[j].strip():
+                j += 1
+            self._add_free(free)
+            free = []
+            if replace and name not in replaced:
+                self.remove(name)
+                replaced.add(name)
+            self.serial += 1
+            self.segments[self.serial] = ''.join(lines[i:j])
+            self.blocks.setdefault(name, []).append(self.serial)
+            self.block_names[self.serial] = name
+            i = j
+        self._add_free(free)
+
+    def _add_free(self, lines):
+        if lines:
+            self.serial += 1
+            self.segments[self.serial] = ''.join(lines)
+
+
+class MenuAppender:
+    """
+    File like object collecting what gets written to a menu, see open_append().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.chunks = []
+
+    def write(self, text):
+        self.chunks.append(text)
+        return len(text)
+
+    def close(self):
+        if self.chunks is None:
+            return
+        text, self.chunks = ''.join(self.chunks), None
+        with _lock:
+            menu = load(self.path)
+            menu.append(text)
+            if _menus is None:
+                menu.save()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Don't leave half a block in the menu.
+            self.chunks = None
+
+
+def load(path):
+    """
+    :return: MenuFile of path, the one of the open transaction if there is one.
+    """
+    with _lock:
+        if _menus is None:
+            return MenuFile(path)
+        if path not in _menus:
+            _menus[path] = MenuFile(path)
+        return _menus[path]
+
+
+def open_append(path):
+    """
+    Replacement of open(path, 'a') for the main menus. What gets written is
+    added to the menu on close(), and saved right away unless a transaction
+    is open.
+    """
+    return MenuAppender(path)
+
+
+def remove(path, name):
+    """
+    Remove the block of a distro from a menu.
+    :return: True if the menu had a block of the name
+    """
+    with _lock:
+        menu = load(path)
+        removed = menu.remove(name)
+        if _menus is None:
+            menu.save()
+    return removed
+
+
+@contextlib.contextmanager
+def transaction():
+    """
+    Keep the menus changed within the block in memory and write each of
+    them once when the outermost transaction ends, including when the
+    block raised, so that the menus match what got installed so far.
+    """
+    global _menus, _depth
+    with _lock:
+        if _depth == 0:
+            _menus = {}
+        _depth += 1
+    try:
+        yield
+    finally:
+        with _lock:
+            _depth -= 1
+            menus = None
+            if _depth == 0:
+                menus, _menus = _menus, None
+            for menu in (menus or {}).values():
+                try:
+                    menu.save()
+                except (IOError, OSError) as e:
+                    gen.log('Could not write %s: %s' % (menu.path, e),
+                            error=True)
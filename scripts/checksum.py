@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     checksum.py
+# Purpose:  Module to compute digests of written images and verify them by reading the target back
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import errno
+import hashlib
+import mmap
+import os
+import threading
+
+from . import config
+
+# O_DIRECT reads must be aligned to the logical block size of the device.
+ALIGNMENT = 4096
+READ_SIZE = 4 * 1024 * 1024
+
+
+def new_hash():
+    """
+    :return: hashlib object of config.verify_hash ('sha256', 'blake2b', ...)
+    """
+    return hashlib.new(config.verify_hash)
+
+
+def file_digest(path):
+    """
+    :return: Hex digest of the content of a file, see new_hash()
+    """
+    h = new_hash()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(READ_SIZE)
+            if not data:
+                return h.hexdigest()
+            h.update(data)
+
+
+class ReadBack(threading.Thread):
+    """
+    Hash a file or device from its start while it is being written. The
+    writer calls advance() with the number of bytes safely written so far
+    and finish() once done. Reading happens in this thread, lagging behind
+    the writer, so that verification overlaps with writing.
+    With direct=True the page cache is bypassed (O_DIRECT) where possible,
+    so that what gets hashed is what reached the media.
+    """
+
+    def __init__(self, path, direct=True):
+        threading.Thread.__init__(self, name='read_back', daemon=True)
+        self.path = path
+        self.direct = direct
+        self.hash = new_hash()
+        self.cond = threading.Condition()
+        self.available = 0
+        self.final = False
+        self.error = None
+        self.start()
+
+    def advance(self, nbytes):
+        with self.cond:
+            self.available = max(self.available, nbytes)
+            self.cond.notify()
+
+    def finish(self, length):
+        """
+        :param length: Total number of bytes written
+        :return: Hex digest of the first length bytes of the file
+        """
+        with self.cond:
+            self.available = length
+            self.final = True
+            self.cond.notify()
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.hash.hexdigest()
+
+    def cancel(self):
+        """
+        Stop reading, for when writing failed, and wait for the thread.
+        Errors of the thread are dropped.
+        """
+        with self.cond:
+            self.available = 0
+            self.final = True
+            self.cond.notify()
+        self.join()
+
+    def _open(self):
+        flags = os.O_RDONLY | getattr(os, 'O_BINARY', 0)
+        if self.direct and hasattr(os, 'O_DIRECT'):
+            try:
+                return os.open(self.path, flags | os.O_DIRECT), True
+            except OSError as e:
+                if e.errno != errno.EINVAL:
+                    raise
+        return os.open(self.path, flags), False
+
+    def _wait_for_data(self, pos):
+        """
+        :return: Tuple of (end of the data to read next, True if it is the last)
+        """
+        with self.cond:
+            while True:
+                end = self.available
+                if not self.final:
+                    # Keep reads aligned until the end is known.
+                    end -= end % ALIGNMENT
+                if end > pos or self.final:
+                    return end, self.final
+                self.cond.wait()
+
+    def run(self):
+        buf = memoryview(mmap.mmap(-1, READ_SIZE))
+        try:
+            fd, direct = self._open()
+            try:
+                pos = 0
+                while True:
+                    end, final = self._wait_for_data(pos)
+                    while pos < end:
+                        want = min(READ_SIZE, end - pos)
+                        size = want + (-want % ALIGNMENT) if direct else want
+                        try:
+                            os.lseek(fd, pos, os.SEEK_SET)
+                            n = os.readv(fd, [buf[:size]])
+                        except OSError as e:
+                            if not direct or e.errno != errno.EINVAL:
+                                raise
+                            # Device or file system refuses O_DIRECT.
+                            os.close(fd)
+                            fd, direct = os.open(self.path, os.O_RDONLY), False
+                            continue
+                        if n <= 0:
+                            raise IOError(errno.EIO, 'Unexpected end of %s'
+                                          % self.path)
+                        n = min(n, want)
+                        self.hash.update(buf[:n])
+                        pos += n
+                    if final:
+                        return
+            finally:
+                os.close(fd)
+        except (IOError, OSError) as e:
+            self.error = e
@@ -39,6 +39,40 @@ imager_return = ""
 
 install_size = ""
 
+# Native ISO9660 extraction. Files of at least extract_large_file_size bytes
+# are copied by a dedicated thread, the others by extract_workers threads.
+extract_workers = 4
+extract_large_file_size = 32 * 1024 * 1024
+# Remember distro detection results of ISOs across runs (see detect_cache.py).
+detect_cache = True
+detect_cache_size = 64
+# Large file copies (see copier.py). Chunk size can be picked per device,
+# e.g. {'/dev/sdb1': 4 * 1024 * 1024}. Data is flushed to the device every
+# copy_sync_size bytes, which is when progress gets reported.
+copy_chunk_size = 16 * 1024 * 1024
+copy_chunk_sizes = {}
+copy_sync_size = 64 * 1024 * 1024
+# Hash images while writing them and read them back to check (see checksum.py).
+verify = False
+verify_hash = 'sha256'
+# Raw writes on Linux: 'dd' runs the external dd, 'native' writes in-process
+# (see rawwrite.py) dd_block_size bytes at a time.
+dd_engine = 'dd'
+dd_block_size = 4 * 1024 * 1024
+# With the 'native' engine, zero the target range first (BLKZEROOUT) and skip
+# writing blocks of zeros. Only faster on disks which unmap or zero ranges
+# without writing them, on others the whole range is written twice.
+dd_discard_first = False
+# Threads removing files on uninstall (see manifest.py).
+uninstall_workers = 4
+# Threads rewriting the config files of a distro (see update_cfg_file.py).
+cfg_rewrite_workers = 4
+# Install directory of the distro to update to image_path instead of
+# installing it (see install.update_distro()). With update_hash, files whose
+# size and modification time match are also compared by content.
+update_from = ''
+update_hash = False
+
 editors_linux = ["xdg-open", "gedit", "kate", "kwrite"]
 editors_win = ["notepad++.exe", "notepad.exe"]
 
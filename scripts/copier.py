@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     copier.py
+# Purpose:  Module to copy large files such as ISO images to USB disks quickly
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import collections
+import errno
+import mmap
+import os
+import shutil
+import time
+
+from . import checksum
+from . import config
+from . import gen
+from . import isodump3
+
+CopyResult = collections.namedtuple('CopyResult',
+                                    ['throughput', 'digest', 'verified'])
+
+
+def chunk_size_for(usb_disk):
+    """
+    :param usb_disk: Device the copy goes to, e.g. '/dev/sdb1'
+    :return: Chunk size for the device from config.copy_chunk_sizes or config.copy_chunk_size
+    """
+    return config.copy_chunk_sizes.get(usb_disk, config.copy_chunk_size)
+
+
+def _fadvise(fd, offset, length, advice):
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, offset, length, advice)
+        except OSError:
+            pass
+
+
+def _sync(fd):
+    if hasattr(os, 'fdatasync'):
+        os.fdatasync(fd)
+    else:
+        os.fsync(fd)
+
+
+def copy_file(src, dst, chunk_size=None, sync_size=None, progress=None,
+              report=None, verify=None):
+    """
+    Copy a large file, preallocating the destination. Data is moved by
+    copy_file_range() (or sendfile() or a page aligned buffer, see
+    isodump3.copy_range()) chunk_size bytes at a time. The destination is
+    flushed every sync_size bytes and the pages of both files dropped from
+    the page cache, so that a multi-GB copy does not evict everything else.
+    With verify, data goes through the buffer instead so that its digest is
+    computed on the way, and every flushed range is read back from dst and
+    hashed by a second thread while the copy goes on.
+    :param src: Path to source file
+    :param dst: Path to destination file or directory
+    :param chunk_size: Bytes per copy call, config.copy_chunk_size by default
+    :param sync_size: Bytes between flushes, config.copy_sync_size by default
+    :param progress: Called with the number of bytes flushed to dst
+    :param report: Called with the throughput in MB/s after each flush
+    :param verify: Verify the copy, config.verify by default
+    :return: CopyResult
+    """
+    chunk_size = chunk_size or config.copy_chunk_size
+    sync_size = max(sync_size or config.copy_sync_size, chunk_size)
+    if verify is None:
+        verify = config.verify
+    if os.path.isdir(dst):
+        dst = os.path.join(dst, os.path.basename(src))
+    length = os.path.getsize(src)
+    # Anonymous maps are page aligned.
+    buf = memoryview(mmap.mmap(-1, min(chunk_size, isodump3.COPY_STEP_SIZE)))
+    src_hash = checksum.new_hash() if verify else None
+    read_back = None
+    start = time.time()
+    with open(src, 'rb') as f_input, open(dst, 'wb', 0) as f_output:
+        in_fd = f_input.fileno()
+        out_fd = f_output.fileno()
+        _fadvise(in_fd, 0, length, getattr(os, 'POSIX_FADV_SEQUENTIAL', 0))
+        isodump3.preallocate(out_fd, length)
+        if verify:
+            read_back = checksum.ReadBack(dst)
+        try:
+            copied = synced = 0
+            while copied < length:
+                n = min(chunk_size, length - copied)
+                if src_hash is None:
+                    isodump3.copy_range(f_input, copied, n, f_output, copied,
+                                        buf)
+                else:
+                    _copy_hashed(f_input, f_output, n, buf, src_hash)
+                copied += n
+                if copied - synced >= sync_size or copied == length:
+                    _sync(out_fd)
+                    dontneed = getattr(os, 'POSIX_FADV_DONTNEED', 0)
+                    _fadvise(in_fd, synced, copied - synced, dontneed)
+                    _fadvise(out_fd, synced, copied - synced, dontneed)
+                    if progress:
+                        progress(copied - synced)
+                    synced = copied
+                    if read_back:
+                        read_back.advance(synced)
+                    if report:
+                        report(_throughput(copied, start))
+        except Exception:
+            # Otherwise left waiting for data, keeping dst open.
+            if read_back:
+                read_back.cancel()
+            raise
+    shutil.copymode(src, dst)
+    throughput = _throughput(length, start)
+    gen.log('Copied %s to %s at %.1f MB/s' % (src, dst, throughput))
+    if not verify:
+        return CopyResult(throughput, None, None)
+    digest = src_hash.hexdigest()
+    verified = read_back.finish(length) == digest
+    log_verification(dst, digest, verified)
+    return CopyResult(throughput, digest, verified)
+
+
+def _copy_hashed(f_input, f_output, length, buf, src_hash):
+    """
+    Copy length bytes from the current position of f_input to the one of
+    f_output through buf, hashing them.
+    """
+    while length:
+        n = f_input.readinto(buf[:min(len(buf), length)])
+        if not n:
+            raise IOError(errno.EIO, "Unexpected end of file")
+        view = buf[:n]
+        src_hash.update(view)
+        while view:
+            view = view[f_output.write(view):]
+        length -= n
+
+
+def log_verification(target, digest, verified):
+    """
+    :return: Message logged
+    """
+    if verified:
+        message = 'Verified %s, %s %s' % (target, config.verify_hash, digest)
+    else:
+        message = 'Verification of %s failed: data read back does not ' \
+                  'match %s %s' % (target, config.verify_hash, digest)
+    gen.log(message, error=not verified)
+    return message
+
+
+def _throughput(nbytes, start):
+    return nbytes / (1024 * 1024) / max(time.time() - start, 1e-6)
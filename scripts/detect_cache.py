@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     detect_cache.py
+# Purpose:  Module to remember distro detection results of ISO images across runs.
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import json
+import os
+import threading
+
+from . import config
+from . import distro_rules
+from . import gen
+from . import isodump3
+
+# Bump when the layout of an entry changes.
+_cache_format = 1
+
+# Keys of the entries found by lookup(), most recently used last. Their
+# order gets saved by the next store(), lookups do not rewrite the file.
+_recently_used = []
+_recently_used_lock = threading.Lock()
+
+
+def cache_file_path():
+    return os.path.join(gen.multibootusb_host_dir(), 'detect_cache.json')
+
+
+def fingerprint(iso_link):
+    """
+    Identify the content of an ISO file without reading it whole.
+    :param iso_link: Path to ISO file
+    :return: Key as string, or None if the ISO has no ISO9660 primary volume descriptor.
+    """
+    # Don't let the parser complain about images which are not ISO9660.
+    if not isodump3.is_iso9660(iso_link):
+        return None
+    try:
+        st = os.stat(iso_link)
+        pvd_hash = isodump3.ISO9660(iso_link).priVolHash
+    except Exception:
+        return None
+    if pvd_hash is None:
+        return None
+    return '%d:%d:%s' % (st.st_size, st.st_mtime_ns, pvd_hash)
+
+
+def _rules_tag():
+    """
+    Results are only valid for the detection rules that produced them:
+    the ones of this version and the user's own ones, if any.
+    """
+    try:
+        user_rules_mtime = os.stat(distro_rules.user_rules_path()).st_mtime_ns
+    except OSError:
+        user_rules_mtime = 0
+    return '%s:%d' % (gen.mbusb_version(), user_rules_mtime)
+
+
+def _load():
+    try:
+        with open(cache_file_path(), 'r') as f:
+            cache = json.load(f)
+    except (IOError, OSError, ValueError):
+        return []
+    if not isinstance(cache, dict) or cache.get('format') != _cache_format \
+            or cache.get('version') != _rules_tag():
+        # Detection rules may have changed since.
+        return []
+    return cache.get('entries', [])
+
+
+def _save(entries):
+    path = cache_file_path()
+    tmp_path = path + '.tmp'
+    try:
+        with open(tmp_path, 'w') as f:
+            json.dump({'format': _cache_format,
+                       'version': _rules_tag(),
+                       'entries': entries}, f)
+        os.replace(tmp_path, path)
+    except (IOError, OSError) as e:
+        gen.log('Could not save detection cache: %s' % e)
+
+
+def lookup(iso_link, key=None):
+    """
+    Find the detection result of an ISO.
+    :param iso_link: Path to ISO file
+    :param key: fingerprint() of the ISO if already known
+    :return: Dict with 'distro', 'isolinux_bin_dir', 'syslinux_version' and 'file_list' keys or None.
+    """
+    if not config.detect_cache:
+        return None
+    key = key or fingerprint(iso_link)
+    if key is None:
+        return None
+    for entry in _load():
+        if entry.get('key') == key:
+            with _recently_used_lock:
+                if key in _recently_used:
+                    _recently_used.remove(key)
+                _recently_used.append(key)
+            return entry
+    return None
+
+
+def store(iso_link, distro, isolinux_bin_dir, syslinux_version, file_list,
+          key=None):
+    """
+    Remember the detection result of an ISO. The least recently used entries,
+    as of the lookups since the last store(), are dropped beyond
+    config.detect_cache_size entries.
+    :param iso_link: Path to ISO file
+    :param key: fingerprint() of the ISO if already known
+    :return:
+    """
+    if not config.detect_cache:
+        return
+    key = key or fingerprint(iso_link)
+    if key is None:
+        return
+    with _recently_used_lock:
+        rank = dict((k, i) for i, k in enumerate(_recently_used))
+        del _recently_used[:]
+    entries = [e for e in _load() if e.get('key') != key]
+    # Most recently used entries are kept at the end, the sort is stable.
+    entries.sort(key=lambda e: rank.get(e.get('key'), -1))
+    entries.append({'key': key,
+                    'distro': distro,
+                    'isolinux_bin_dir': isolinux_bin_dir or '',
+                    'syslinux_version': syslinux_version or '',
+                    'file_list': file_list})
+    _save(entries[-config.detect_cache_size:])
+
+
+def clear():
+    try:
+        os.remove(cache_file_path())
+    except OSError:
+        pass
@@ -6,15 +6,17 @@
 # Licence:  This file is a part of multibootusb package. You can redistribute it or modify
 # under the terms of GNU General Public License, v.2 or above
 
-from functools import partial
 import os
 import platform
 import re
 
 from . import _7zip
+from . import detect_cache
+from . import distro_rules
 from .gen import *
 from . import iso
 from .isodump3 import ISO9660
+from . import progress
 
 
 def distro(iso_cfg_ext_dir, iso_link, expose_exception=False):
@@ -27,8 +29,9 @@ def distro(iso_cfg_ext_dir, iso_link, expose_exception=False):
 #     iso_file_list = iso9660fs.readDir("/")
 
     distro = None  # tenatively set to None
+    rules = distro_rules.get_rules()
 
-    iso_file_list = _7zip.list_iso(
+    iso_file_list = iso.iso_file_list(
         iso_link, expose_exception=expose_exception)
     iso_file_list_lower = [f.lower() for f in iso_file_list]
     v_isolinux_bin_exists = iso.isolinux_bin_exist(iso_link)
@@ -48,117 +51,15 @@ def distro(iso_cfg_ext_dir, iso_link, expose_exception=False):
     else:
         iso_file_list = []
 
-    def run_contains(keywords, filename, file_content, iso_flielist,
-                     isolinux_bin_exists):
-        return any(k in file_content for k in keywords.split('|'))
-
-    def contains(keywords):
-        return partial(run_contains, keywords.lower())
-
-    def run_file_exists(filename_sought, filename, file_content, iso_filelist,
-                        isolinux_bin_exists):
-        return filename_sought in iso_filelist
-    def file_exists(filename_sought):
-        return partial(run_file_exists, filename_sought)
-
-    def run_isolinux_bin_exists(exist_or_not, filename, file_content,
-                                iso_filelist, isolinux_bin_exists):
-        return exist_or_not is isolinux_bin_exists
-
-    def isolinux_bin_exists(exist_or_not):
-        return partial(run_isolinux_bin_exists, exist_or_not)
-
-    def run_not(predicate, filename, file_content,
-                iso_filelist, isolinux_bin_exists):
-        return not predicate(filename, file_content, iso_filelist,
-                             isolinux_bin_exists)
-    def not_(predicate):
-        return partial(run_not, predicate)
-
-    # contains(X) predicates that X is contained in an examined text file.
-    # Multiple keywords can be concatenated by '|'. Predicates gets aaserted
-    # if anyone of the keywords is found in the text file.
-    # Sorry you can't include | in a keyword for now.
-    test_vector = [
-        ('ubcd',       contains('ubcd')),
-        ('hbcd',       contains('hbcd')),
-        ('systemrescuecd', contains('systemrescuecd')),
-        ('parted-magic', [contains('pmagic|partedmagic'),
-                          isolinux_bin_exists(True)]),
-        # mounting fat filesystem hard coded in to initrd.
-        # Can be modified only under linux.
-        ('mageialive', contains('mgalive')),
-        ('arch',       contains('archisolabel|misolabel|parabolaisolabel')),
-        ('chakra',     contains('chakraisolabel')),
-        ('kaos',       contains('kdeosisolabel')),
-        ('debian',     [contains('boot=live'), isolinux_bin_exists(True)]),
-        ('grml',       [contains('grml'), contains('live-media-path')]),
-        ('debian-install', [contains('debian-installer'),
-                            not_(file_exists('casper'))]),
-        ('solydx',     contains('solydx')),
-        ('knoppix',    contains('knoppix')),
-        ('centos',     contains('root=live:CDLABEL=CentOS')),
-        ('fedora',     contains('root=live:CDLABEL=|root=live:LABEL=')),
-        ('fedora',     contains('redcore')),
-        ('redhat',     contains('redhat')),
-        ('slitaz',     contains('slitaz|dban |ophcrack|tinycore|rescue.cpi'
-                                '|xpud|untangle|4mlinux|partition wizard'
-                                '|android-x86.png|riplinux|lebel dummy'
-                                '|http://pogostick.net/~pnh/ntpasswd/'
-                                '|AVG Rescue CD|AntivirusLiveCD'
-                                '|lkrn|Nanolinux|OSForensics|PING')),
-        ('slitaz',     contains('minimal Slackware|Slackware-HOWTO')),
-        #('suse',      contains('suse')),
-        ('opensuse-install', contains('class opensuse')),
-        ('ubuntu',     contains('boot=casper')),
-        ('wifislax',   contains('wifislax')),
-        ('slax',       contains('slax')),
-        ('sms',        [contains('sms.jpg|vector |autoexec'),
-                        isolinux_bin_exists(True)]),
-        ('antix',      contains('antix')),
-        ('porteus',    contains('porteus')),
-        ('pclinuxos',  contains('livecd=livecd|PCLinuxOS')),
-        ('gentoo',     contains('looptype=squashfs|http://dee.su/liberte')),
-        ('finnix',     contains('finnix')),
-        ('wifiway',    contains('wifiway')),
-        ('puppy',      contains('puppy|quirky|fatdog|slacko|xenialpup')),
-        ('ipcop',      contains('ipcop')),
-        ('ipfire',     contains('ipfire')),
-        ('salix-live', [contains('zenwalk|slack|salix'),
-                        contains('live')]),
-        ('zenwalk',        contains('zenwalk|slack|salix')),
-        ('ubuntu-server',  contains('ubuntu server')),
-        ('centos-install', contains('Install CentOS')),
-        ('centos',         contains('centos')),
-        ('trinity-rescue', contains('Trinity Rescue Kit')),
-        ('alpine',         contains('alpine')),
-        ('kaspersky',      contains('http://support.kaspersky.com')),
-        ('alt-linux',      contains('ALT Linux')),
-        ('Windows',        contains('Sergei Strelec')),
-        ('ReactOS',        contains('ReactOS')),
-        ('fsecure',        contains('fsecure')),
-        ('pc-unlocker',    contains('default rwp')),
-        ('pc-tool',        contains('/system/stage1')),
-        ('grub2only',      contains('vba32rescue')),
-        ('rising-av',      contains('BOOT_IMAGE=rising')),
-        ('Avira-RS',       contains('Avira Rescue System')),
-        ('insert',         contains('BOOT_IMAGE=insert')),
-        ('sgrubd2',    contains('Super Grub Disk')),
-        ]
-
-
     # I'm not sure if this platform check is necessary but I will
     # avoid removal to not alter the behaviour.
     if platform.system() == "Linux" or platform.system() == "Windows":
         for path, subdirs, files in os.walk(iso_cfg_ext_dir):
             for name in files:
-                name_lower = name.lower()
-                if not name_lower.endswith(('.cfg', '.txt', '.lst')):
-                    continue
-                if name_lower=='i18n.cfg':
-                    # i18n.cfg in salitaz-rolling cause misdetection
-                    # of centos by the following line.
-                    # MENU LABEL English US (acentos)
+                # i18n.cfg in salitaz-rolling cause misdetection
+                # of centos by the following line, hence "scan_skip".
+                # MENU LABEL English US (acentos)
+                if not rules.should_scan(name):
                     continue
                 try:
                     # errors='ignore' is required as some files also
@@ -169,12 +70,10 @@ def distro(iso_cfg_ext_dir, iso_link, expose_exception=False):
                     log("Read Error on %s." % name)
                     continue
 
-                for distro_, predicate in test_vector:
-                    predicates = [predicate] if callable(predicate) \
-                                 else predicate
-                    if all( p(name_lower, string.lower(), iso_file_list_lower,
-                              v_isolinux_bin_exists) for p in predicates ):
-                        return distro_
+                distro_ = rules.detect_from_text(
+                    string.lower(), iso_file_list_lower, v_isolinux_bin_exists)
+                if distro_:
+                    return distro_
 
     if distro:
         return distro
@@ -194,70 +93,65 @@ def distro(iso_cfg_ext_dir, iso_link, expose_exception=False):
         return None
 
 
+def detect_distro(iso_link, expose_exception=False, cfg_dir=None):
+    """
+    Extract the files needed for detection and detect the distro of an ISO.
+    The result is kept in the detection cache, so selecting the same ISO again
+    extracts nothing, the syslinux version later steps need included.
+    :param iso_link: Path to ISO file
+    :param cfg_dir: Directory to extract to instead of iso_cfg_ext_dir(), see gen.iso_cfg_staging_dir()
+    :return: Detected distro name as string.
+    """
+    _iso_cfg_ext_dir = cfg_dir or iso_cfg_ext_dir()
+    if not os.path.exists(_iso_cfg_ext_dir):
+        os.makedirs(_iso_cfg_ext_dir)
+    clean_iso_cfg_ext_dir(_iso_cfg_ext_dir)  # Need to be cleaned everytime
+    key = detect_cache.fingerprint(iso_link)
+    entry = detect_cache.lookup(iso_link, key)
+    if entry is not None:
+        log('Using cached detection result for ' + iso_link)
+        iso.remember_file_list(iso_link, entry['file_list'])
+        iso.remember_isolinux(iso_link, entry['isolinux_bin_dir'],
+                              entry['syslinux_version'])
+        if entry['isolinux_bin_dir'] and not entry['syslinux_version']:
+            # The version gets read from isolinux.bin. Not part of any
+            # install progress, as in extract_cfg_file().
+            iso.iso_extract_patterns(iso_link, _iso_cfg_ext_dir,
+                                     [iso.isolinux_bin_path(iso_link)],
+                                     tracker=progress.private())
+        return entry['distro']
+
+    iso.extract_cfg_file(iso_link, _iso_cfg_ext_dir)
+    _distro = distro(_iso_cfg_ext_dir, iso_link,
+                     expose_exception=expose_exception)
+    file_list = iso.iso_file_list(iso_link)
+    if file_list:
+        bin_path = iso.isolinux_bin_path(iso_link)
+        syslinux_version = bin_path and iso.isolinux_version(
+            os.path.join(_iso_cfg_ext_dir, bin_path))
+        bin_dir = iso.isolinux_bin_dir(iso_link)
+        iso.remember_isolinux(iso_link, bin_dir, syslinux_version)
+        detect_cache.store(iso_link, _distro, bin_dir, syslinux_version,
+                           file_list, key)
+    return _distro
+
+
 def detect_iso_from_file_list(iso_file_list):
     """
     Fallback detection script from the content of an ISO.
     :return: supported distro as string
     """
-    keys_to_distro = [
-        (['f4ubcd'], 'f4ubcd'),
-        (['alpine-release'], 'alpine'),
-        (['sources', 'boot.wim'], 'Windows'),
-        (['config.isoclient'], 'opensuse'),
-        (['dban'], 'slitaz'),
-        (['memtest.img'], 'memtest'),
-        (['mt86.png', 'isolinux'], 'raw_iso'),
-        (['menu.lst'], 'grub4dos'),
-        (['bootwiz.cfg', 'bootmenu_logo.png'], 'grub4dos_iso') ]
-
-    filenames = [f.lower() for f in iso_file_list]
-    for keys, distro in keys_to_distro:
-        match = True
-        for k in keys:
-            if all(k not in fn for fn in filenames):
-                match = False
-                break
-        if match is True:
-            return distro
-    #log("Examined %d %s in the iso but could not determine the distro."
-    #  % (len(filenames), len(filenames)==1 and 'filename' or 'filenames'))
-    return None
+    return distro_rules.get_rules().detect_from_file_list(iso_file_list)
 
 
 def perform_strict_detections(iso_cfg_ext_dir, iso_file_list):
-
-    def run_contains(filepath, keyword, cfg_dir=iso_cfg_ext_dir):
-        fullpath = os.path.join(cfg_dir, filepath.replace('/', os.sep))
-        if not os.path.exists(fullpath):
-            return False
-        try:
-            with open(fullpath, 'rb') as f:
-                data = f.read().lower()
-                return keyword in data
-        except (IOError, OSError):
-            log("Failed to open %s" % fullpath)
-            return False
-
-    def contains(relataive_filepath, keyword):
-        return partial(run_contains, relataive_filepath,
-                       bytes(keyword.lower(),'us-ascii'))
-
-    # contains(P, K) predicates that file P contains the specified
-    # string K. The predicate get never asserted if P has not been
-    # extracted into the staging area (iso_cfg_ext_dir).
-    test_vector = [
-        ('wifislax',   contains('boot/syslinux/menu/vesamenu.cfg',
-                                'menu label Wifislax64 Live')),
-        ('salix-live', contains('boot/menus/mainmenu.cfg',
-                                'MENU LABEL SALIX LIVE')),
-        ('grml',       contains('boot/isolinux/vesamenu.cfg',
-                                'menu title  Grml - Live Linux'))
-        ]
-    for distro, predicate in test_vector:
-        predicates = [predicate] if callable(predicate) else predicate
-        if all(p() for p in predicates):
-            return distro
-    return None
+    """
+    Detect distros that can only be told apart by the content of one
+    specific file.
+    :return: supported distro as string
+    """
+    return distro_rules.get_rules().detect_strict(iso_cfg_ext_dir,
+                                                  iso_file_list)
 
 
 if __name__ == '__main__':
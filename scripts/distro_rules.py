@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     distro_rules.py
+# Purpose:  Module to load and evaluate the distro detection rules kept in data/distro_rules.json
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import json
+import os
+import re
+
+from . import gen
+
+_rules = None
+
+
+class KeywordMatcher:
+    """
+    Find which of a set of keywords occur in a text, scanning it only once.
+    A combined regex locates the positions where some keyword starts and
+    the keywords sharing the first character are then checked there.
+    """
+    def __init__(self, keywords):
+        keywords = set(keywords)
+        self.by_first_char = {}
+        for k in keywords:
+            self.by_first_char.setdefault(k[0], []).append(k)
+        self.regex = re.compile('(?=%s)' % '|'.join(
+            re.escape(k) for k in sorted(keywords, key=len, reverse=True))) \
+            if keywords else None
+
+    def find(self, text):
+        """
+        :param text: Text to be scanned
+        :return: Set of the keywords found in text
+        """
+        found = set()
+        if self.regex is None:
+            return found
+        for m in self.regex.finditer(text):
+            pos = m.start()
+            for k in self.by_first_char[text[pos]]:
+                if k not in found and text.startswith(k, pos):
+                    found.add(k)
+        return found
+
+
+def _index(rules, keys_of):
+    """
+    Map each key to the positions of the rules it appears in.
+    :return: Dict of key -> list of rule positions
+    """
+    index = {}
+    for i, rule in enumerate(rules):
+        for k in keys_of(rule):
+            positions = index.setdefault(k, [])
+            if not positions or positions[-1] != i:
+                positions.append(i)
+    return index
+
+
+class RuleSet:
+    """
+    Detection rules with indexes so that only rules which can possibly
+    match get evaluated.
+
+    strict:    {"distro", "file", "contains"} - the file, extracted from the
+               ISO, contains the text. Indexed by file path.
+    file_list: {"distro", "names"} - each name is part of some path of the
+               ISO listing. Indexed by name.
+    keywords:  {"distro", "contains", ["isolinux_bin"], ["unless_file"]} -
+               a scanned cfg file has one keyword of each group of
+               "contains", isolinux.bin exists (or not) and the ISO has no
+               top level "unless_file". Indexed by keyword.
+    Only extracted files having one of "scan_suffixes" are scanned for
+    keywords, save for the ones listed in "scan_skip".
+    """
+    def __init__(self, rules):
+        self.strict = [dict(r, file=r['file'].lower().strip('/'),
+                            contains=r['contains'].lower().encode('utf-8'))
+                       for r in rules.get('strict', [])]
+        self.strict_by_path = _index(self.strict, lambda r: [r['file']])
+
+        self.file_list = [dict(r, names=[n.lower() for n in r['names']])
+                          for r in rules.get('file_list', [])]
+        self.file_list_by_name = _index(self.file_list, lambda r: r['names'])
+        self.file_list_matcher = KeywordMatcher(self.file_list_by_name)
+
+        self.scan_suffixes = tuple(s.lower() for s in
+                                   rules.get('scan_suffixes', []))
+        self.scan_skip = set(s.lower() for s in rules.get('scan_skip', []))
+
+        self.keywords = [dict(r, contains=[frozenset(k.lower() for k in group)
+                                           for group in r.get('contains', [])])
+                         for r in rules.get('keywords', [])]
+        self.keywords_by_keyword = _index(
+            self.keywords, lambda r: [k for group in r['contains'] for k in group])
+        # Rules without keywords are worth checking for any file.
+        self.keywords_always = [i for i, r in enumerate(self.keywords)
+                                if not r['contains']]
+        self.keyword_matcher = KeywordMatcher(self.keywords_by_keyword)
+
+    def should_scan(self, filename):
+        name = filename.lower()
+        return name.endswith(self.scan_suffixes) and name not in self.scan_skip
+
+    def detect_strict(self, iso_cfg_ext_dir, iso_file_list):
+        """
+        Evaluate the strict rules whose file is present in the ISO.
+        :param iso_cfg_ext_dir: Directory the ISO files were extracted to
+        :param iso_file_list: Listing of the ISO
+        :return: Detected distro as string or None
+        """
+        present = {}
+        for f in iso_file_list:
+            present.setdefault(f.replace('\\', '/').strip('/').lower(), f)
+        candidates = sorted(set(i for path in present
+                                for i in self.strict_by_path.get(path, [])))
+        for i in candidates:
+            rule = self.strict[i]
+            fullpath = os.path.join(
+                iso_cfg_ext_dir, present[rule['file']].replace('\\', '/')
+                .strip('/').replace('/', os.sep))
+            if not os.path.exists(fullpath):
+                continue
+            try:
+                with open(fullpath, 'rb') as f:
+                    if rule['contains'] in f.read().lower():
+                        return rule['distro']
+            except (IOError, OSError):
+                gen.log("Failed to open %s" % fullpath)
+        return None
+
+    def detect_from_file_list(self, iso_file_list):
+        """
+        Evaluate the file_list rules against an ISO listing.
+        :return: Detected distro as string or None
+        """
+        found = self.file_list_matcher.find(
+            '\n'.join(f.lower() for f in iso_file_list))
+        candidates = sorted(set(i for name in found
+                                for i in self.file_list_by_name[name]))
+        for i in candidates:
+            rule = self.file_list[i]
+            if all(n in found for n in rule['names']):
+                return rule['distro']
+        return None
+
+    def detect_from_text(self, text, iso_file_list_lower, isolinux_bin_exists):
+        """
+        Evaluate the keyword rules against the content of one cfg file.
+        :param text: Lowercased content of the file
+        :param iso_file_list_lower: Lowercased listing of the ISO
+        :param isolinux_bin_exists: True if the ISO has isolinux.bin
+        :return: Detected distro as string or None
+        """
+        found = self.keyword_matcher.find(text)
+        candidates = set(self.keywords_always)
+        for k in found:
+            candidates.update(self.keywords_by_keyword[k])
+        for i in sorted(candidates):
+            rule = self.keywords[i]
+            if not all(not group.isdisjoint(found) for group in rule['contains']):
+                continue
+            if 'isolinux_bin' in rule and \
+                    rule['isolinux_bin'] is not isolinux_bin_exists:
+                continue
+            if 'unless_file' in rule and \
+                    rule['unless_file'] in iso_file_list_lower:
+                continue
+            return rule['distro']
+        return None
+
+
+def user_rules_path():
+    return os.path.join(gen.multibootusb_host_dir(), 'distro_rules.json')
+
+
+def load_rules():
+    """
+    Read the bundled rules and the optional user ones from the multibootusb
+    host directory. User rules of each section take precedence.
+    :return: RuleSet
+    """
+    with open(gen.resource_path(os.path.join('data', 'distro_rules.json'))) as f:
+        rules = json.load(f)
+    user_path = user_rules_path()
+    if os.path.exists(user_path):
+        try:
+            with open(user_path) as f:
+                user_rules = json.load(f)
+            merged = dict(rules)
+            for section in ['strict', 'file_list', 'keywords', 'scan_suffixes',
+                            'scan_skip']:
+                merged[section] = user_rules.get(section, []) + \
+                    rules.get(section, [])
+            rule_set = RuleSet(merged)
+            gen.log('Loaded distro rules from ' + user_path)
+            return rule_set
+        except (IOError, OSError, ValueError, TypeError, AttributeError,
+                KeyError) as e:
+            gen.log('Ignoring %s: %s' % (user_path, e))
+    return RuleSet(rules)
+
+
+def get_rules():
+    """
+    :return: RuleSet, loaded on first use.
+    """
+    global _rules
+    if _rules is None:
+        _rules = load_rules()
+    return _rules
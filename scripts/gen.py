@@ -78,6 +78,27 @@ def iso_cfg_ext_dir():
     return os.path.join(multibootusb_host_dir(), 'iso_cfg_ext_dir')
 
 
+def iso_cfg_staging_dir(index):
+    """
+    Directory the files of the index-th ISO of a batch install are extracted
+    to ahead of its turn, see activate_iso_cfg_staging_dir().
+    """
+    return os.path.join(multibootusb_host_dir(), 'iso_cfg_staging', str(index))
+
+
+def activate_iso_cfg_staging_dir(staging_dir):
+    """
+    Make the files extracted to a staging directory the content of
+    iso_cfg_ext_dir(), where the install steps look for them.
+    :param staging_dir: Directory from iso_cfg_staging_dir()
+    :return:
+    """
+    target = iso_cfg_ext_dir()
+    if os.path.exists(target):
+        shutil.rmtree(target)
+    os.rename(staging_dir, target)
+
+
 def clean_iso_cfg_ext_dir(iso_cfg_ext_dir):
     """
     Clean old ISO config files extracted by previous use of multibootusb.
@@ -5,14 +5,21 @@
 # Authors:  Sundar
 # Licence:  This file is a part of multibootusb package. You can redistribute it or modify
 # under the terms of GNU General Public License, v.2 or above
+import collections
 import os
 import re
+from . import bootmenu
 from . import config
 from . import iso
 from . import _7zip
 from . import gen
 from .usb import bytes2human
 from . import menus
+from . import pathindex
+from . import syslinux_cfg
+
+# Results of converted_entries(), see there.
+_converted = collections.OrderedDict()
 
 
 def mbusb_update_grub_cfg():
@@ -93,7 +100,7 @@ def mbusb_update_grub_cfg():
     if os.path.exists(mbus_grub_cfg_path):
         gen.log('Updating grub.cfg file...')
         if grub_custom_menu(mbus_grub_cfg_path, config.distro) is False:
-            with open(mbus_grub_cfg_path, 'a') as f:
+            with bootmenu.open_append(mbus_grub_cfg_path) as f:
                 f.write("#start " + iso.iso_basename(config.image_path) + "\n")
                 if grub_cfg_path is not None:
                     if  config.distro == 'grub2only':
@@ -125,7 +132,7 @@ def mbusb_update_grub_cfg():
                 f.write("#end " + iso.iso_basename(config.image_path) + "\n")
 
     # Ascertain if the entry is made..
-    if gen.check_text_in_file(mbus_grub_cfg_path, iso.iso_basename(config.image_path)):
+    if iso.iso_basename(config.image_path) in bootmenu.load(mbus_grub_cfg_path):
         gen.log('Updated entry in grub.cfg...')
     else:
         gen.log('Unable to update entry in grub.cfg...')
@@ -181,7 +188,7 @@ def grub_raw_iso(mbus_grub_cfg_path):
                  '    linux16 /multibootusb/memdisk iso raw vmalloc=750M\n' \
                  '    initrd16 /multibootusb/' + iso.iso_basename(config.image_path) + '/' + iso.iso_name(config.image_path) + '\n' \
                  '}\n'
-    with open(mbus_grub_cfg_path, 'a') as f:
+    with bootmenu.open_append(mbus_grub_cfg_path) as f:
         f.write("#start " + iso.iso_basename(config.image_path) + "\n")
         f.write(menu_entry)
         f.write("#end " + iso.iso_basename(config.image_path) + "\n")
@@ -206,7 +213,7 @@ def locate_kernel_file(subpath, isolinux_dir):
     #    return subpath
     if subpath[:1] != '/':
         subpath = '/' + subpath
-    if os.path.exists(os.path.join(config.usb_mount, subpath[1:])):
+    if pathindex.exists(os.path.join(config.usb_mount, subpath[1:])):
         gen.log("Accepting kernel/initrd path '%s' as it exists." % subpath)
         return subpath
     _iso_basename = iso.iso_basename(config.image_path)
@@ -223,7 +230,7 @@ def locate_kernel_file(subpath, isolinux_dir):
             os.path.join('multibootusb', _iso_basename, 'arch'),
             ]:
         fullpath = os.path.join(config.usb_mount, d, subpath)
-        if os.path.exists(fullpath):
+        if pathindex.exists(fullpath):
             gen.log("Digged out '%s' at '%s'" % (subpath, fullpath))
             unix_style_path = os.path.join(d, subpath).\
                               replace('\\', '/').\
@@ -281,11 +288,112 @@ def extract_initrd_params_and_fix_kernel(value, isolinux_dir):
     return  initrd_line, ' '.join(others),
 
 
+def convert_entry(entry, iso_bin_dir):
+    """
+    Convert a syslinux menu entry into a grub2 menuentry.
+    :param entry: syslinux_cfg.Entry
+    :param iso_bin_dir: Path to isolinux directory of an ISO
+    :return: Tuple of (menuentry title, label for comments, lines of the
+             menuentry or None if it would boot nothing)
+    """
+    labels = [v for v in entry.labels if v[0].lower()=='label']
+    menu_labels = [v for v in entry.labels if v[0].lower()=='menu label']
+    if 0 == len(labels) + len(menu_labels):
+        gen.log('Warning: found a block without menu-entry.')
+        menu_entry = 'Anonymous'
+        menu_label = 'Unlabeled'
+    else:
+        for vec, name in [ (labels, 'label'),
+                           (menu_labels, 'menu label') ]:
+            if 2 <= len(vec):
+                gen.log("warning: found a block with more than "
+                        "one '%s' entries." % name)
+        # Prefer 'menu label' over 'label'.
+        if 0<len(menu_labels):
+            value = menu_labels[0][1].replace('^', '')
+        else:
+            value = labels[0][1]
+        menu_entry = menu_label = value
+
+    # Convert lines containing 'kernel','linux','initrd'
+    # or 'append' into grub2 compatible ones.
+    linux_line = initrd_line = None
+    appends = []
+    sought_archs = ['x86_64', 'i686', 'i386']
+    arch = []
+    for keyword, value in entry.boot_lines:
+        kw = keyword.lower()
+        if kw in ['kernel', 'linux']:
+            if linux_line:
+                gen.log("Warning: found more than one "
+                        "'kernel/linux' lines in block '%s'."
+                        % menu_label)
+                continue
+            arch = [(value.find(a), a) for a in sought_archs
+                    if 0 <= value.find(a)]
+            linux_line = 'linux ' + \
+                         tweak_bootfile_path(value, iso_bin_dir)
+        elif kw == 'initrd':
+            if initrd_line:
+                gen.log("Warning: found more than one "
+                        "'initrd' specifications in block '%s'."
+                        % menu_label)
+                continue
+            initrd_line = 'initrd ' + \
+                          tweak_bootfile_path(value, iso_bin_dir)
+        elif kw== 'append':
+            new_initrd_line, new_value \
+                = extract_initrd_params_and_fix_kernel(
+                    value, iso_bin_dir)
+            appends.append(new_value)
+            if new_initrd_line:
+                if initrd_line:
+                    gen.log("Warning: found more than one initrd "
+                            "specifications in block '%s'."
+                            % menu_label)
+                initrd_line = new_initrd_line
+    if arch: # utilize left most arch.
+        menu_entry += (" (%s)" % sorted(arch)[-1][1])
+    if not (linux_line or initrd_line):
+        return menu_entry, menu_label, None
+    out_lines = ['menuentry ' + gen.quote(menu_entry) + ' {']
+    for starter, value in [
+            (linux_line, ' '.join(appends)),
+            (initrd_line, '')]:
+        vec = [x for x in [starter, value] if x]
+        if vec:
+            out_lines.append('    ' + ' '.join(vec))
+    out_lines.append( '}' )
+    return menu_entry, menu_label, out_lines
+
+
+def converted_entries(config_tree, iso_bin_dir):
+    """
+    Convert the entries of a parsed syslinux config file, or return the
+    result of converting a file of the same content for the same ISO and
+    USB disk earlier on, so that installing an ISO again skips conversion.
+    :return: List of convert_entry() results
+    """
+    key = (config_tree.digest, iso.iso_basename(config.image_path),
+           iso_bin_dir, config.usb_mount)
+    if key in _converted:
+        _converted.move_to_end(key)
+        return _converted[key]
+    result = [convert_entry(entry, iso_bin_dir)
+              for entry in config_tree.entries]
+    _converted[key] = result
+    while syslinux_cfg.CACHE_SIZE < len(_converted):
+        _converted.popitem(last=False)
+    return result
+
+
 def iso2grub2(install_dir, loopback_cfg_path):
     """
     Function to convert syslinux configuration to grub2 accepted configuration format. Features implemented are similar
     to that of grub2  'loopback.cfg'. This 'loopback.cfg' file can be later on caled directly from grub2. The main
     advantage of this function is to generate the 'loopback.cfg' file automatically without manual involvement.
+    Config files are parsed by syslinux_cfg, files they include are converted
+    right after them, and 'loopback.cfg' is written once at the end.
     :param install_dir: Path to distro install directory for looping through '.cfg' files.
     :param loopback_cfg_path: Path to 'loopback.cfg' to be updated
     :param file_out: Path to 'loopback.cfg' file. By default it is set to root of distro install directory.
@@ -297,136 +405,59 @@ def iso2grub2(install_dir, loopback_cfg_path):
     gen.log('loopback.cfg file is set to ' + loopback_cfg_path)
 
     iso_bin_dir = iso.isolinux_bin_dir(config.image_path)
-    seen_menu_entries = []
-    # Loop though the distro installed directory for finding config files
-    for dirpath, dirnames, filenames in os.walk(install_dir):
-        for f in filenames:
-            # We will strict to only files ending with '.cfg' extension. This is the file extension isolinux or syslinux
-            #  recommends for writing configurations
-            if not f.endswith((".cfg", ".CFG")):
-                continue
-            cfg_file_path = os.path.join(dirpath, f)
-            # We will omit the grub directory
-            if 'grub' in cfg_file_path:
-                continue
-            # we will use only files containing strings which can be converted to grub2 cfg style
-            with open(cfg_file_path, "r", errors='ignore') as f:
-                data = f.read()
-
-            # Make sure that lines with 'label' available for processing.
-            # Do nothing otherwise.
-            matching_blocks_re = [m for m in re.finditer(
-                '^(label)(.*?)(?=(^label))',
-                data, re.I|re.DOTALL|re.MULTILINE)]
-
-            if matching_blocks_re:
-                matching_blocks = [m.group() for m in matching_blocks_re]
-                # Append the block after the last matching position
-                matching_blocks.append(data[matching_blocks_re[-1].span()[1]:])
+    # We will strict to only files ending with '.cfg' extension. This is the
+    # file extension isolinux or syslinux recommends for writing
+    # configurations. Other files are converted when they are included.
+    cfg_file_paths = [os.path.join(dirpath, f)
+                      for dirpath, dirnames, filenames in os.walk(install_dir)
+                      for f in filenames if f.endswith((".cfg", ".CFG"))]
+    pending = list(reversed(cfg_file_paths))
+    visited = set()
+    seen_menu_entries = set()
+    chunks = []
+    while pending:
+        cfg_file_path = pending.pop()
+        # We will omit the grub directory
+        if cfg_file_path in visited or 'grub' in cfg_file_path:
+            continue
+        visited.add(cfg_file_path)
+        try:
+            config_tree = syslinux_cfg.parse_file(cfg_file_path)
+        except (IOError, OSError) as e:
+            gen.log('Could not read %s: %s' % (cfg_file_path, e))
+            continue
+        # Follow INCLUDE and CONFIG before the next file.
+        for name in reversed(config_tree.includes):
+            included = syslinux_cfg.include_path(cfg_file_path, name,
+                                                 install_dir)
+            if included:
+                pending.append(included)
+        # Make sure that lines with 'label' available for processing.
+        # Do nothing otherwise.
+        if not config_tree.entries:
+            continue
+
+        gen.log("Probing '%s'" % cfg_file_path)
+        out_lines = []
+        for menu_entry, menu_label, entry_lines in converted_entries(
+                config_tree, iso_bin_dir):
+            if menu_entry in seen_menu_entries:
+                out_lines.append( "# '%s' is superceded by the previous "
+                                  "definition." % menu_label)
+            elif entry_lines:
+                seen_menu_entries.add(menu_entry)
+                out_lines.extend(entry_lines)
             else:
-                m = re.search('^(label)(.*?)',
-                              data, re.I|re.DOTALL|re.MULTILINE)
-                matching_blocks = m and [data[m.start():]] or []
-
-            if not matching_blocks:
-                continue
-
-            #if not cfg_file_path.endswith('archiso_pxe64.cfg'):
-            #    continue
-            gen.log("Probing '%s'" % cfg_file_path)
-            out_lines = []
-            for matching_block in matching_blocks:
-                #print ('------------ block begins here ------------')
-                #print (matching_block)
-                #print ('------------ block ends here ------------')
-                # Extract 'menu label or 'label' line.
-                matches =  re.findall(
-                    r'^\s*(menu label|label)\s+(.*)$',
-                    matching_block, re.I|re.MULTILINE)
-                labels = [v for v in matches if v[0].lower()=='label']
-                menu_labels = [v for v in matches if v[0].lower()=='menu label']
-                if 0 == len(labels) + len(menu_labels):
-                    gen.log('Warning: found a block without menu-entry.')
-                    menu_entry = 'Anonymous'
-                    menu_label = 'Unlabeled'
-                else:
-                    for vec, name in [ (labels, 'label'),
-                                       (menu_labels, 'menu label') ]:
-                        if 2 <= len(vec):
-                            gen.log("warning: found a block with more than "
-                                    "one '%s' entries." % name)
-                    # Prefer 'menu label' over 'label'.
-                    if 0<len(menu_labels):
-                        value = menu_labels[0][1].replace('^', '')
-                    else:
-                        value = labels[0][1]
-                    menu_entry = menu_label = value
-
-                # Extract lines containing 'kernel','linux','initrd'
-                # or 'append' to convert them into grub2 compatible ones.
-                linux_line = initrd_line = None
-                appends = []
-                sought_archs = ['x86_64', 'i686', 'i386']
-                arch = []
-                for keyword, value in re.findall(
-                        r'^\s*(kernel|linux|initrd|append)[= ](.*)$',
-                        matching_block, re.I|re.MULTILINE):
-                    kw = keyword.lower()
-                    if kw in ['kernel', 'linux']:
-                        if linux_line:
-                            gen.log("Warning: found more than one "
-                                    "'kernel/linux' lines in block '%s'."
-                                    % menu_label)
-                            continue
-                        arch = [(value.find(a), a) for a in sought_archs
-                                if 0 <= value.find(a)]
-                        linux_line = 'linux ' + \
-                                     tweak_bootfile_path(value, iso_bin_dir)
-                    elif kw == 'initrd':
-                        if initrd_line:
-                            gen.log("Warning: found more than one "
-                                    "'initrd' specifications in block '%s'."
-                                    % menu_label)
-                            continue
-                        initrd_line = 'initrd ' + \
-                                      tweak_bootfile_path(value, iso_bin_dir)
-                    elif kw== 'append':
-                        new_initrd_line, new_value \
-                            = extract_initrd_params_and_fix_kernel(
-                                value, iso_bin_dir)
-                        appends.append(new_value)
-                        if new_initrd_line:
-                            if initrd_line:
-                                gen.log("Warning: found more than one initrd "
-                                        "specifications in block '%s'."
-                                        % menu_label)
-                            initrd_line = new_initrd_line
-                if arch: # utilize left most arch.
-                    menu_entry += (" (%s)" % sorted(arch)[-1][1])
-                menu_line = 'menuentry ' + gen.quote(menu_entry)
-                if menu_entry in seen_menu_entries:
-                    out_lines.append( "# '%s' is superceded by the previous "
-                                      "definition." % menu_label)
-                else:
-                    if linux_line or initrd_line:
-                        seen_menu_entries.append(menu_entry)
-                        out_lines.append(menu_line + ' {')
-                        for starter, value in [
-                                (linux_line, ' '.join(appends)),
-                                (initrd_line, '')]:
-                            vec = [x for x in [starter, value] if x]
-                            if vec:
-                                out_lines.append('    ' + ' '.join(vec))
-                        out_lines.append( '}' )
-                    else:
-                        out_lines.append("# Avoided emitting an empty "
-                                         "menu item '%s'." % menu_label)
-
-            with open(loopback_cfg_path, 'a') as f:
-                f.write('# Extracted from %s\n' %
-                        cfg_file_path.replace('\\', '/'))
-                f.write('\n'.join(out_lines) + '\n')
-                f.write('\n')
+                out_lines.append("# Avoided emitting an empty "
+                                 "menu item '%s'." % menu_label)
+        chunks.append('# Extracted from %s\n' %
+                      cfg_file_path.replace('\\', '/'))
+        chunks.append('\n'.join(out_lines) + '\n')
+        chunks.append('\n')
+
+    if chunks:
+        with open(loopback_cfg_path, 'a') as f:
+            f.write(''.join(chunks))
 
     if os.path.exists(loopback_cfg_path):
         gen.log(
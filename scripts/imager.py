@@ -12,6 +12,7 @@ import io
 import os
 import platform
 import signal
+import threading
 import time
 import subprocess
 import traceback
@@ -23,7 +24,7 @@ from . import config
 from . import iso
 from . import osdriver
 from . import progressbar
-from . import osdriver
+from . import rawwrite
 from . import usb
 
 
@@ -82,6 +83,72 @@ def _dd_iso_image(dd_progress_thread):
                 c.__exit__(None, None, None)
 
 
+def dd_iso_images(usb_disks):
+    """
+    Write config.image_path to several USB disks at once, reading it only
+    once (see rawwrite.write_images()). Linux only.
+    :param usb_disks: List of disks, e.g. ['/dev/sdb', '/dev/sdc']
+    :return: Dict of disk -> error message or None
+    """
+    pbar = progressbar.ProgressBar(maxval=100).start()
+    in_file_size = os.path.getsize(config.image_path)
+    disks = [osdriver.physical_disk(d) for d in usb_disks]
+    # Bytes written to the disks still being written.
+    written = dict((d, 0) for d in disks)
+    lock = threading.Lock()
+
+    def update():
+        # The slowest disk tells when it's all over.
+        if written:
+            percentage = min(written.values()) * 100. / in_file_size
+            config.imager_percentage = percentage
+            pbar.update(percentage)
+
+    def progress(disk, nbytes):
+        with lock:
+            written[disk] += nbytes
+            update()
+
+    def on_error(disk, error):
+        with lock:
+            del written[disk]
+            update()
+
+    unmounted = []
+    try:
+        for usb_disk in usb_disks:
+            for x in osdriver.find_mounted_partitions_on(usb_disk):
+                partition_dev, mount_point = x[:2]
+                c = usb.UnmountedContext(partition_dev, config.update_usb_mount)
+                c.__enter__()
+                unmounted.append((c, partition_dev))
+        log('Writing %s to %s' % (config.image_path, ', '.join(disks)))
+        digest, results = rawwrite.write_images(config.image_path, disks,
+                                                progress=progress,
+                                                on_error=on_error)
+    finally:
+        for c, partition_dev in unmounted:
+            c.__exit__(None, None, None)
+
+    errors = {}
+    for disk in disks:
+        result = results[disk]
+        if result.error is not None:
+            errors[disk] = str(result.error)
+            log('Error writing to %s: %s' % (disk, result.error))
+        elif result.verified is False:
+            errors[disk] = 'Verification of %s failed' % disk
+            log('%s written at %.1f MB/s but the data read back does not '
+                'match %s %s' % (disk, result.throughput, config.verify_hash,
+                                 digest))
+        else:
+            errors[disk] = None
+            log('%s written at %.1f MB/s%s' % (
+                disk, result.throughput,
+                ', verified' if result.verified else ''))
+    return errors
+
+
 class Imager(QtWidgets.QMainWindow, Ui_MainWindow):
     """
     Raw write to USB disk using dd.
@@ -6,20 +6,25 @@
 # Licence:  This file is a part of multibootusb package. You can redistribute it or modify
 # under the terms of GNU General Public License, v.2 or above
 
+import collections
 import lzma
 import os
 import platform
 import shutil
 import subprocess
 import threading
-import time
 from .usb import *
 from .gen import *
 # from .iso import *
 from . import iso
 from scripts.update_cfg_file import *
+from . import checksum
 from . import config
+from . import copier
+from . import manifest
 from . import persistence
+from . import progress
+from . import _7zip
 
 
 def install_distro():
@@ -37,14 +42,14 @@ def install_distro():
             resource_path(os.path.join("data", "tools", "multibootusb")),
             os.path.join(config.usb_mount, "multibootusb"))
 
+    record = manifest.Manifest(usb_mount, install_dir)
     if not os.path.exists(install_dir):
         _iso_file_list = iso.iso_file_list(config.image_path)
         os.makedirs(install_dir)
+        record.add(install_dir)
         with open(os.path.join(install_dir, "multibootusb.cfg"), "w") as f:
             f.write(config.distro)
-        with open(os.path.join(install_dir, "iso_file_list.cfg"), 'w') as f:
-            for file_path in _iso_file_list:
-                f.write(file_path + "\n")
+        write_iso_file_list(install_dir, _iso_file_list)
     else:
         # This path is usually not taken.
         with open(os.path.join(install_dir, "multibootusb.cfg"), "r") as f:
@@ -54,87 +59,375 @@ def install_distro():
 
     log("Installing " + iso_name(config.image_path) + " on " + install_dir)
 
-    # Some distros requires certain directories be at the root.
-    relocator = DirectoryRelocator(install_dir, usb_mount)
-
-    if config.distro == "opensuse":
-        iso.iso_extract_file(config.image_path, install_dir, 'boot')
-        config.status_text = "Copying ISO..."
-        log("Copying " + config.image_path + " to " + usb_mount)
-        copy_iso(config.image_path, usb_mount)
-    elif config.distro == "Windows" or config.distro == 'pc-unlocker'\
-            or config.distro == 'pc-tool' or config.distro == 'grub2only':
-        log("Extracting iso to " + usb_mount)
-        iso_extract_full(config.image_path, usb_mount)
-    elif config.distro == "trinity-rescue":
-        iso_extract_full(config.image_path, install_dir)
-        relocator.move(('trk3',))
-    elif config.distro == "ipfire":
-        iso.iso_extract_file(config.image_path, usb_mount,
-                             ['*.tlz', 'distro.img'])
-        iso.iso_extract_file(config.image_path, install_dir, 'boot')
-    elif config.distro == "zenwalk":
-        config.status_text = "Copying ISO..."
-        iso.iso_extract_file(config.image_path, install_dir, "kernel")
-        copy_iso(config.image_path, install_dir)
-    elif config.distro in ["salix-live", 'wifislax']:
-        # iso.iso_extract_file(config.image_path, install_dir, "boot")
-        iso.iso_extract_file(config.image_path, install_dir,
-                             ['*syslinux', '*isolinux', '*system_tools', '*menus', '*vmlinuz', '*initrd*',
-                              'EFI'])
-        iso.iso_extract_file(config.image_path, usb_mount,
-                             ['*modules', '*packages', '*optional',
-                              '*liveboot'])
-        #iso.iso_extract_full(config.image_path, usb_mount)
-        config.status_text = "Copying ISO..."
-        copy_iso(config.image_path, install_dir)
-    elif config.distro == "rising-av":
-        iso.iso_extract_file(config.image_path, install_dir, '*boot')
-        iso.iso_extract_file(config.image_path, usb_mount, '*rising')
-    elif config.distro == 'sgrubd2':
-        copy_iso(config.image_path, install_dir)
-    elif config.distro == 'alt-linux':
-        iso.iso_extract_file(config.image_path, install_dir, '-xr!*rescue')
-        iso.iso_extract_file(config.image_path, config.usb_mount, 'rescue')
-    elif config.distro == "generic":
-        #with open(os.path.join(install_dir, "generic.cfg"), "w") as f:
-        #    f.write(os.path.join(isolinux_bin_dir(config.image_path), "generic") + ".bs")
-        iso_extract_full(config.image_path, usb_mount)
-    elif config.distro == 'grub4dos':
-        iso_extract_full(config.image_path, usb_mount)
-    elif config.distro == 'ReactOS':
-        iso_extract_full(config.image_path, usb_mount)
-    elif config.distro == 'grub4dos_iso' or config.distro == 'raw_iso' or config.distro == 'memdisk_iso' or \
-                    config.distro == 'memdisk_img':
-        copy_iso(config.image_path, install_dir)
-    elif config.distro == 'Avira-RS':
-        iso_extract_full(config.image_path, install_dir)
-        # we want following directories on root of the USB drive. Ensure the previous directories are removed before moving.
-        relocator.move(('antivir', 'avupdate', 'system'))
-    elif config.distro == 'alpine':
-        iso_extract_full(config.image_path, install_dir)
-        relocator.move(('apks',))
-    elif config.distro == 'insert':
-        iso_extract_full(config.image_path, install_dir)
-        relocator.move(('INSERT',))
-    elif config.distro == 'centos-install' and \
-      any(f=='.treeinfo' for f in _iso_file_list):
-        # DVD installer
-        iso.iso_extract_file(config.image_path, install_dir, '-xr-!Packages')
-        log("Copying the source iso file as is.")
-        copy_iso(config.image_path, install_dir)
-    else:
-        iso.iso_extract_full(config.image_path, install_dir)
-
+    steps = install_steps(config.distro, install_dir, usb_mount,
+                          _iso_file_list)
+    entries = iso_entries(config.image_path)
+    sizes = install_step_sizes(config.image_path, steps, entries)
+    tracker = progress.tracker
+    tracker.start(sum(sizes) + config.persistence, 'Installing...')
+    run_install_steps(config.image_path, steps, sizes, install_dir, usb_mount,
+                      tracker, record, entries)
 
     if config.persistence != 0:
         log('Creating persistence...')
-        config.status_text = 'Creating persistence...'
+        tracker.set_text('Creating persistence...')
         persistence.create_persistence()
+        tracker.add(config.persistence)
 
     install_patch()
 
 
+def install_steps(distro, install_dir, usb_mount, iso_file_list):
+    """
+    Plan the installation of a distro as a list of steps:
+      ('extract', dest_dir, patterns) extracts the files selected by patterns
+          (see _7zip.select_paths()), the whole ISO if patterns is None.
+      ('copy', dest_dir) copies the ISO file itself.
+      ('relocate', dirs) moves dirs from install_dir to the root of the USB disk,
+          as some distros require certain directories to be there.
+    :param distro: Detected distro as string
+    :param install_dir: Directory of the distro on the USB disk
+    :param usb_mount: Mount point of the USB disk
+    :param iso_file_list: Listing of the ISO
+    :return: List of steps
+    """
+    if distro == "opensuse":
+        return [('extract', install_dir, ['boot']),
+                ('copy', usb_mount)]
+    elif distro in ["Windows", 'pc-unlocker', 'pc-tool', 'grub2only',
+                    "generic", 'grub4dos', 'ReactOS']:
+        return [('extract', usb_mount, None)]
+    elif distro == "trinity-rescue":
+        return [('extract', install_dir, None),
+                ('relocate', ('trk3',))]
+    elif distro == "ipfire":
+        return [('extract', usb_mount, ['*.tlz', 'distro.img']),
+                ('extract', install_dir, ['boot'])]
+    elif distro == "zenwalk":
+        return [('extract', install_dir, ["kernel"]),
+                ('copy', install_dir)]
+    elif distro in ["salix-live", 'wifislax']:
+        return [('extract', install_dir,
+                 ['*syslinux', '*isolinux', '*system_tools', '*menus',
+                  '*vmlinuz', '*initrd*', 'EFI']),
+                ('extract', usb_mount,
+                 ['*modules', '*packages', '*optional', '*liveboot']),
+                ('copy', install_dir)]
+    elif distro == "rising-av":
+        return [('extract', install_dir, ['*boot']),
+                ('extract', usb_mount, ['*rising'])]
+    elif distro in ['sgrubd2', 'grub4dos_iso', 'raw_iso', 'memdisk_iso',
+                    'memdisk_img']:
+        return [('copy', install_dir)]
+    elif distro == 'alt-linux':
+        return [('extract', install_dir, ['-xr!*rescue']),
+                ('extract', usb_mount, ['rescue'])]
+    elif distro == 'Avira-RS':
+        return [('extract', install_dir, None),
+                ('relocate', ('antivir', 'avupdate', 'system'))]
+    elif distro == 'alpine':
+        return [('extract', install_dir, None),
+                ('relocate', ('apks',))]
+    elif distro == 'insert':
+        return [('extract', install_dir, None),
+                ('relocate', ('INSERT',))]
+    elif distro == 'centos-install' and \
+            any(f == '.treeinfo' for f in iso_file_list):
+        # DVD installer
+        return [('extract', install_dir, ['-xr-!Packages']),
+                ('copy', install_dir)]
+    return [('extract', install_dir, None)]
+
+
+def iso_entries(iso_link):
+    """
+    :return: Ordered dict of '/' separated path -> _7zip.IsoEntry of the ISO
+             content, empty if it can't be listed
+    """
+    try:
+        return collections.OrderedDict(
+            (e.path.replace(os.sep, '/').replace('\\', '/'), e)
+            for e in _7zip.iter_iso(iso_link))
+    except Exception as e:
+        log('Could not read the sizes of the ISO files: %s' % e)
+        return collections.OrderedDict()
+
+
+def step_paths(step, entries):
+    """
+    :return: Paths of entries an 'extract' step extracts
+    """
+    if step[2] is None:
+        return list(entries)
+    return _7zip.select_paths(list(entries), step[2])
+
+
+def install_step_sizes(iso_link, steps, entries=None):
+    """
+    Bytes each install step is expected to write, from the sizes of the ISO
+    listing filtered by the patterns of the step.
+    :param iso_link: Path to ISO file
+    :param steps: List of steps from install_steps()
+    :param entries: iso_entries() of the ISO if already known
+    :return: List of sizes, one per step
+    """
+    if entries is None:
+        entries = iso_entries(iso_link)
+    total_size = iso_size(iso_link)
+    sizes = []
+    for step in steps:
+        if step[0] == 'copy':
+            sizes.append(total_size)
+        elif step[0] == 'extract' and not entries:
+            # Best guess without a listing.
+            sizes.append(total_size if step[2] is None else 0)
+        elif step[0] == 'extract':
+            paths = step_paths(step, entries)
+            sizes.append(sum(entries[p].size for p in paths
+                             if not entries[p].is_dir))
+        else:
+            sizes.append(0)
+    return sizes
+
+
+def run_install_steps(iso_link, steps, sizes, install_dir, usb_mount,
+                      tracker, record=None, entries=None):
+    """
+    Run install steps. Engines that count the bytes they write (native
+    extraction, copy_iso() on Linux) push them to tracker as they go, the
+    others are accounted for when their step completes.
+    :param record: manifest.Manifest to add what the steps create to
+    :param entries: iso_entries() of the ISO if already known
+    :return:
+    """
+    if record is not None and entries is None:
+        entries = iso_entries(iso_link)
+    relocator = DirectoryRelocator(install_dir, usb_mount)
+    for step, size in zip(steps, sizes):
+        done_before = tracker.done
+        created = step_new_paths(iso_link, step, usb_mount, record, entries) \
+            if record is not None else []
+        if step[0] == 'extract':
+            dest_dir, patterns = step[1:]
+            log("Extracting iso to " + dest_dir)
+            if patterns is None:
+                iso.iso_extract_full(iso_link, dest_dir)
+            else:
+                iso.iso_extract_file(iso_link, dest_dir, patterns)
+        elif step[0] == 'copy':
+            tracker.set_text("Copying ISO...")
+            log("Copying " + iso_link + " to " + step[1])
+            copy_iso(iso_link, step[1])
+        elif step[0] == 'relocate':
+            relocator.move(step[1])
+        if record is not None:
+            record_step(iso_link, step, install_dir, usb_mount, record,
+                        entries)
+            for path in created:
+                if os.path.lexists(path):
+                    record.add(path)
+            record.save()
+        tracker.add(max(0, size - (tracker.done - done_before)))
+
+
+def step_new_paths(iso_link, step, usb_mount, record, entries):
+    """
+    Files and directories an install step is going to create, to be looked
+    up before the step runs.
+    :return: List of full paths
+    """
+    if step[0] == 'extract':
+        if record.covers(step[1]):
+            return []
+        return record.new_paths(step[1], step_paths(step, entries))
+    elif step[0] == 'copy':
+        return record.new_paths(step[1], [iso_name(iso_link)])
+    elif step[0] == 'relocate':
+        # DirectoryRelocator replaces what is there.
+        return [os.path.join(usb_mount, d) for d in step[1]]
+    return []
+
+
+def record_step(iso_link, step, install_dir, usb_mount, record, entries):
+    """
+    List the files an install step wrote from the ISO in record, along with
+    their size and modification time in the ISO, for updates to compare.
+    :return:
+    """
+    if step[0] == 'extract':
+        for path in step_paths(step, entries):
+            entry = entries[path]
+            if not entry.is_dir:
+                record.add_file(os.path.join(step[1], *path.split('/')),
+                                entry.size, entry.mtime)
+    elif step[0] == 'copy':
+        st = os.stat(iso_link)
+        record.add_file(os.path.join(step[1], iso_name(iso_link)),
+                        st.st_size, st.st_mtime)
+    elif step[0] == 'relocate':
+        for d in step[1]:
+            record.move(os.path.join(install_dir, d),
+                        os.path.join(usb_mount, d))
+
+
+def write_iso_file_list(install_dir, iso_file_list):
+    """
+    Save the listing of the ISO of a distro in its install directory, for
+    install_distro() to read back.
+    """
+    with open(os.path.join(install_dir, "iso_file_list.cfg"), 'w') as f:
+        for file_path in iso_file_list:
+            f.write(file_path + "\n")
+
+
+def update_distro(installed_name):
+    """
+    Update an installed distro to the ISO config.image_path, a newer release
+    of it. The ISO listing is compared against the manifest of the install:
+    files whose size and modification time (and content, with
+    config.update_hash) are unchanged are kept, the others are extracted
+    again and files the new ISO doesn't have any more are removed, along with
+    the directories they leave empty.
+    The install directory gets renamed after the new ISO if needed, once its
+    files are updated, in which case every config file is extracted again.
+    :param installed_name: Name of the install directory of the distro
+    :return: List of the config files written, to be tweaked again, None if
+             the distro can't be updated in place
+    """
+    usb_mount = config.usb_mount
+    iso_link = config.image_path
+    old_dir = os.path.join(usb_mount, "multibootusb", installed_name)
+    install_dir = os.path.join(usb_mount, "multibootusb", iso_basename(iso_link))
+    record = manifest.Manifest(usb_mount, old_dir)
+    if not record.files:
+        log('%s was installed without a manifest of its files, it has to be '
+            'uninstalled and installed again.' % installed_name)
+        return None
+    with open(os.path.join(old_dir, "multibootusb.cfg"), "r") as f:
+        installed_distro = f.read().strip()
+    if installed_distro != config.distro:
+        log('%s is %s, not %s. It has to be uninstalled and installed again.'
+            % (installed_name, installed_distro, config.distro))
+        return None
+    entries = iso_entries(iso_link)
+    if not entries:
+        return None
+    renamed = old_dir != install_dir
+    if renamed and os.path.exists(install_dir):
+        log(install_dir + ' already exists.')
+        return None
+
+    # Files get updated under the old name, so that the boot menus and the
+    # manifest still point at them if the update fails half way.
+    steps = install_steps(config.distro, old_dir, usb_mount, list(entries))
+    relocated = set(d for step in steps if step[0] == 'relocate'
+                    for d in step[1])
+    # Destination directory -> paths of the ISO to extract there.
+    plan = collections.OrderedDict()
+    copies = []
+    wanted = set()
+    unchanged = []
+    for step in steps:
+        if step[0] == 'copy':
+            target = os.path.join(step[1], iso_name(iso_link))
+            st = os.stat(iso_link)
+            wanted.add(record.relpath(target))
+            if record.files.get(record.relpath(target)) != \
+                    (st.st_size, int(st.st_mtime)):
+                copies.append(step[1])
+        if step[0] != 'extract':
+            continue
+        for path in step_paths(step, entries):
+            entry = entries[path]
+            if entry.is_dir:
+                continue
+            dest_dir = step[1]
+            if dest_dir == old_dir and path.split('/')[0] in relocated:
+                dest_dir = usb_mount
+            target = os.path.join(dest_dir, *path.split('/'))
+            rel = record.relpath(target)
+            wanted.add(rel)
+            if record.files.get(rel) != (entry.size, int(entry.mtime)) or \
+                    (renamed and is_distro_cfg_file(path)):
+                plan.setdefault(dest_dir, []).append(path)
+            elif config.update_hash and not is_distro_cfg_file(path):
+                unchanged.append((dest_dir, path, target))
+
+    if unchanged:
+        digests = iso.iso_file_digests(iso_link,
+                                       [path for _, path, _ in unchanged])
+        for dest_dir, path, target in unchanged:
+            try:
+                same = digests is not None and \
+                    checksum.file_digest(target) == digests.get(path)
+            except (IOError, OSError):
+                same = False
+            if not same:
+                plan.setdefault(dest_dir, []).append(path)
+
+    stale = [rel for rel in record.files if rel not in wanted]
+    for rel in stale:
+        path = os.path.join(usb_mount, *rel.split('/'))
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        del record.files[rel]
+        record.prune(os.path.dirname(path))
+
+    tracker = progress.tracker
+    tracker.start(sum(entries[p].size for paths in plan.values() for p in paths)
+                  + len(copies) * iso_size(iso_link), 'Updating...')
+    changed = []
+    for dest_dir, paths in plan.items():
+        log('Extracting %d changed file(s) to %s' % (len(paths), dest_dir))
+        created = record.new_paths(dest_dir, paths)
+        iso.iso_extract_paths(iso_link, dest_dir, paths)
+        for path in paths:
+            target = os.path.join(dest_dir, *path.split('/'))
+            record.add_file(target, entries[path].size, entries[path].mtime)
+            changed.append(target)
+        for path in created:
+            record.add(path)
+        record.save()
+    for dest_dir in copies:
+        tracker.set_text("Copying ISO...")
+        copy_iso(iso_link, dest_dir)
+        record_step(iso_link, ('copy', dest_dir), old_dir, usb_mount,
+                    record, entries)
+    record.save()
+    log('Updated %d file(s), kept %d, removed %d.'
+        % (len(changed) + len(copies), len(wanted) - len(changed) - len(copies),
+           len(stale)))
+    if renamed:
+        log('Renaming %s to %s' % (old_dir, install_dir))
+        os.rename(old_dir, install_dir)
+        record.move(old_dir, install_dir)
+        record.save()
+        changed = [install_dir + path[len(old_dir):]
+                   if path.startswith(old_dir + os.sep) else path
+                   for path in changed]
+    write_iso_file_list(install_dir, iso.iso_file_list(iso_link))
+
+    cfg_files = [path for path in changed
+                 if path.startswith(install_dir + os.sep) and
+                 is_distro_cfg_file(path)]
+    for path in cfg_files:
+        # syslinux.cfg copies of isolinux.cfg get made again.
+        dirname, fname = os.path.split(path)
+        if fname.lower().endswith('isolinux.cfg'):
+            copy = os.path.join(dirname,
+                                fname.lower().replace('isolinux.cfg', 'syslinux.cfg'))
+            if record.relpath(copy) not in record.files and os.path.exists(copy):
+                os.remove(copy)
+    # A loopback.cfg not coming from the ISO is written again with the menus.
+    loopback_cfg = os.path.join(install_dir, 'loopback.cfg')
+    if record.relpath(loopback_cfg) not in record.files and \
+            os.path.exists(loopback_cfg):
+        os.remove(loopback_cfg)
+    return cfg_files
+
+
 def copy_iso(src, dst):
     """
     A simple wrapper for copying larger files. This is necessary as
@@ -150,12 +443,17 @@ def copy_iso(src, dst):
         assert os.path.exists(dst)
         subprocess.call(['xcopy', '/Y', src, dst], shell=True)
     elif platform.system() == "Linux":
-        shutil.copy(src, dst)
+        copier.copy_file(
+            src, dst, chunk_size=copier.chunk_size_for(config.usb_disk),
+            progress=progress.tracker.add,
+            report=lambda mbps: progress.tracker.set_text(
+                "Copying ISO... %.1f MB/s" % mbps))
 
 
 def install_progress():
     """
-    Function to calculate progress percentage of install.
+    Function to report progress percentage of install, as accounted for by
+    progress.tracker.
     :return:
     """
     from . import progressbar
@@ -166,22 +464,12 @@ def install_progress():
         return
 
     config.usb_mount = usb_details['mount_point']
-    usb_size_used = usb_details['size_used']
     thrd = threading.Thread(target=install_distro, name="install_progress")
-    # thrd.daemon()
-    # install_size = usb_size_used / 1024
-#     install_size = iso_size(config.image_path) / 1024
-    final_size = (usb_size_used + iso_size(config.image_path)) + config.persistence
     thrd.start()
     pbar = progressbar.ProgressBar(maxval=100).start()  # bar = progressbar.ProgressBar(redirect_stdout=True)
     while thrd.is_alive():
-        current_size = shutil.disk_usage(usb_details['mount_point'])[1]
-        percentage = int((current_size / final_size) * 100)
-        if percentage > 100:
-            percentage = 100
-        config.percentage = percentage
+        percentage, status_text = progress.tracker.wait(0.5)
         pbar.update(percentage)
-        time.sleep(0.1)
 
 
 def replace_syslinux_modules(syslinux_version, under_this_dir):
@@ -229,13 +517,10 @@ def install_patch():
     if not isobin_path:
         return
 
-    iso_cfg_ext_dir = os.path.join(multibootusb_host_dir(),
-                                   "iso_cfg_ext_dir")
-    isolinux_path = os.path.join(iso_cfg_ext_dir, isobin_path)
 #   iso_linux_bin_dir = isolinux_bin_dir(config.image_path)
     distro_install_dir = os.path.join(
         config.usb_mount, "multibootusb", iso_basename(config.image_path))
-    config.syslinux_version = isolinux_version(isolinux_path)
+    config.syslinux_version = iso.iso_syslinux_version(config.image_path)
 
     if config.distro in ['slitaz', 'ubunu']:
         replace_syslinux_modules(config.syslinux_version, distro_install_dir)
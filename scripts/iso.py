@@ -7,15 +7,30 @@
 # Licence:  This file is a part of multibootusb package. You can redistribute it or modify
 # under the terms of GNU General Public License, v.2 or above
 
+import collections
 import os
 import re
+import threading
 from .gen import *
 from .isodump3 import ISO9660
+from . import isodump3
 from . import _7zip
+from . import checksum
+from . import progress
 
 
 _iso_cfg_ext_dir = iso_cfg_ext_dir()
 
+# Listings of recently examined ISOs. Keys are (path, size, mtime, inode) so
+# that an image which gets modified or replaced is listed afresh.
+_file_list_cache = collections.OrderedDict()
+_file_list_cache_size = 16
+# Batch installs detect the next ISO while the current one is installed.
+_file_list_cache_lock = threading.RLock()
+# isolinux.bin directory and syslinux version of ISOs by iso_fingerprint(),
+# see remember_isolinux().
+_isolinux_cache = {}
+
 
 def iso_name(iso_link):
     """
@@ -52,8 +67,7 @@ def isolinux_bin_exist(iso_link):
     :return: True if "isolinux.bin" file exist of False if not.
     """
     if os.path.exists(iso_link):
-        iso_file_list = _7zip.list_iso(iso_link)
-        return bool(any("isolinux.bin" in s.lower() for s in iso_file_list))
+        return first_iso_path(iso_link, _is_isolinux_bin) is not None
 
 
 def iso_size(iso_link):
@@ -83,15 +97,14 @@ def isolinux_bin_dir(iso_link):
     Detects "isolinux.bin" directory.
     :return: path of "isolinux.bin" directory as string.
     """
+    remembered = _remembered_isolinux(iso_link)
+    if remembered is not None:
+        return remembered[0] or False
     if os.path.exists(iso_link):
-        bin_dir = False
-        for f in _7zip.list_iso(iso_link):
-            if 'isolinux.bin' in f.lower():
-                if 'efi' not in f.lower():  # Certain distros place their isolinux.bin in to /EFI/BOOT director and we don't want to include them
-                    bin_dir = os.path.dirname(f)
-                    break
-
-        return bin_dir
+        # Certain distros place their isolinux.bin in to /EFI/BOOT director and we don't want to include them
+        f = first_iso_path(iso_link, lambda f: _is_isolinux_bin(f) and
+                           'efi' not in f.lower())
+        return os.path.dirname(f) if f is not None else False
 
 
 def isolinux_bin_path(iso_link):
@@ -99,15 +112,39 @@ def isolinux_bin_path(iso_link):
     Detects pat to "isolinux.bin".
     :return: path of "isolinux.bin" as a string.
     """
-    iso_bin_path = False
-    if isolinux_bin_exist(iso_link) is not False:
-        iso_file_list = _7zip.list_iso(iso_link)
-        for f in iso_file_list:
-            if 'isolinux.bin' in f.lower():
-                iso_bin_path = f
-                break
+    if not os.path.exists(iso_link):
+        return False
+    return first_iso_path(iso_link, _is_isolinux_bin) or False
+
 
-    return iso_bin_path
+def _is_isolinux_bin(path):
+    return 'isolinux.bin' in path.lower()
+
+
+def first_iso_path(iso_link, match):
+    """
+    Find the first path of the listing of an ISO match(path) is true for.
+    The listing remembered by iso_file_list() is searched if there is one,
+    otherwise the ISO is listed by _7zip.iter_iso() only up to the path
+    found, and the whole listing remembered if none is.
+    :return: Path as listed by iso_file_list(), None if no path matches
+    """
+    key = iso_fingerprint(iso_link)
+    with _file_list_cache_lock:
+        file_list = _file_list_cache.get(key) if key is not None else None
+    if file_list is not None:
+        return next((f for f in file_list if match(f)), None)
+    paths = []
+    try:
+        for entry in _7zip.iter_iso(iso_link):
+            if match(entry.path):
+                return entry.path
+            paths.append(entry.path)
+    except Exception as e:
+        log(e)
+        return None
+    remember_file_list(iso_link, paths)
+    return None
 
 
 def iso_menu_lst_path(iso_link):
@@ -116,8 +153,7 @@ def iso_menu_lst_path(iso_link):
     :return: path of "menu.lst" as a string.
     """
     menu_lst_path = False
-    iso_file_list = _7zip.list_iso(iso_link)
-    for f in iso_file_list:
+    for f in iso_file_list(iso_link):
         if 'menu.lst' in f.lower():
             menu_lst_path = f
             break
@@ -133,12 +169,96 @@ def integrity(iso_link):
     return _7zip.test_iso(iso_link)
 
 
-def iso_file_list(iso_link):
+def iso_fingerprint(iso_link):
+    """
+    Identify the current state of an ISO file.
+    :param iso_link: Path to ISO file
+    :return: Tuple of (path, size, mtime, inode) or None if the file can not be examined.
     """
-    Function to return the content of an ISO.
+    try:
+        st = os.stat(iso_link)
+    except (OSError, TypeError, ValueError):
+        return None
+    return (os.path.abspath(iso_link), st.st_size, st.st_mtime_ns, st.st_ino)
+
+
+def iso_file_list(iso_link, expose_exception=False):
+    """
+    Function to return the content of an ISO. The listing is remembered for as long as the ISO file stays unchanged,
+    so repeated calls during detection and install do not rescan the image.
+    :param expose_exception: Re-raise a failure to list the ISO instead of returning an empty list.
     :return: List of files of an ISO as list.
     """
-    return _7zip.list_iso(iso_link)
+    key = iso_fingerprint(iso_link)
+    if key is None:
+        return _7zip.list_iso(iso_link, expose_exception=expose_exception)
+    with _file_list_cache_lock:
+        file_list = _file_list_cache.get(key)
+        if file_list is not None:
+            _file_list_cache.move_to_end(key)
+            return list(file_list)
+    file_list = _7zip.list_iso(iso_link, expose_exception=expose_exception)
+    if not file_list:
+        # Don't remember a failure.
+        return file_list
+    remember_file_list(iso_link, file_list)
+    return list(file_list)
+
+
+def remember_file_list(iso_link, file_list):
+    """
+    Store the listing of an ISO obtained elsewhere (e.g. from the detection cache) for iso_file_list() to return.
+    :param iso_link: Path to ISO file
+    :param file_list: List of files of the ISO
+    :return:
+    """
+    key = iso_fingerprint(iso_link)
+    if key is None or not file_list:
+        return
+    with _file_list_cache_lock:
+        for stale_key in [k for k in _file_list_cache if k[0] == key[0]]:
+            del _file_list_cache[stale_key]
+        _file_list_cache[key] = list(file_list)
+        while len(_file_list_cache) > _file_list_cache_size:
+            _file_list_cache.popitem(last=False)
+
+
+def remember_isolinux(iso_link, bin_dir, syslinux_version):
+    """
+    Store the isolinux.bin directory and syslinux version of an ISO found by
+    an earlier detection, for isolinux_bin_dir() and iso_syslinux_version()
+    to return.
+    :param iso_link: Path to ISO file
+    :param bin_dir: isolinux_bin_dir() of the ISO
+    :param syslinux_version: Version of its isolinux.bin, empty if unknown
+    :return:
+    """
+    key = iso_fingerprint(iso_link)
+    if key is None:
+        return
+    with _file_list_cache_lock:
+        for stale_key in [k for k in _isolinux_cache if k[0] == key[0]]:
+            del _isolinux_cache[stale_key]
+        _isolinux_cache[key] = (bin_dir, syslinux_version)
+
+
+def _remembered_isolinux(iso_link):
+    key = iso_fingerprint(iso_link)
+    with _file_list_cache_lock:
+        return _isolinux_cache.get(key)
+
+
+def iso_syslinux_version(iso_link):
+    """
+    Version of the isolinux.bin of an ISO, as remembered from its detection
+    or read from the copy extracted to iso_cfg_ext_dir().
+    :return: Version number as string.
+    """
+    remembered = _remembered_isolinux(iso_link)
+    if remembered is not None and remembered[1]:
+        return remembered[1]
+    return isolinux_version(os.path.join(iso_cfg_ext_dir(),
+                                         isolinux_bin_path(iso_link)))
 
 
 def isolinux_version(isolinux_bin_path):
@@ -165,20 +285,103 @@ def iso_extract_file(iso_link, dest_dir, _filter):
     :param filter: Filter to extract particular file(s)
     :return: Extract file(s) to destination.
     """
-    _7zip.extract_iso(iso_link, dest_dir, _filter)
+    if type(_filter) is str:
+        _filter = [_filter]
+    iso_extract_patterns(iso_link, dest_dir, _filter)
 
 
-def extract_cfg_file(iso_link):
+def extract_cfg_file(iso_link, dest_dir=None):
     """
     Function to extract certain files for auto detecting supported distros
     :param iso_link: Path to ISO file
+    :param dest_dir: Directory to extract to, iso_cfg_ext_dir() by default
     :return:
     """
     #_pattern = ['.cfg', '.CFG', '.txt', '.TXT', 'isolinux.bin', 'ISOLINUX.BIN', '.lst']
     _pattern = ['.cfg', '.txt', 'isolinux.bin', '.lst']
-    # file_list = iso_file_list(iso_link)
-    for ext in _pattern:
-        _7zip.extract_iso(iso_link, _iso_cfg_ext_dir, pattern='*' + ext)
+    # These are few small files and not part of any install progress.
+    iso_extract_patterns(iso_link, dest_dir or _iso_cfg_ext_dir,
+                         ['*' + ext for ext in _pattern],
+                         workers=1, tracker=progress.private())
+
+
+def iso_extract_patterns(iso_link, dest_dir, patterns, workers=None,
+                         tracker=None):
+    """
+    Extract the files matching any of the patterns in one go. Patterns
+    follow "7z x <patterns> -r" rules, see _7zip.select_paths().
+    :param iso_link: Path to ISO file
+    :param dest_dir: Path to destination directory.
+    :param patterns: List of wildcard patterns, exact paths or exclusion switches
+    :param workers: Extraction threads, see ISO9660.extractPaths()
+    :param tracker: progress.Progress the copied bytes are pushed to, progress.current() by default
+    :return:
+    """
+    iso9660fs = isodump3.open_iso9660(iso_link)
+    if iso9660fs is not None:
+        try:
+            index = iso9660fs.directoryIndex()
+            paths = _7zip.select_paths(index, patterns)
+            if iso9660fs.extractPaths(dest_dir, paths, index, workers,
+                                      tracker) == isodump3.E_SUCCESS:
+                return
+        except (IOError, OSError) as e:
+            log('Native extraction failed, using 7zip instead: %s' % e)
+    _7zip.extract_iso(iso_link, dest_dir, pattern=patterns)
+
+
+def iso_extract_paths(iso_link, dest_dir, paths, tracker=None):
+    """
+    Extract exactly the given files of an ISO. 7zip, used when the ISO can't
+    be read natively, may also extract files whose paths end like them.
+    :param dest_dir: Path to destination directory.
+    :param paths: '/' separated paths as listed by _7zip.iter_iso()
+    :param tracker: progress.Progress the copied bytes are pushed to, progress.current() by default
+    :return:
+    """
+    if not paths:
+        return
+    iso9660fs = isodump3.open_iso9660(iso_link)
+    if iso9660fs is not None:
+        try:
+            index = iso9660fs.directoryIndex()
+            if index is not None and all(p in index for p in paths) and \
+                    iso9660fs.extractPaths(dest_dir, paths, index,
+                                           tracker=tracker) == isodump3.E_SUCCESS:
+                return
+        except (IOError, OSError) as e:
+            log('Native extraction failed, using 7zip instead: %s' % e)
+    _7zip.extract_iso(iso_link, dest_dir, pattern=paths)
+
+
+def iso_file_digests(iso_link, paths):
+    """
+    Hash files of an ISO without extracting them, see checksum.new_hash().
+    :param paths: '/' separated paths as listed by _7zip.iter_iso()
+    :return: Dict of path -> hex digest, None if the ISO can't be read natively
+    """
+    iso9660fs = isodump3.open_iso9660(iso_link)
+    if iso9660fs is None:
+        return None
+    index = iso9660fs.directoryIndex()
+    if index is None:
+        return None
+    digests = {}
+    for path in paths:
+        if path not in index:
+            continue
+        loc, size = index[path][:2]
+        h = checksum.new_hash()
+        for loc, length in iso9660fs.multiExtents.get(path, [(loc, size)]):
+            iso9660fs.isoFile.seek(loc * isodump3.BLOCK_SIZE)
+            while length > 0:
+                data = iso9660fs.isoFile.read(min(length, checksum.READ_SIZE))
+                if not data:
+                    break
+                h.update(data)
+                length -= len(data)
+        digests[path] = h.hexdigest()
+    return digests
 
 
 def iso_extract_full(iso_link, dest_dir):
@@ -187,6 +390,8 @@ def iso_extract_full(iso_link, dest_dir):
     :param dest_dir: Destination path as string.
     :return: False if it fails or extract ISO files to destination directory.
     """
+    if isodump3.extract_iso9660(iso_link, dest_dir):
+        return
     _7zip.extract_iso(iso_link, dest_dir)
 
 
@@ -201,8 +406,7 @@ def iso_file_path(iso_link, file_name):
     assert file_name
 
     file_path = False
-    iso_file_list = _7zip.list_iso(iso_link)
-    for f in iso_file_list:
+    for f in iso_file_list(iso_link):
         if file_name in f.lower():
             file_path = f
             break
@@ -211,7 +415,7 @@ def iso_file_path(iso_link, file_name):
 
 def get_file_list(iso_link, predicate):
     # Note that unlike iso_file_path(), only the basename is checked.
-    return [f for f in _7zip.list_iso(iso_link) if predicate(f)]
+    return [f for f in iso_file_list(iso_link) if predicate(f)]
 
 if __name__ == '__main__':
     #iso_path = '../../../DISTROS/2016/debian-live-8.3.0-amd64-lxde-desktop.iso'
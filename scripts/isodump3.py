@@ -20,7 +20,13 @@ Extract directories and files.
 # Author  : joni <joni.kartore.lee@gmail.com>
 # version : 1.0
 
+import calendar
+import collections
+import errno
+import hashlib
+import queue
 import sys
+import threading
 import struct
 import os
 import re
@@ -28,6 +34,7 @@ import stat
 from ctypes import *
 from . import config
 from . import gen
+from . import progress
 
 
 BLOCK_SIZE = 2048
@@ -43,6 +50,19 @@ E_SUCCESS = 0
 E_FAILURE = -1
 E_DEVICEFILE = -2  # can't write device file
 
+# Size of the buffer used when data can't be copied between fds directly.
+COPY_BUFFER_SIZE = 1024 * 1024
+# Most bytes handed to the kernel at once, to report progress regularly.
+COPY_STEP_SIZE = 16 * 1024 * 1024
+# errno values telling a fast copy primitive doesn't apply to these fds.
+_COPY_FALLBACK_ERRNOS = set([errno.EXDEV, errno.EINVAL, errno.ENOSYS,
+                             errno.EBADF, errno.EOPNOTSUPP,
+                             getattr(errno, 'ENOTSUP', errno.EOPNOTSUPP)])
+# From linux/falloc.h, allocate without changing the size of the file.
+FALLOC_FL_KEEP_SIZE = 1
+# See _fallocate().
+_fallocate_func = None
+
 class PrimaryVolume(Structure):
     def  __init__(self):
         self.sysIdentifier = ""
@@ -112,9 +132,15 @@ class ISO9660:
             raise IOError("File {0} appears to be empty".format(isofile))
 
         self.isoFile = f
+        self.isoPath = isofile
         self.priVol = None
+        self.priVolHash = None
+        self.jolietVol = None
         self.rootDir = None
         self.rripOffset = -1
+        self.termDesc = None
+        self.multiExtents = {}
+        self.copyBuffer = None
 
         desc_nr = 0
         while True:
@@ -126,7 +152,11 @@ class ISO9660:
                 if flag == 1:
                     self.__readPrimaryVolume__(volume_dsc)
                     continue
+                if flag == 2:
+                    self.__readSupplementaryVolume__(volume_dsc)
+                    continue
                 if flag == 255:
+                    self.termDesc = 15+desc_nr
                     break
             except Exception as e:
                 gen.log("Got exception when init iso file:", sys.exc_info()[0])
@@ -140,6 +170,8 @@ class ISO9660:
     def __readPrimaryVolume__(self, volume_dsc):
         """ Dump primary volume descriptor """
         global BLOCK_SIZE
+        # Identifies the image contents (ids, dates, sizes, root location).
+        self.priVolHash = hashlib.sha1(volume_dsc).hexdigest()
         priVol = PrimaryVolume()
         priVol.sysIdentifier = volume_dsc[8:40]
         priVol.volIdentifier = volume_dsc[40:72]
@@ -166,6 +198,34 @@ class ISO9660:
             gen.log("This ISO doesn't support RRIP")
         self.rootDir = root_dir
 
+    def __readSupplementaryVolume__(self, volume_dsc):
+        """ Read a supplementary volume descriptor. Only Joliet is of interest. """
+        if volume_dsc[88:90] != b'%/' or volume_dsc[90:91] not in [b'@', b'C', b'E']:
+            return
+        jolietVol = PrimaryVolume()
+        jolietVol.volSize = struct.unpack('<L',volume_dsc[80:84])[0]
+        jolietVol.blockSize = struct.unpack('<H',volume_dsc[128:130])[0]
+        jolietVol.ptSize = struct.unpack('<L',volume_dsc[132:136])[0]
+        jolietVol.ptLRd = struct.unpack('<L',volume_dsc[140:144])[0]
+        jolietVol.rootLoc = struct.unpack('<L',volume_dsc[158:162])[0]
+        jolietVol.rootTotal = struct.unpack('<L',volume_dsc[166:170])[0]
+        self.jolietVol = jolietVol
+
+    def hasUDF(self):
+        """ Check the volume recognition sequence following the descriptor
+        set terminator for an UDF (NSR02/NSR03) descriptor.
+        """
+        if self.termDesc == None:
+            return False
+        for sector in range(self.termDesc+1, self.termDesc+17):
+            self.isoFile.seek(sector*2048)
+            ident = self.isoFile.read(6)[1:6]
+            if ident in [b'NSR02', b'NSR03']:
+                return True
+            if ident not in [b'BEA01', b'BOOT2', b'CDW02', b'TEA01']:
+                break
+        return False
+
     #  Rrip extension
     def __rripLoop__(self, desc_buf, len_buf):
 
@@ -408,40 +468,186 @@ class ISO9660:
                    break
         return dirs
 
-    def readPathtableL(self):
-        """ Read path table of L typde """
-        if self.priVol == None:
+    def readPathtableL(self, volume=None):
+        """ Read path table of L typde
+        @volume -- volume descriptor to read it from, primary one by default.
+        """
+        if volume == None:
+            volume = self.priVol
+        if volume == None:
            return
-        block_nr = self.priVol.ptLRd
-        total = self.priVol.ptSize
+        block_nr = volume.ptLRd
+        total = volume.ptSize
+        if volume is self.jolietVol:
+            encoding = 'utf-16-be'
+        else:
+            encoding = 'latin-1'
 
         path_table = []
         self.isoFile.seek(block_nr*BLOCK_SIZE)
         ptbuf = self.isoFile.read((BLOCK_SIZE * ((total+BLOCK_SIZE-1)//BLOCK_SIZE)))
-        i = 0
-        r_size = 0
-        while True :
-            i = i+1
+        pos = 0
+        while pos + 8 <= total:
             t = PathTabelItem()
-
-            t.lenDi = struct.unpack('B', ptbuf[0:1])[0]
-            t.lenEattr = struct.unpack('B', ptbuf[1:2])[0]
-            t.locExtent = struct.unpack('<L', ptbuf[2:6])[0]
-            t.pdirNr = struct.unpack('<H', ptbuf[6:8])[0]
-            t.fIdentifier = ptbuf[8:8+t.lenDi].decode()
-            path_table.append(t)
-            if t.lenDi % 2 :
-                len_pd = 1
-            else:
-                len_pd = 0
-
-            r_size += 9+t.lenDi-1+len_pd
-            if r_size >= total:
+            t.lenDi, t.lenEattr, t.locExtent, t.pdirNr = \
+                struct.unpack_from('<BBLH', ptbuf, pos)
+            if t.lenDi == 0:
                 break
-            ptbuf = ptbuf[9+t.lenDi-1+len_pd:]
+            t.fIdentifier = ptbuf[pos+8:pos+8+t.lenDi].decode(encoding, 'replace')
+            path_table.append(t)
+            pos += 8 + t.lenDi + (t.lenDi % 2)
         # while True
         return path_table
 
+    def directoryIndex(self):
+        """ Index the whole directory tree in one pass.
+        Directories are located through the path table and their extents are
+        fetched with as few reads as possible. Joliet names are preferred
+        over RRIP ones, which in turn are preferred over plain ISO9660 names.
+        This is the same order 7-Zip applies, so paths agree with what 7-Zip
+        lists and extracts.
+        Return an ordered dict {path: (extent, size, flags, mtime)}. Paths are
+        relative and '/' separated, listed depth first like 7-Zip does.
+        Return None if there is no usable primary volume.
+        """
+        if self.priVol == None:
+            return None
+        volume = self.jolietVol or self.priVol
+        if volume is self.jolietVol:
+            name_of = self.__jolietName__
+        elif self.rripOffset != -1:
+            name_of = self.__rripName__
+        else:
+            name_of = self.__plainName__
+
+        path_table = self.readPathtableL(volume) or []
+        extents = sorted(set([t.locExtent for t in path_table] + [volume.rootLoc]))
+        buffers = self.__readExtentRuns__(extents)
+
+        def dir_bytes(extent, size=None):
+            for start, buf in buffers:
+                offset = (extent - start) * BLOCK_SIZE
+                if 0 <= offset < len(buf):
+                    if size == None:
+                        # Size is stored in the '.' record of the directory.
+                        size = struct.unpack_from('<L', buf, offset+10)[0]
+                    if offset + size <= len(buf):
+                        return memoryview(buf)[offset:offset+size]
+                    break
+            if size == None:
+                self.isoFile.seek(extent * BLOCK_SIZE)
+                size = struct.unpack('<L', self.isoFile.read(14)[10:14])[0]
+            self.isoFile.seek(extent * BLOCK_SIZE)
+            return memoryview(self.isoFile.read(size))
+
+        self.multiExtents = {}
+        index = collections.OrderedDict()
+        visited = set()
+        stack = [('', volume.rootLoc, volume.rootTotal)]
+        while stack:
+            dir_path, extent, size = stack.pop()
+            if extent in visited:
+                continue
+            visited.add(extent)
+            subdirs = []
+            for name, loc, length, flags, mtime in self.__iterDirRecords__(
+                    dir_bytes(extent, size), name_of):
+                path = dir_path + name
+                if path in index and (index[path][2] & 0x80):
+                    # Continuation of a multi-extent file.
+                    first = index[path]
+                    index[path] = (first[0], first[1] + length, flags | 0x80,
+                                   first[3])
+                    self.multiExtents.setdefault(
+                        path, [(first[0], first[1])]).append((loc, length))
+                    continue
+                index[path] = (loc, length, flags, mtime)
+                if flags & 0x02:
+                    subdirs.append((path + '/', loc, length))
+                elif flags & 0x80:
+                    self.multiExtents[path] = [(loc, length)]
+            # Visit sub directories right after their parent entry.
+            for path, loc, length in reversed(subdirs):
+                stack.append((path, loc, length))
+        ordered = collections.OrderedDict()
+        self.__orderDepthFirst__(index, ordered)
+        return ordered
+
+    def __orderDepthFirst__(self, index, ordered):
+        children = {}
+        for path in index:
+            children.setdefault(path.rpartition('/')[0], []).append(path)
+        stack = list(reversed(children.get('', [])))
+        while stack:
+            path = stack.pop()
+            ordered[path] = index[path]
+            stack.extend(reversed(children.get(path, [])))
+
+    def __readExtentRuns__(self, extents, max_gap=32, max_run=1024):
+        """ Read sorted extents, coalescing the ones lying close to each
+        other into a single read. Return a list of (first_extent, bytes).
+        """
+        buffers = []
+        i = 0
+        while i < len(extents):
+            start = end = extents[i]
+            i += 1
+            while i < len(extents) and extents[i] - end <= max_gap and \
+                    extents[i] - start < max_run:
+                end = extents[i]
+                i += 1
+            self.isoFile.seek(start * BLOCK_SIZE)
+            buffers.append((start, self.isoFile.read((end - start + 1) * BLOCK_SIZE)))
+        return buffers
+
+    def __iterDirRecords__(self, buf, name_of):
+        """ Yield (name, extent, size, flags, mtime) of each directory record
+        in 'buf' except '.' and '..'. Records never cross a sector boundary.
+        """
+        total = len(buf)
+        pos = 0
+        while pos < total:
+            len_dr = buf[pos]
+            if len_dr == 0:
+                # Rest of the sector is padding.
+                pos = (pos // BLOCK_SIZE + 1) * BLOCK_SIZE
+                continue
+            record = buf[pos:pos+len_dr]
+            pos += len_dr
+            if len(record) < 34:
+                break
+            len_fi = record[32]
+            if len_fi == 1 and record[33] in (0, 1):
+                continue
+            name = name_of(record, len_fi)
+            yield (name,
+                   struct.unpack_from('<L', record, 2)[0],
+                   struct.unpack_from('<L', record, 10)[0],
+                   record[25],
+                   record_time(record))
+
+    def __plainName__(self, record, len_fi):
+        name = bytes(record[33:33+len_fi]).decode('latin-1')
+        idx = name.rfind(";")
+        if idx != -1:
+            name = name[0:idx]
+        return name
+
+    def __jolietName__(self, record, len_fi):
+        name = bytes(record[33:33+len_fi]).decode('utf-16-be', 'replace')
+        idx = name.rfind(";")
+        if idx != -1:
+            name = name[0:idx]
+        return name
+
+    def __rripName__(self, record, len_fi):
+        susp_start = 33 + len_fi + (1 - len_fi % 2)
+        if len(record) > susp_start + 4:
+            rr = self.__rripLoop__(bytes(record[susp_start:]), len(record) - susp_start)
+            if rr.altname not in ["", ".", ".."]:
+                return rr.altname
+        return self.__plainName__(record, len_fi)
+
     # @path -- path within iso file system.
     # @output -- what local path you want write to.
     # @pattern -- regular expression.
@@ -551,34 +757,139 @@ class ISO9660:
 
                 return E_SUCCESS
 
-        loc = dirRec.locExtent
-        length = dirRec.lenData
-        self.isoFile.seek(BLOCK_SIZE * loc)
-        #gen.log "file length(%d)"%(length)
-        r_size = BLOCK_SIZE*1024*50 #100M cache
-
         try:
-            f_output = open(detFile, 'wb', r_size)
+            f_output = open(detFile, 'wb', 0)
         except(IOError):
             sys.stderr.write("can't open{0} for write\n".format(detFile))
             return E_FAILURE
 
-        while True:
-            if length == 0:
-                break
-            elif length <= r_size:
-                r_size = length
-                length = 0
+        try:
+            self.copyExtents(f_output, [(dirRec.locExtent, dirRec.lenData)])
+        except(IOError, OSError):
+            sys.stderr.write("can't write {0}\n".format(detFile))
+            return E_FAILURE
+        finally:
+            f_output.close()
+        return E_SUCCESS
+
+    def copyExtents(self, f_output, extents, f_input=None, buf=None,
+                    progress=None):
+        """ Copy file extents [(location, length), ...] to the unbuffered
+        file f_output, in order. Data goes from the iso fd to the output fd
+        without passing through python where the platform allows it.
+        f_input and buf default to the ones of this instance. Threads must
+        pass their own. progress(nbytes) is called as data gets copied.
+        """
+        if f_input == None:
+            f_input = self.isoFile
+        if buf == None:
+            if self.copyBuffer == None:
+                self.copyBuffer = memoryview(bytearray(COPY_BUFFER_SIZE))
+            buf = self.copyBuffer
+        total = sum([length for loc, length in extents])
+        preallocate(f_output.fileno(), total)
+        out_offset = 0
+        for loc, length in extents:
+            copy_range(f_input, loc * BLOCK_SIZE, length, f_output,
+                       out_offset, buf, progress)
+            out_offset += length
+
+    def extractAll(self, dest_dir, workers=None, tracker=None):
+        """ Extract every file and directory of the image to dest_dir,
+        using the names directoryIndex() reports. See extractPaths().
+        Return 0 means success otherwise failure.
+        """
+        index = self.directoryIndex()
+        if index == None:
+            return E_FAILURE
+        return self.extractPaths(dest_dir, list(index), index, workers,
+                                 tracker)
+
+    def extractPaths(self, dest_dir, paths, index=None, workers=None,
+                     tracker=None):
+        """ Extract the given paths of directoryIndex() to dest_dir.
+        Files are taken in the order of their extents, so the image is read
+        front to back. Files of config.extract_large_file_size or more are
+        copied one after the other by a dedicated thread. The others are
+        spread over 'workers' threads (config.extract_workers by default).
+        With a single worker everything is copied in one sweep.
+        Bytes copied are pushed to tracker, progress.current() by default.
+        Return 0 means success otherwise failure.
+        """
+        if index == None:
+            index = self.directoryIndex()
+        if index == None:
+            return E_FAILURE
+        if workers == None:
+            workers = config.extract_workers
+        if tracker == None:
+            tracker = progress.current()
+        files = []
+        for path in paths:
+            loc, length, flags, mtime = index[path]
+            target = os.path.join(dest_dir, *path.split('/'))
+            if flags & 0x02:
+                if not os.path.isdir(target):
+                    os.makedirs(target)
+                continue
+            dirname = os.path.dirname(target)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            files.append((loc, length, path, target))
+        large_files = []
+        small_files = []
+        for loc, length, path, target in sorted(files):
+            item = (path, target, self.multiExtents.get(path, [(loc, length)]))
+            if workers > 1 and length >= config.extract_large_file_size:
+                large_files.append(item)
             else:
-                length = length - r_size
+                small_files.append(item)
+
+        if workers <= 1:
+            self.__extractFiles__(small_files, tracker, threading.Event())
+            return E_SUCCESS
 
-            buf = self.isoFile.read(r_size)
-            f_output.write(buf)
-            f_output.flush()
-        # while True end.
-        f_output.close()
+        jobs = queue.Queue()
+        for item in small_files:
+            jobs.put(item)
+        errors = []
+        abort = threading.Event()
+
+        def run(items):
+            try:
+                self.__extractFiles__(items, tracker, abort)
+            except Exception as e:
+                errors.append(e)
+                # Make the other threads give up too.
+                abort.set()
+
+        threads = [threading.Thread(target=run, args=(large_files,),
+                                    name='extract_large')]
+        threads += [threading.Thread(target=run, args=(QueueIter(jobs),),
+                                     name='extract_%d' % i)
+                    for i in range(workers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
         return E_SUCCESS
 
+    def __extractFiles__(self, items, tracker, abort):
+        """ Extract [(path, target, extents), ...] using a private iso
+        handle and buffer, so that several threads can do it at once.
+        """
+        buf = memoryview(bytearray(COPY_BUFFER_SIZE))
+        with open(self.isoPath, 'rb') as f_input:
+            for path, target, extents in items:
+                if abort.is_set():
+                    return
+                tracker.set_text('Extracting ' + path)
+                with open(target, 'wb', 0) as f_output:
+                    self.copyExtents(f_output, extents, f_input, buf,
+                                     tracker.add)
+
     def readDir(self, dir_path, r=True):
         file_list = []
         d = self.searchDir(dir_path)
@@ -644,6 +955,183 @@ class ISO9660:
         return True
 
 ###########################################################################
+def record_time(record):
+    """ Return the recording time of a directory record as seconds since
+    the epoch, 0 if it isn't set.
+    """
+    year, month, day, hour, minute, second, gmt_offset = \
+        struct.unpack_from('<6Bb', record, 18)
+    if month == 0 or day == 0:
+        return 0
+    try:
+        # Offset from GMT is counted in 15 minutes intervals.
+        return calendar.timegm((1900 + year, month, day, hour, minute,
+                                second)) - gmt_offset * 15 * 60
+    except (ValueError, OverflowError):
+        return 0
+
+
+class QueueIter:
+    """ Iterate over a queue until it is empty. """
+    def __init__(self, q):
+        self.q = q
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return self.q.get_nowait()
+        except queue.Empty:
+            raise StopIteration
+
+
+def _fallocate():
+    """ fallocate() of the C library, None where there is none. """
+    global _fallocate_func
+    if _fallocate_func is None:
+        _fallocate_func = False
+        if sys.platform.startswith('linux'):
+            try:
+                libc = CDLL(None, use_errno=True)
+                func = getattr(libc, 'fallocate64', None) or libc.fallocate
+            except (OSError, AttributeError):
+                return None
+            func.argtypes = [c_int, c_int, c_int64, c_int64]
+            func.restype = c_int
+            _fallocate_func = func
+    return _fallocate_func or None
+
+
+def preallocate(fd, length):
+    """ Reserve disk space for a file about to be written, so that it is
+    laid out in one go instead of growing chunk by chunk.
+    fallocate() is called with FALLOC_FL_KEEP_SIZE rather than
+    posix_fallocate(), which glibc emulates by writing zeros over the whole
+    length where the file system has no fallocate() support (exFAT, vfat
+    before Linux 4.19). There, fallocate() fails and nothing is reserved.
+    """
+    if length == 0:
+        return
+    fallocate = _fallocate()
+    if fallocate is None:
+        return
+    if fallocate(fd, FALLOC_FL_KEEP_SIZE, 0, length) != 0:
+        err = get_errno()
+        if err not in _COPY_FALLBACK_ERRNOS:
+            raise OSError(err, os.strerror(err))
+
+
+def copy_range(f_input, in_offset, length, f_output, out_offset, buf,
+               progress=None):
+    """ Copy length bytes at in_offset of f_input to out_offset of the
+    unbuffered file f_output.
+    copy_file_range() is tried first, then sendfile(). Whatever they
+    leave is copied through buf, a memoryview reused across calls.
+    progress(nbytes) is called after each step, if given.
+    """
+    if progress == None:
+        progress = lambda n: None
+    in_fd = f_input.fileno()
+    out_fd = f_output.fileno()
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                n = os.copy_file_range(in_fd, out_fd,
+                                       min(COPY_STEP_SIZE, length - copied),
+                                       in_offset + copied,
+                                       out_offset + copied)
+                if n == 0:
+                    break
+                copied += n
+                progress(n)
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+    if copied < length and hasattr(os, 'sendfile'):
+        os.lseek(out_fd, out_offset + copied, os.SEEK_SET)
+        try:
+            while copied < length:
+                n = os.sendfile(out_fd, in_fd, in_offset + copied,
+                                min(COPY_STEP_SIZE, length - copied))
+                if n == 0:
+                    break
+                copied += n
+                progress(n)
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+    if copied < length:
+        f_input.seek(in_offset + copied)
+        f_output.seek(out_offset + copied)
+        while copied < length:
+            n = f_input.readinto(buf[:min(len(buf), length - copied)])
+            if not n:
+                raise IOError(errno.EIO, "Unexpected end of image")
+            view = buf[:n]
+            while view:
+                view = view[f_output.write(view):]
+            copied += n
+            progress(n)
+
+
+def extract_iso9660(isofile, dest_dir):
+    """ Extract a plain ISO9660 image natively.
+    Return False if the image isn't one iso9660_index() accepts or if
+    extraction failed, so that the caller can fall back on 7-Zip.
+    """
+    iso9660fs = open_iso9660(isofile)
+    if iso9660fs == None:
+        return False
+    try:
+        return iso9660fs.extractAll(dest_dir) == E_SUCCESS
+    except (IOError, OSError) as e:
+        gen.log("Native extraction of %s failed: %s" % (isofile, e))
+        return False
+
+
+def is_iso9660(isofile):
+    """ Check if a file starts with an ISO9660 volume descriptor. """
+    try:
+        with open(isofile, 'rb') as f:
+            f.seek(16 * 2048 + 1)
+            return f.read(5) == b'CD001'
+    except (IOError, OSError):
+        return False
+
+
+def open_iso9660(isofile):
+    """ Return an ISO9660 instance for a plain ISO9660 image.
+    Return None if the image is not ISO9660 or also carries an UDF file
+    system, which is what 7-Zip would present instead.
+    """
+    if not is_iso9660(isofile):
+        return None
+    try:
+        iso9660fs = ISO9660(isofile)
+        if iso9660fs.priVol == None or iso9660fs.hasUDF():
+            return None
+        return iso9660fs
+    except Exception as e:
+        gen.log("Could not read %s natively: %s" % (isofile, e))
+        return None
+
+
+def iso9660_index(isofile):
+    """ Return directoryIndex() of a plain ISO9660 image, None if
+    open_iso9660() doesn't accept it.
+    """
+    iso9660fs = open_iso9660(isofile)
+    if iso9660fs == None:
+        return None
+    try:
+        return iso9660fs.directoryIndex()
+    except Exception as e:
+        gen.log("Could not index %s natively: %s" % (isofile, e))
+        return None
+
+
 def dump_dir_record(dirs):
     """ Dump all the file directory records contained in desc_buf """
 
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     manifest.py
+# Purpose:  Module to record what the installation of a distro created on the USB disk and remove exactly that on uninstall
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import collections
+import concurrent.futures
+import os
+import time
+
+from . import config
+from . import gen
+
+MANIFEST_NAME = 'install_manifest.cfg'
+# Files unlinked by a task of the removal thread pool.
+UNLINK_BATCH = 64
+
+
+class Manifest:
+    """
+    Topmost files and directories created by the installation of a distro,
+    relative to the mount point of the USB disk. Saved in the install
+    directory as one 'd <path>' or 'f <path>' line per entry, paths being
+    '/' separated. Directories are removed with everything below them.
+    The files written from the ISO are listed as well, with the size and
+    modification time they have in the ISO, as 'i <size> <mtime> <path>'
+    lines. Updates compare them against a newer ISO.
+    """
+
+    def __init__(self, usb_mount, install_dir):
+        self.usb_mount = usb_mount
+        self.path = os.path.join(install_dir, MANIFEST_NAME)
+        self.entries = collections.OrderedDict()
+        self.files = collections.OrderedDict()
+        for kind, rel, size, mtime in _read(install_dir) or []:
+            if kind == 'i':
+                self.files[rel] = (size, mtime)
+            else:
+                self.entries[rel] = kind == 'd'
+
+    def relpath(self, path):
+        return os.path.relpath(path, self.usb_mount).replace(os.sep, '/')
+
+
+    def covers(self, path):
+        """
+        :return: True if path is an entry or is below a directory entry
+        """
+        rel = self.relpath(path)
+        while rel:
+            if rel in self.entries:
+                return True
+            rel = rel.rpartition('/')[0]
+        return False
+
+    def add(self, path):
+        if not self.covers(path):
+            self.entries[self.relpath(path)] = os.path.isdir(path)
+
+    def new_paths(self, dest_dir, paths):
+        """
+        Find out, before extracting paths to dest_dir, the topmost ones the
+        extraction is going to create.
+        :param paths: '/' separated paths relative to dest_dir, parents first
+        :return: List of full paths
+        """
+        if self.covers(dest_dir):
+            return []
+        created = []
+        below_created = set()
+        for path in paths:
+            if path.rpartition('/')[0] in below_created:
+                below_created.add(path)
+                continue
+            full_path = os.path.join(dest_dir, *path.split('/'))
+            if not os.path.lexists(full_path):
+                created.append(full_path)
+                below_created.add(path)
+        return created
+
+    def add_file(self, path, size, mtime):
+        """
+        Remember that path was written from a file of the ISO of the given
+        size and modification time.
+        """
+        self.files[self.relpath(path)] = (size, int(mtime))
+
+    def move(self, src, dst):
+        """
+        Account for src having been renamed to dst.
+        """
+        src_rel = self.relpath(src)
+        dst_rel = self.relpath(dst)
+        for table in (self.entries, self.files):
+            items = list(table.items())
+            table.clear()
+            for rel, value in items:
+                if rel == src_rel or rel.startswith(src_rel + '/'):
+                    rel = dst_rel + rel[len(src_rel):]
+                table[rel] = value
+        if os.path.dirname(self.path) == src:
+            self.path = os.path.join(dst, MANIFEST_NAME)
+
+    def prune(self, path):
+        """
+        Remove path and its parents as long as they are empty directories,
+        up to the topmost ones of the manifest, which are kept.
+        """
+        while self.covers(path) and self.relpath(path) not in self.entries:
+            try:
+                os.rmdir(path)
+            except OSError:
+                return
+            path = os.path.dirname(path)
+
+    def save(self):
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            for rel, is_dir in self.entries.items():
+                f.write(('d ' if is_dir else 'f ') + rel + '\n')
+            for rel, (size, mtime) in self.files.items():
+                f.write('i %d %d %s\n' % (size, mtime, rel))
+        os.replace(tmp_path, self.path)
+
+
+def _read(install_dir):
+    """
+    :return: List of (kind, relative path, size, mtime), None if there is no manifest
+    """
+    try:
+        with open(os.path.join(install_dir, MANIFEST_NAME), 'r') as f:
+            lines = f.read().splitlines()
+    except (IOError, OSError):
+        return None
+    records = []
+    for line in lines:
+        if line[:2] in ('d ', 'f '):
+            records.append((line[0], line[2:], None, None))
+        elif line[:2] == 'i ':
+            try:
+                size, mtime, rel = line[2:].split(' ', 2)
+                records.append(('i', rel, int(size), int(mtime)))
+            except ValueError:
+                pass
+    return records
+
+
+def load(install_dir):
+    """
+    :return: List of (relative path, True if a directory), None for a distro
+             installed without a manifest
+    """
+    records = _read(install_dir)
+    if records is None:
+        return None
+    return [(rel, kind == 'd') for kind, rel, size, mtime in records
+            if kind != 'i']
+
+
+def _unlink(paths):
+    removed = 0
+    for path in paths:
+        try:
+            try:
+                os.unlink(path)
+            except PermissionError:
+                # Read only files such as ldlinux.sys on Windows.
+                os.chmod(path, 0o777)
+                os.unlink(path)
+            removed += 1
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            gen.log('Could not remove %s: %s' % (path, e))
+    return removed
+
+
+def _scan(path, files, dirs):
+    """
+    List the files and directories below path, directories before what
+    they contain, without a stat per entry.
+    """
+    stack = [path]
+    while stack:
+        dir_path = stack.pop()
+        with os.scandir(dir_path) as it:
+            dirs.append(dir_path)
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    files.append(entry.path)
+
+
+def remove(usb_mount, entries, workers=None):
+    """
+    Remove the entries of a manifest. Directories are listed with scandir,
+    then their files are unlinked by a thread pool and the directories
+    removed deepest first.
+    :param entries: List from load()
+    :param workers: Threads unlinking files, config.uninstall_workers by default
+    :return: Number of files removed
+    """
+    start = time.time()
+    files = []
+    dirs = []
+    for rel, is_dir in entries:
+        path = os.path.join(usb_mount, *rel.split('/'))
+        if not is_dir:
+            files.append(path)
+            continue
+        try:
+            _scan(path, files, dirs)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            gen.log('Could not list %s: %s' % (path, e))
+    batches = [files[i:i + UNLINK_BATCH]
+               for i in range(0, len(files), UNLINK_BATCH)]
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or config.uninstall_workers) as pool:
+        removed = sum(pool.map(_unlink, batches))
+    for path in reversed(dirs):
+        try:
+            os.rmdir(path)
+        except OSError as e:
+            gen.log('Could not remove %s: %s' % (path, e))
+    gen.log('Removed %d files and %d directories in %.2f seconds.'
+            % (removed, len(dirs), time.time() - start))
+    return removed
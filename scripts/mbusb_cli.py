@@ -6,17 +6,22 @@
 # Licence:  This file is a part of multibootusb package. You can redistribute it or modify
 # under the terms of GNU General Public License, v.2 or above
 
+import concurrent.futures
 import os
 import ctypes
 import platform
+import shutil
+from . import bootmenu
 from . import usb
 from . import gen
+from . import _7zip
 from .iso import *
 from .uninstall_distro import *
 from .distro import *
 from .syslinux import *
 from .install import *
 from . import imager
+from . import progress
 from . import syslinux
 
 
@@ -66,32 +71,103 @@ def cli_install_distro():
         # Get the GPT status of the disk and store it on a variable
         usb.gpt_device(config.usb_disk)
         prepare_mbusb_host_dir()
-        if isinstance(config.image_path, str) is True:
+        if config.update_from:
+            iso_update(config.image_path, config.update_from)
+        elif isinstance(config.image_path, str) is True:
             iso_install(config.image_path)
         elif isinstance(config.image_path, list) is True:
-            # Transfer the list to other variable and loop through iso image
-            iso_list = config.image_path
-            for config.image_path in iso_list:
-                iso_install(config.image_path)
+            iso_install_batch(config.image_path)
 
 
-def iso_install(iso_image):
+def stage_iso(iso_image, staging_dir):
+    """
+    Detect the distro of an ISO of a batch ahead of its turn, extracting
+    its files to a staging directory of its own. Its progress and 7z runs
+    are kept apart from the ones of the install going on, see
+    progress.background().
+    :return: Tuple of the detected distro name, None if the ISO is not to be installed, and the reason why not
+    """
+    with progress.background():
+        if already_installed(iso_image):
+            return None, "'%s' is already installed. Skipping installation." \
+                % iso.iso_basename(iso_image)
+        _distro = detect_distro(iso_image, cfg_dir=staging_dir)
+        if _distro is None:
+            return None, 'Sorry %s is not supported at the moment.' % \
+                iso_name(iso_image)
+        return _distro, None
+
+
+def iso_install_batch(iso_list):
+    """
+    Install several ISOs one after the other. The next ISOs are detected in a
+    background worker while the current one is being installed, and the
+    syslinux.cfg and grub.cfg menus are updated at the end, also for the
+    ISOs installed before one failed.
+    :param iso_list: List of paths to ISO images
+    :return:
+    """
+    installed = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as worker:
+            staged = [worker.submit(stage_iso, iso_image,
+                                    iso_cfg_staging_dir(i))
+                      for i, iso_image in enumerate(iso_list)]
+            try:
+                for i, iso_image in enumerate(iso_list):
+                    config.image_path = iso_image
+                    try:
+                        _distro, reason = staged[i].result()
+                    except Exception as e:
+                        log('Could not detect the distro of %s: %s' %
+                            (iso_image, e))
+                        continue
+                    if _distro is None:
+                        log(reason)
+                        continue
+                    activate_iso_cfg_staging_dir(iso_cfg_staging_dir(i))
+                    if iso_install(iso_image, _distro, menus=False):
+                        installed.append((iso_image, config.distro,
+                                          config.syslinux_version))
+            finally:
+                # No need to detect the rest after a failed install.
+                for future in staged:
+                    future.cancel()
+    finally:
+        shutil.rmtree(os.path.join(multibootusb_host_dir(), 'iso_cfg_staging'),
+                      ignore_errors=True)
+
+        # The menus get written once, whatever the number of ISOs.
+        with bootmenu.transaction():
+            for config.image_path, config.distro, config.syslinux_version \
+                    in installed:
+                log('Adding %s to the boot menus...'
+                    % iso.iso_basename(config.image_path))
+                update_menus(config.image_path, config.usb_disk, config.distro)
+
+
+def already_installed(iso_image):
+    return os.path.exists(os.path.join(config.usb_mount, 'multibootusb',
+                                       iso.iso_basename(iso_image)))
+
+
+def iso_install(iso_image, _distro=None, menus=True):
     """
     Script for installing iso image to a disk. This can be called by other script for auto install of many distros
     :param iso_image: Path to ISO image
-    :return:
+    :param _distro: Distro of the ISO if already detected
+    :param menus: Update the boot menus, see update_distro_cfg_files()
+    :return: True if the ISO got installed
     """
-    if os.path.exists(os.path.join(config.usb_mount, 'multibootusb',
-                                   iso.iso_basename(iso_image))):
+    _7zip.reset_spawn_count()
+    if already_installed(iso_image):
         log("'%s' is already installed. Skipping installation." %
             iso.iso_basename(iso_image))
     elif size_not_enough(iso_image, config.usb_disk) is True:
         log(config.usb_disk + ' does not have enough space...')
     else:
-        clean_iso_cfg_ext_dir( # Need to be cleaned everytime
-            os.path.join(multibootusb_host_dir(), "iso_cfg_ext_dir"))
-        extract_cfg_file(iso_image)
-        _distro = distro(iso_cfg_ext_dir(), iso_image)
+        if _distro is None:
+            _distro = detect_distro(iso_image)
         if _distro is not None:
             log('Initiating installation process for ' +
                  iso.iso_basename(iso_image))
@@ -103,7 +179,7 @@ def iso_install(iso_image):
                 log('Y/y/Yes/yes/YES or N/n/No/no/NO')
                 if read_input_yes() is not True:
                     log('Not proceeding. User cancelled the operation.')
-                    return
+                    return False
             else:
                 log('Skipping user confirmation for ' + iso_image)
             config.distro = _distro
@@ -113,14 +189,56 @@ def iso_install(iso_image):
             syslinux_default(config.usb_disk)
             replace_grub_binary()
             update_distro_cfg_files(iso_image, config.usb_disk, _distro,
-                                    config.persistence)
+                                    config.persistence, menus=menus)
             log('Finished installing ' + iso.iso_basename(iso_image))
+            log('7z was run %d time(s) during the installation.'
+                % _7zip.spawn_count)
+            return True
         else:
             log('\n\nSorry ' + iso_name(iso_image) +
                  ' is not supported at the moment.\n'
                 'Please report an issue at '
                 'https://github.com/mbusb/multibootusb/issues\n')
 
+def iso_update(iso_image, installed_name):
+    """
+    Update an installed distro to a newer release of it, writing only the
+    files that changed, see update_distro().
+    :param iso_image: Path to the ISO of the newer release
+    :param installed_name: Name the distro is installed under
+    :return: True if the distro got updated
+    """
+    if not os.path.exists(os.path.join(config.usb_mount, 'multibootusb',
+                                       installed_name)):
+        log("'%s' is not installed on %s." % (installed_name, config.usb_disk))
+        return False
+    _distro = detect_distro(iso_image)
+    if _distro is None:
+        log('\n\nSorry ' + iso_name(iso_image) +
+            ' is not supported at the moment.')
+        return False
+    log('Updating %s to %s' % (installed_name, iso_name(iso_image)))
+    if config.yes is not True:
+        log('Please confirm the option.')
+        log('Y/y/Yes/yes/YES or N/n/No/no/NO')
+        if read_input_yes() is not True:
+            log('Not proceeding. User cancelled the operation.')
+            return False
+    config.distro = _distro
+    cfg_files = update_distro(installed_name)
+    if cfg_files is None:
+        return False
+    syslinux_distro_dir(config.usb_disk, iso_image, _distro)
+    update_distro_cfg_files(iso_image, config.usb_disk, _distro,
+                            config.persistence, menus=False, only=cfg_files)
+    with bootmenu.transaction():
+        update_sys_cfg_file(installed_name)
+        update_grub_cfg_file(installed_name)
+        update_menus(iso_image, config.usb_disk, _distro)
+    log('Finished updating ' + iso.iso_basename(iso_image))
+    return True
+
+
 def cli_uninstall_distro():
     distro_list = install_distro_list()
     if distro_list is not None:
@@ -141,10 +259,14 @@ def cli_dd():
     Function to write ISO image directly to USB disk using dd
     :return:
     """
+    usb_disks = config.usb_disk if type(config.usb_disk) is list else [config.usb_disk]
     if platform.system() == 'Linux':
-        if config.usb_disk[-1].isdigit() is True:
+        if any(d[-1].isdigit() for d in usb_disks):
             log('Selected USB is a disk partition. Please select the whole disk eg. \'/dev/sdb\'')
             sys.exit(2)
+    elif len(usb_disks) > 1:
+        log('Writing to several USB disks at once is only supported on Linux.')
+        sys.exit(2)
 
     if not os.path.exists(config.image_path):
         log('ISO image path does not exist. Please correct the path.')
@@ -153,12 +275,17 @@ def cli_dd():
         if config.yes is not True:
             log('Initiating destructive writing process for ' + iso.iso_basename(config.image_path))
             log('\nSelected ISO is          :' + quote(iso_name(config.image_path)))
-            log('Selected target device is  :' + quote(config.usb_disk))
-            log('Writing ISO directly to target USB disk ' + quote(config.usb_disk) + ' will DESTROY ALL DATA.' + '\n')
+            log('Selected target device is  :' + ', '.join(quote(d) for d in usb_disks))
+            log('Writing ISO directly to target USB disk ' + ', '.join(quote(d) for d in usb_disks) +
+                ' will DESTROY ALL DATA.' + '\n')
             log('Please confirm the option.')
             log('Y/y/Yes/yes/YES or N/n/No/no/NO')
             if read_input_yes() is True:
-                if platform.system() == 'Linux':
+                if len(usb_disks) > 1:
+                    errors = imager.dd_iso_images(usb_disks)
+                    if any(errors.values()):
+                        sys.exit(1)
+                elif platform.system() == 'Linux':
                         imager.dd_linux()
                 else:
                     imager.dd_win()
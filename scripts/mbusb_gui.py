@@ -25,6 +25,7 @@ from scripts.gui.ui_about import Ui_About
 from . import usb
 from .gen import *
 from .install import *
+from . import bootmenu
 from . import uninstall_distro
 from .syslinux import *
 from .distro import *
@@ -33,6 +34,7 @@ from .iso import *
 # from .imager import *
 from .imager import Imager, dd_iso_image
 from . import persistence
+from . import progress
 from . import config
 from . import admin
 from . import qemu
@@ -262,11 +264,8 @@ class AppGui(qemu.Qemu, Imager, QtWidgets.QMainWindow, Ui_MainWindow):
 
             # Detect supported distro
             try:
-                clean_iso_cfg_ext_dir(     # Need to be cleaned.
-                    os.path.join(multibootusb_host_dir(), "iso_cfg_ext_dir"))
-                extract_cfg_file(config.image_path)
-                config.distro = distro(iso_cfg_ext_dir(), config.image_path,
-                                       expose_exception=True)
+                config.distro = detect_distro(
+                    config.image_path, expose_exception=True)
             except Exception as exc:
                 QtWidgets.QMessageBox.critical(
                     self,
@@ -555,8 +554,9 @@ class AppGui(qemu.Qemu, Imager, QtWidgets.QMainWindow, Ui_MainWindow):
                                      config.uninstall_distro_dir_name)):
                     log("Distro install directory not found. "
                         "Just updating syslinux.cfg and grub.cfg.")
-                    uninstall_distro.update_sys_cfg_file(config.uninstall_distro_dir_name)
-                    uninstall_distro.update_grub_cfg_file(config.uninstall_distro_dir_name)
+                    with bootmenu.transaction():
+                        uninstall_distro.update_sys_cfg_file(config.uninstall_distro_dir_name)
+                        uninstall_distro.update_grub_cfg_file(config.uninstall_distro_dir_name)
                     self.uninstall_sys_file_update()
                     # self.uninstall.update_sys_cfg_file()
                     self.ui_enable_controls()
@@ -915,7 +915,8 @@ class GuiInstallProgress(QtCore.QThread):
             if not self.thread.isFinished() and config.percentage == 100:
                 config.status_text = "Status: Please wait..."
                 self.status.emit("Status: Please wait...")
-            time.sleep(0.1)
+            # Wakes up as soon as the engines report progress.
+            progress.tracker.wait(0.1)
 
         self.update.emit(100)
         self.update.emit(0)
@@ -11,6 +11,10 @@ import sys
 import tempfile
 import time
 
+from . import checksum
+from . import config
+from . import rawwrite
+
 if platform.system() == 'Windows':
     import wmi
     from scripts import win32
@@ -267,17 +271,51 @@ class Base:
             }
         self.add_dd_iso_image_popen_args(kw_args)
         self.dd_iso_image_prepare(input, output, status_update)
-        log('Executing => ' + str(cmd))
-        dd_process = subprocess.Popen(cmd, **kw_args)
-        output_q = queue.Queue()
-        while dd_process.poll() is None:
-            self.dd_iso_image_readoutput(dd_process, gui_update, in_file_size,
-                                         output_q)
-        output_lines = [output_q.get() for i in range(output_q.qsize())]
-        for l in output_lines:
-            log('dd: ' + l)
-        return self.dd_iso_image_interpret_result(
-            dd_process.returncode, output_lines)
+        read_backs = []
+        if config.verify:
+            # Hash the image alongside dd, which has it in the page cache,
+            # and read back what dd reports written.
+            source = checksum.ReadBack(input_, direct=False)
+            source.advance(in_file_size)
+            target = checksum.ReadBack(self.physical_disk(output))
+            read_backs = [source, target]
+            dd_update = gui_update
+
+            def gui_update(percentage):
+                # Stay a block behind in case of rounding.
+                target.advance(int(percentage * in_file_size / 100.) - 1024 * 1024)
+                dd_update(percentage)
+        try:
+            log('Executing => ' + str(cmd))
+            start = time.time()
+            dd_process = subprocess.Popen(cmd, **kw_args)
+            output_q = queue.Queue()
+            while dd_process.poll() is None:
+                self.dd_iso_image_readoutput(dd_process, gui_update,
+                                             in_file_size, output_q)
+            output_lines = [output_q.get() for i in range(output_q.qsize())]
+            for l in output_lines:
+                log('dd: ' + l)
+            error = self.dd_iso_image_interpret_result(
+                dd_process.returncode, output_lines)
+            if not error:
+                log('dd wrote %s at %.1f MB/s' % (
+                    input_, in_file_size / (1024 * 1024) /
+                    max(time.time() - start, 1e-6)))
+            if config.verify and not error:
+                # copier imports gen, which imports this module.
+                from . import copier
+                status_update('Verifying...')
+                digest = source.finish(in_file_size)
+                verified = target.finish(in_file_size) == digest
+                message = copier.log_verification(output, digest, verified)
+                if not verified:
+                    error = message
+        finally:
+            # Left reading when dd failed, a no-op once finished.
+            for read_back in read_backs:
+                read_back.cancel()
+        return error
 
 class Windows(Base):
 
@@ -289,6 +327,8 @@ class Windows(Base):
 
     def dd_iso_image(self, input_, output, gui_update, status_update):
         assert type(output) is int
+        if config.verify:
+            log('Verification of raw writes is not supported on Windows.')
         status_update('Zapping PhyiscalDisk%d' % output)
         win32.ZapPhysicalDrive(output, wmi_get_volume_info_on, log)
         # Ouch. Needs sometime for the zapping to take effect...
@@ -349,6 +389,40 @@ class Linux(Base):
     def __init__(self):
         self.dd_exe = 'dd'
 
+    def dd_iso_image(self, input_, output, gui_update, status_update):
+        if config.dd_engine != 'native':
+            return Base.dd_iso_image(self, input_, output, gui_update,
+                                     status_update)
+        in_file_size = os.path.getsize(input_)
+        disk = self.physical_disk(output)
+        written = [0]
+
+        def on_progress(nbytes):
+            written[0] += nbytes
+            gui_update(written[0] / in_file_size * 100.)
+
+        status_update('Writing to ' + disk)
+        log('Writing %s to %s in-process, %d bytes per block' %
+            (input_, disk, config.dd_block_size))
+        try:
+            result = rawwrite.write_image(input_, disk, progress=on_progress)
+        except (IOError, OSError) as e:
+            log('Error writing %s to %s: %s' % (input_, disk, e))
+            return str(e)
+        log('Wrote %s at %.1f MB/s' % (input_, result.throughput))
+        if config.dd_discard_first and result.skipped is None:
+            log('Could not discard %s, every block was written.' % disk)
+        elif config.dd_discard_first:
+            log('Skipped %d bytes of zeros out of %d.' %
+                (result.skipped, in_file_size))
+        if result.verified is not None:
+            from . import copier
+            message = copier.log_verification(disk, result.digest,
+                                              result.verified)
+            if not result.verified:
+                return message
+        return None
+
     def dd_iso_image_prepare(self, input, output, status_update):
         pass
 
@@ -75,19 +75,22 @@ def contains_all_tokens(*tokens):
 def contains_any_token(*tokens):
     return lambda starter, params: any([t in params for t in tokens])
 
+def _has_key(params, key):
+    if isinstance(params, ParamList):
+        return params.has_key(key)
+    return any(p.startswith(key) for p in params)
+
 def contains_key(key):
     assert type(key)==str
     assert key[-1:] == '='
-    return lambda starter, params: any(x.startswith(key) for x in params)
+    return lambda starter, params: _has_key(params, key)
 
 def contains_all_keys(*keys):
     assert all([k.endswith('=') for k in keys])
-    return lambda starter, params: all(any(p.startswith(k) for p in params)
-                              for k in keys)
+    return lambda starter, params: all(_has_key(params, k) for k in keys)
 
 def contains_any_key(*keys):
-    return lambda starter, params: any(any(p.startswith(k) for p in params)
-                              for k in keys)
+    return lambda starter, params: any(_has_key(params, k) for k in keys)
 
 def starter_is_either(*possible_starters):
     return lambda starter, params: starter in possible_starters
@@ -96,6 +99,177 @@ def _not(another_predicate):
     return lambda starter, params: not another_predicate(starter, params)
 
 
+# Batch application
+
+def key_of(token):
+    """ Return what precedes the first '=' of token, '=' included, None
+    if token has no '='.
+    """
+    key, equal, value = token.partition('=')
+    return key + equal if equal else None
+
+class ParamList:
+    """ Params of a boot line indexed by token and by key, so that the
+    operations above apply in place without a pass over all params per
+    operation. Removed params leave a None in 'tokens' until joined.
+    Iterating yields the params like the list the operations work on.
+    """
+
+    def __init__(self, params):
+        self.tokens = list(params)
+        self.positions = positions = {}
+        self.keys = keys = {}
+        for i, token in enumerate(self.tokens):
+            positions.setdefault(token, []).append(i)
+            key, equal, value = token.partition('=')
+            if equal:
+                keys.setdefault(key + equal, []).append(i)
+
+    def __contains__(self, token):
+        return bool(self.positions.get(token))
+
+    def __iter__(self):
+        return (t for t in self.tokens if t is not None)
+
+    def list(self):
+        return list(self)
+
+    def join(self, separator=' '):
+        return separator.join(self)
+
+    def _index(self, i, token):
+        self.positions.setdefault(token, []).append(i)
+        key = key_of(token)
+        if key:
+            self.keys.setdefault(key, []).append(i)
+
+    def _unindex(self, i, token):
+        self.positions[token].remove(i)
+        key = key_of(token)
+        if key:
+            self.keys[key].remove(i)
+
+    def append(self, token):
+        self._index(len(self.tokens), token)
+        self.tokens.append(token)
+
+    def remove_at(self, i):
+        self._unindex(i, self.tokens[i])
+        self.tokens[i] = None
+
+    def set_at(self, i, token):
+        self._unindex(i, self.tokens[i])
+        self.tokens[i] = token
+        self._index(i, token)
+
+    def find_key(self, key):
+        """ Return the positions of the params starting with key. """
+        first_key = key_of(key)
+        if first_key is None:
+            return [i for i, t in enumerate(self.tokens)
+                    if t is not None and t.startswith(key)]
+        # 'root=UUID=' is found among the params keyed 'root='.
+        return sorted(i for i in self.keys.get(first_key, [])
+                      if self.tokens[i].startswith(key))
+
+    def has_key(self, key):
+        return bool(self.find_key(key))
+
+    def move_to_end(self, token):
+        """ Move the first occurrence of token to the end. """
+        positions = self.positions.get(token)
+        if positions:
+            self.remove_at(min(positions))
+            self.append(token)
+
+    # Counterparts of the op_* functions.
+
+    def add_tokens(self, tokens):
+        for t in [t for t in tokens if t not in self]:
+            self.append(t)
+
+    def remove_tokens(self, tokens):
+        for t in tokens:
+            for i in list(self.positions.get(t, [])):
+                self.remove_at(i)
+
+    def replace_token(self, old_token, new_token):
+        for i in list(self.positions.get(old_token, [])):
+            self.set_at(i, new_token)
+
+    def add_or_replace_kv(self, key, value):
+        if self.has_key(key):
+            return self.replace_kv(key, value)
+        self.append(key + (value(key, None, self.list())
+                           if callable(value) else value))
+
+    def replace_kv(self, key, value):
+        positions = self.find_key(key)
+        params = self.list() if callable(value) and positions else None
+        for i in positions:
+            self.set_at(i, key + (value(key, self.tokens[i][len(key):], params)
+                                  if callable(value) else value))
+
+    def remove_keys(self, keys):
+        for key in keys:
+            for i in self.find_key(key):
+                self.remove_at(i)
+
+BATCH_OPERATIONS = {
+    op_add_tokens: ParamList.add_tokens,
+    op_remove_tokens: ParamList.remove_tokens,
+    op_replace_token: ParamList.replace_token,
+    op_add_or_replace_kv: ParamList.add_or_replace_kv,
+    op_replace_kv: ParamList.replace_kv,
+    op_remove_keys: ParamList.remove_keys,
+}
+
+def apply_operation(op, params):
+    """ Apply op to the ParamList params in place. op is one of the
+    operations above or any callable taking and returning a list of params.
+    """
+    method = BATCH_OPERATIONS.get(getattr(op, 'func', None))
+    if method and not op.keywords:
+        method(params, *op.args)
+        return params
+    return ParamList(op(params.list()))
+
+def rewrite_param_lines(content, line_pattern, operations_for):
+    """ Rewrite the params of every boot line of content in one pass.
+    :param line_pattern: Compiled pattern of a boot line, grouping the
+                         part up to the params, the starter and the params.
+    :param operations_for: Called with the starter and the ParamList of a
+                           line, returns the list of (operation or list of
+                           operations, precondition) to apply to the line.
+    :return: The rewritten content
+    """
+    chunks = []
+    pos = 0
+    for m in line_pattern.finditer(content):
+        start, end = m.span()
+        starter_part, starter_token, params_part = m.group(1, 2, 3)
+        params = ParamList(params_part.split(' '))
+        for op_or_op_list, precondition in operations_for(starter_token,
+                                                          params):
+            if not precondition(starter_token, params):
+                continue
+            try:
+                iter(op_or_op_list)
+                op_list = op_or_op_list
+            except TypeError:
+                op_list = [op_or_op_list]
+            for op in op_list:
+                params = apply_operation(op, params)
+
+        # I see something special about this param. Place it at the end.
+        params.move_to_end('---')
+
+        chunks += [content[pos:start], starter_part, params.join()]
+        pos = end
+    chunks.append(content[pos:])
+    return ''.join(chunks)
+
+
 def test_rewrite_machinary():
 
     def transform(op_or_oplist, predicate, input_line):
@@ -231,3 +405,36 @@ def test_rewrite_machinary():
                      _not(contains_all_keys('bar=', 'key2=')),
                      boot_line)=="kernel /boot/vmlinuz bar=baz foo bar" \
                      " key2=value2"
+
+
+def test_batch_operations():
+    import re
+
+    boot_line = "kernel /boot/vmlinuz bar=baz foo bar key2=value2 --- foo"
+    for op_list in [
+            [add_tokens('foo', 'more'), remove_tokens('bar')],
+            [replace_token('foo', 'hum'), add_or_replace_kv('bar=', 'x')],
+            [add_or_replace_kv('root=UUID=', '1234'),
+             replace_kv('bar=', lambda k, old_v, params: '!' + old_v),
+             remove_keys('key2=')],
+            [remove_tokens('foo', 'kernel'), add_tokens('---', 'foo')],
+            [lambda params: params[::-1], add_tokens('tail')]]:
+        params = boot_line.split(' ')
+        batch = ParamList(params)
+        for op in op_list:
+            params = op(params)
+            batch = apply_operation(op, batch)
+        assert batch.join() == ' '.join(params)
+        assert batch.list() == params
+
+    print ('Test rewriting of more lines than the recursion limit')
+    line_pattern = re.compile(r'^(\s*(kernel|append|linux)\s*)(.*)$',
+                              flags=re.I | re.MULTILINE)
+    content = 'label x\n  append --- quiet root=/dev/sr0\n' * 5000
+    out = rewrite_param_lines(
+        content, line_pattern,
+        lambda starter, params: [
+            ([replace_kv('root=', 'UUID=1234'), add_tokens('ignore_bootid')],
+             contains_key('root='))])
+    assert out == 'label x\n  append quiet root=UUID=1234 ignore_bootid ---\n' \
+        * 5000
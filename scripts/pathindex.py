@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     pathindex.py
+# Purpose:  Module to answer whether files of an installed distro exist from an in-memory index instead of the USB disk
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import contextlib
+import os
+import platform
+import threading
+
+# File systems looking names up regardless of case.
+CASE_INSENSITIVE_FS = ('vfat', 'fat', 'fat16', 'fat32', 'msdos', 'exfat')
+
+_lock = threading.Lock()
+# PathIndex in use within indexed(), if any.
+_index = None
+
+
+def ignores_case(fs_type):
+    """
+    :param fs_type: File system type as in usb.details()['file_system']
+    :return: True if names on the file system are looked up regardless of case
+    """
+    return platform.system() == 'Windows' or \
+        (fs_type or '').lower() in CASE_INSENSITIVE_FS
+
+
+class PathIndex:
+    """
+    Relative paths of the files and directories below a root directory,
+    listed by one os.scandir() walk. Looking a path up costs no system call.
+    Paths below symbolic links are not indexed and left to os.path.exists().
+    """
+
+    def __init__(self, root, ignore_case=False):
+        self.root = os.path.normpath(root)
+        self.ignore_case = ignore_case
+        self.paths = set()
+        self.links = []
+        stack = ['']
+        while stack:
+            rel = stack.pop()
+            try:
+                it = os.scandir(os.path.join(self.root, rel))
+            except OSError:
+                continue
+            with it:
+                for entry in it:
+                    entry_rel = rel + '/' + entry.name if rel else entry.name
+                    self.paths.add(self.key(entry_rel))
+                    if entry.is_symlink():
+                        self.links.append(self.key(entry_rel) + '/')
+                    elif entry.is_dir():
+                        stack.append(entry_rel)
+
+    def key(self, rel):
+        return rel.lower() if self.ignore_case else rel
+
+    def lookup(self, path):
+        """
+        :param path: Full path
+        :return: True or False, None if path is not covered by the index
+        """
+        path = os.path.normpath(path)
+        if path == self.root:
+            return True
+        if not path.startswith(self.root.rstrip(os.sep) + os.sep):
+            return None
+        rel = self.key(path[len(self.root.rstrip(os.sep)) + 1:]
+                       .replace(os.sep, '/'))
+        if self.links and rel.startswith(tuple(self.links)):
+            return None
+        return rel in self.paths
+
+
+def exists(path):
+    """
+    Replacement of os.path.exists() for the files of a distro, answered by
+    the index of indexed() when path is below its root.
+    """
+    index = _index
+    if index is not None:
+        found = index.lookup(path)
+        if found is not None:
+            return found
+    return os.path.exists(path)
+
+
+@contextlib.contextmanager
+def indexed(root, ignore_case=False):
+    """
+    Answer exists() for the paths below root from a PathIndex within the
+    block, for all threads. Files created or removed below root within the
+    block are not seen, so keep it to stages that only rewrite files.
+    """
+    global _index
+    index = PathIndex(root, ignore_case)
+    with _lock:
+        saved, _index = _index, index
+    try:
+        yield index
+    finally:
+        with _lock:
+            _index = saved
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     progress.py
+# Purpose:  Module to account for the bytes written by long running operations such as installing a distro
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import contextlib
+import threading
+
+from . import config
+
+
+class Progress:
+    """
+    Byte counter of a long running operation. The expected total is set by
+    whoever plans the work with start(), the engines doing the work push the
+    bytes they write with add(). Consumers either subscribe() a callback or
+    wait() for changes.
+    Unless mirror is False, every change is mirrored to config.percentage
+    and config.status_text.
+    """
+
+    def __init__(self, mirror=True):
+        self.mirror = mirror
+        self.cond = threading.Condition()
+        self.total = 0
+        self.done = 0
+        self.text = ''
+        self.generation = 0
+        self.listeners = []
+
+    def start(self, total, text=''):
+        """
+        Begin accounting for an operation expected to write 'total' bytes.
+        """
+        with self.cond:
+            self.total = total
+            self.done = 0
+            self.text = text
+        self._changed()
+
+    def add(self, nbytes):
+        with self.cond:
+            self.done += nbytes
+        self._changed()
+
+    def set_text(self, text):
+        with self.cond:
+            self.text = text
+        self._changed()
+
+    def percentage(self):
+        with self.cond:
+            if not self.total:
+                return 0
+            return min(100, int(self.done * 100 // self.total))
+
+    def subscribe(self, callback):
+        """
+        Call callback(percentage, status_text) on every change.
+        """
+        self.listeners.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
+
+    def wait(self, timeout=None):
+        """
+        Wait for a change or for timeout seconds, whichever comes first.
+        :return: Tuple of (percentage, status_text)
+        """
+        with self.cond:
+            generation = self.generation
+            self.cond.wait_for(lambda: self.generation != generation, timeout)
+        return self.percentage(), self.text
+
+    def _changed(self):
+        percentage = self.percentage()
+        if self.mirror and self.total:
+            config.percentage = percentage
+        if self.mirror and self.text:
+            config.status_text = self.text
+        with self.cond:
+            self.generation += 1
+            self.cond.notify_all()
+        for callback in list(self.listeners):
+            callback(percentage, self.text)
+
+
+# Progress of the current installation.
+tracker = Progress()
+
+_local = threading.local()
+
+
+def current():
+    """
+    :return: Progress the calling thread reports to, tracker unless it runs in background()
+    """
+    return getattr(_local, 'progress', None) or tracker
+
+
+def in_background():
+    return getattr(_local, 'progress', None) is not None
+
+
+def private():
+    """
+    Progress for work that is not part of the byte count of the current
+    operation, such as extracting a few files to detect a distro.
+    :return: Progress mirrored to config like the one of the calling thread
+    """
+    return Progress(mirror=current().mirror)
+
+
+@contextlib.contextmanager
+def background():
+    """
+    Report what the calling thread does, such as staging the next ISO of a
+    batch, to a Progress of its own which is not mirrored to config, so
+    that it doesn't mix with the foreground operation.
+    """
+    _local.progress = Progress(mirror=False)
+    try:
+        yield _local.progress
+    finally:
+        _local.progress = None
@@ -0,0 +1,354 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     rawwrite.py
+# Purpose:  Module to write ISO images to USB disks in-process, as an alternative to dd
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import collections
+import errno
+import mmap
+import os
+import queue
+import stat
+import struct
+import threading
+import time
+
+from . import checksum
+from . import config
+
+# O_DIRECT writes must be aligned to the logical block size of the device.
+ALIGNMENT = 4096
+# Buffers in flight between the reader and the writer.
+QUEUE_DEPTH = 2
+# _IO(0x12, 127) from linux/fs.h
+BLKZEROOUT = 0x127f
+
+# Buffers shared by the writers of write_images().
+RING_SLOTS = 4
+
+WriteResult = collections.namedtuple('WriteResult',
+                                     ['throughput', 'digest', 'verified',
+                                      'skipped'])
+TargetResult = collections.namedtuple('TargetResult',
+                                      ['throughput', 'error', 'verified'])
+
+
+def _open_target(path):
+    """
+    :return: Tuple of (fd, True if opened with O_DIRECT)
+    """
+    flags = os.O_WRONLY
+    if hasattr(os, 'O_DIRECT'):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError as e:
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, flags), False
+
+
+def _set_direct(fd, enable):
+    import fcntl
+    fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fl = fl | os.O_DIRECT if enable else fl & ~os.O_DIRECT
+    fcntl.fcntl(fd, fcntl.F_SETFL, fl)
+
+
+def discard(fd, path, length):
+    """
+    Zero the first length bytes of a block device (BLKZEROOUT, which
+    unmaps the range where the device guarantees that unmapped blocks read
+    as zeros, and writes zeros otherwise) or empty a regular file, then
+    check that the start of the range reads back as zeros. BLKDISCARD is
+    not used, many devices return stale data after it. On a device without
+    write zeroes or unmap support, the kernel writes the whole range, so
+    this costs as much as writing the image.
+    :return: True if the range now reads as zeros, False if it could not be zeroed
+    """
+    try:
+        mode = os.fstat(fd).st_mode
+        probe_size = min(length, 1024 * 1024)
+        if stat.S_ISBLK(mode):
+            import fcntl
+            fcntl.ioctl(fd, BLKZEROOUT, struct.pack('QQ', 0, length))
+        elif stat.S_ISREG(mode):
+            size = os.fstat(fd).st_size
+            os.ftruncate(fd, 0)
+            os.ftruncate(fd, size)
+            # Past its end, a file reads as zeros once written over.
+            probe_size = min(probe_size, size)
+        else:
+            return False
+        zeros = checksum.new_hash()
+        zeros.update(bytes(probe_size))
+        return checksum.ReadBack(path).finish(probe_size) == zeros.hexdigest()
+    except (IOError, OSError):
+        return False
+
+
+def _is_zero(buf, n, zeros):
+    """
+    :param buf: Memoryview of an mmap buffer
+    :param zeros: Bytes of zeros as long as buf
+    :return: True if the first n bytes of buf are all zero
+    """
+    # Comparing bytes objects is a plain memcmp.
+    return buf.obj[:n] == (zeros if n == len(zeros) else zeros[:n])
+
+
+def _write_all(fd, buf, n, direct):
+    """
+    Write the first n bytes of buf to fd.
+    :return: True if fd is still in O_DIRECT mode
+    """
+    if direct and n % ALIGNMENT:
+        # The tail can't be written with O_DIRECT.
+        _set_direct(fd, False)
+        direct = False
+    view = buf[:n]
+    while view:
+        view = view[os.write(fd, view):]
+    return direct
+
+
+def _read_block(f_input, buf):
+    n = 0
+    while n < len(buf):
+        got = f_input.readinto(buf[n:])
+        if not got:
+            break
+        n += got
+    return n
+
+
+def _reader(f_input, free_q, full_q, src_hash, stop):
+    """
+    Fill buffers taken from free_q with the image and queue them on full_q.
+    None marks the end, an exception is queued in case of failure.
+    """
+    try:
+        while not stop.is_set():
+            buf = free_q.get()
+            n = _read_block(f_input, buf)
+            if n == 0:
+                break
+            if src_hash is not None:
+                src_hash.update(buf[:n])
+            full_q.put((buf, n))
+            if n < len(buf):
+                break
+        full_q.put(None)
+    except Exception as e:
+        full_q.put(e)
+
+
+def write_image(src, dst, block_size=None, progress=None, verify=None,
+                discard_first=None):
+    """
+    Write an image to a device (or file) block by block. A reader thread
+    fills page aligned buffers while the writer empties them, so reading
+    and writing overlap. The device is opened with O_DIRECT where supported,
+    so written data skips the page cache and progress follows what the
+    device has accepted. The device is fsync'ed at the end.
+    With discard_first, the range of the image is zeroed beforehand (see
+    discard()) and blocks of zeros are skipped instead of written.
+    :param src: Path to the image
+    :param dst: Path to the device
+    :param block_size: Bytes per write, config.dd_block_size by default
+    :param progress: Called with the number of bytes written or skipped
+    :param verify: Hash the image and read dst back, config.verify by default
+    :param discard_first: Discard and skip zeros, config.dd_discard_first by default
+    :return: WriteResult, skipped being None if zeros could not be skipped
+    """
+    block_size = block_size or config.dd_block_size
+    block_size += -block_size % ALIGNMENT
+    if verify is None:
+        verify = config.verify
+    if discard_first is None:
+        discard_first = config.dd_discard_first
+    length = os.path.getsize(src)
+    src_hash = checksum.new_hash() if verify else None
+    free_q = queue.Queue()
+    full_q = queue.Queue(QUEUE_DEPTH)
+    for _ in range(QUEUE_DEPTH + 1):
+        free_q.put(memoryview(mmap.mmap(-1, block_size)))
+    stop = threading.Event()
+    start = time.time()
+    with open(src, 'rb', 0) as f_input:
+        fd, direct = _open_target(dst)
+        zeros = None
+        if discard_first:
+            if discard(fd, dst, length + -length % ALIGNMENT):
+                zeros = bytes(block_size)
+                st = os.fstat(fd)
+                if stat.S_ISREG(st.st_mode) and st.st_size < length:
+                    # Seeking over trailing zeros doesn't extend a file.
+                    os.ftruncate(fd, length)
+        read_back = checksum.ReadBack(dst) if verify else None
+        reader = threading.Thread(target=_reader, name='rawwrite_reader',
+                                  args=(f_input, free_q, full_q, src_hash,
+                                        stop))
+        reader.start()
+        try:
+            written = 0
+            skipped = None if zeros is None else 0
+            while True:
+                item = full_q.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                buf, n = item
+                if zeros is not None and _is_zero(buf, n, zeros):
+                    os.lseek(fd, n, os.SEEK_CUR)
+                    skipped += n
+                else:
+                    direct = _write_all(fd, buf, n, direct)
+                written += n
+                free_q.put(buf)
+                if progress:
+                    progress(n)
+                if read_back and direct:
+                    read_back.advance(written)
+            os.fsync(fd)
+        except Exception:
+            # Otherwise left waiting for data, keeping dst open.
+            if read_back:
+                read_back.cancel()
+            raise
+        finally:
+            stop.set()
+            while reader.is_alive():
+                # Unblock the reader, whichever queue it waits on.
+                free_q.put(memoryview(mmap.mmap(-1, ALIGNMENT)))
+                try:
+                    full_q.get_nowait()
+                except queue.Empty:
+                    pass
+                reader.join(0.05)
+            os.close(fd)
+    throughput = length / (1024 * 1024) / max(time.time() - start, 1e-6)
+    if not verify:
+        return WriteResult(throughput, None, None, skipped)
+    digest = src_hash.hexdigest()
+    return WriteResult(throughput, digest, read_back.finish(length) == digest,
+                       skipped)
+
+
+def write_images(src, dsts, block_size=None, progress=None, verify=None,
+                 on_error=None):
+    """
+    Write an image to several devices at once. The image is read once into
+    a ring of RING_SLOTS shared buffers. Each device has a writer thread
+    going through the ring at its own pace. A slot is refilled once every
+    writer still running is done with it, so the slowest device sets the
+    pace. A failing device is dropped without stopping the others.
+    :param src: Path to the image
+    :param dsts: List of paths to the devices
+    :param block_size: Bytes per write, config.dd_block_size by default
+    :param progress: Called with the device and the number of bytes written to it
+    :param verify: Hash the image and read each device back, config.verify by default
+    :param on_error: Called with the device and the error when a device is dropped
+    :return: Tuple of (digest of the image or None, dict of device -> TargetResult)
+    """
+    block_size = block_size or config.dd_block_size
+    block_size += -block_size % ALIGNMENT
+    if verify is None:
+        verify = config.verify
+    ring = [memoryview(mmap.mmap(-1, block_size)) for _ in range(RING_SLOTS)]
+    cond = threading.Condition()
+    lengths = {}
+    produced = [0]
+    eof = [False]
+    consumed = dict((dst, 0) for dst in dsts)
+    active = set(dsts)
+    results = {}
+    read_digests = {}
+
+    def writer(dst):
+        start = time.time()
+        seq = written = 0
+        read_back = None
+        try:
+            fd, direct = _open_target(dst)
+            try:
+                read_back = checksum.ReadBack(dst) if verify else None
+                while True:
+                    with cond:
+                        cond.wait_for(lambda: produced[0] > seq or eof[0])
+                        if produced[0] <= seq:
+                            break
+                        n = lengths[seq]
+                    direct = _write_all(fd, ring[seq % RING_SLOTS], n, direct)
+                    written += n
+                    seq += 1
+                    with cond:
+                        consumed[dst] = seq
+                        cond.notify_all()
+                    if progress:
+                        progress(dst, n)
+                    if read_back and direct:
+                        read_back.advance(written)
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            if read_back:
+                read_digests[dst] = read_back.finish(written)
+            results[dst] = TargetResult(
+                written / (1024 * 1024) / max(time.time() - start, 1e-6),
+                None, None)
+        except (IOError, OSError) as e:
+            if read_back:
+                read_back.cancel()
+            results[dst] = TargetResult(0, e, None)
+            if on_error:
+                on_error(dst, e)
+        finally:
+            with cond:
+                active.discard(dst)
+                cond.notify_all()
+
+    threads = [threading.Thread(target=writer, args=(dst,),
+                                name='rawwrite_%d' % i)
+               for i, dst in enumerate(dsts)]
+    for t in threads:
+        t.start()
+    src_hash = checksum.new_hash() if verify else None
+    try:
+        with open(src, 'rb', 0) as f_input:
+            seq = 0
+            while True:
+                with cond:
+                    cond.wait_for(lambda: all(consumed[d] > seq - RING_SLOTS
+                                              for d in active))
+                    if not active:
+                        break
+                buf = ring[seq % RING_SLOTS]
+                n = _read_block(f_input, buf)
+                if n == 0:
+                    break
+                if src_hash is not None:
+                    src_hash.update(buf[:n])
+                with cond:
+                    lengths[seq] = n
+                    lengths.pop(seq - RING_SLOTS, None)
+                    produced[0] = seq + 1
+                    cond.notify_all()
+                seq += 1
+                if n < len(buf):
+                    break
+    finally:
+        with cond:
+            eof[0] = True
+            cond.notify_all()
+        for t in threads:
+            t.join()
+    if not verify:
+        return None, results
+    digest = src_hash.hexdigest()
+    for dst in read_digests:
+        results[dst] = results[dst]._replace(
+            verified=read_digests[dst] == digest)
+    return digest, results
@@ -293,11 +293,8 @@ def syslinux_distro_dir(usb_disk, iso_link, distro):
     if isolinux_bin_exist(iso_link) is False:
         log('Distro does not use isolinux for booting ISO.')
     else:
-        # iso_cfg_ext_dir = os.path.join(multibootusb_host_dir(), "iso_cfg_ext_dir")
-        _iso_cfg_ext_dir = iso_cfg_ext_dir()
-        isolinux_path = os.path.join(_iso_cfg_ext_dir, isolinux_bin_path(iso_link))
         iso_linux_bin_dir = isolinux_bin_dir(iso_link)
-        config.syslinux_version = isolinux_version(isolinux_path)
+        config.syslinux_version = iso_syslinux_version(iso_link)
         if int(config.syslinux_version) < 3:
             log('Distro uses really old isolinux. Installing version 3 instead of 2.')
             config.syslinux_version = '3'
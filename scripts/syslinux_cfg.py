@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Name:     syslinux_cfg.py
+# Purpose:  Module to parse syslinux/isolinux config files into their menu entries and the files they include
+# Licence:  This file is a part of multibootusb package. You can redistribute it or modify
+# under the terms of GNU General Public License, v.2 or above
+
+import collections
+import hashlib
+import os
+import re
+import threading
+
+from . import pathindex
+
+# Parsed files kept by parse_file(), by content digest.
+CACHE_SIZE = 64
+
+LABEL_LINE = re.compile(r'\s*(menu label|label)(?:\s+(.*))?$', re.I)
+BOOT_LINE = re.compile(r'\s*(kernel|linux|initrd|append)[= ](.*)$', re.I)
+INCLUDE_LINE = re.compile(r'\s*(?:menu\s+)?(include|config)\s+(\S+)', re.I)
+MENU_BEGIN_LINE = re.compile(r'\s*menu\s+begin\b\s*(.*)$', re.I)
+MENU_END_LINE = re.compile(r'\s*menu\s+end\b', re.I)
+
+_lock = threading.Lock()
+_cache = collections.OrderedDict()
+
+
+class Entry:
+    """
+    LABEL block of a config file, from a line starting with 'label' up to
+    the next one.
+    """
+
+    def __init__(self, menu):
+        # Titles of the MENU BEGIN submenus the entry is in.
+        self.menu = menu
+        # ('label' or 'menu label' as written, value)
+        self.labels = []
+        # ('kernel', 'linux', 'initrd' or 'append' as written, value)
+        self.boot_lines = []
+
+
+class Config:
+    """
+    Entries of a config file, and the files it refers to with INCLUDE,
+    MENU INCLUDE and CONFIG, as written.
+    """
+
+    def __init__(self, digest):
+        self.digest = digest
+        self.entries = []
+        self.includes = []
+
+
+def parse(data, digest=None):
+    """
+    Parse the content of a config file line by line.
+    :return: Config
+    """
+    config_tree = Config(digest)
+    entry = None
+    menu = ()
+    for line in data.split('\n'):
+        if line[:5].lower() == 'label':
+            entry = Entry(menu)
+            config_tree.entries.append(entry)
+        m = INCLUDE_LINE.match(line)
+        if m:
+            config_tree.includes.append(m.group(2))
+            continue
+        m = MENU_BEGIN_LINE.match(line)
+        if m:
+            menu = menu + (m.group(1).strip(),)
+            continue
+        if MENU_END_LINE.match(line):
+            menu = menu[:-1]
+            continue
+        if entry is None:
+            continue
+        m = LABEL_LINE.match(line)
+        if m:
+            entry.labels.append((m.group(1), m.group(2) or ''))
+            continue
+        m = BOOT_LINE.match(line)
+        if m:
+            entry.boot_lines.append(m.groups())
+    return config_tree
+
+
+def parse_file(path):
+    """
+    Parse a config file, or return the Config of a file of the same
+    content parsed earlier.
+    :return: Config
+    """
+    with open(path, 'r', errors='ignore') as f:
+        data = f.read()
+    digest = hashlib.sha1(data.encode('utf-8', 'surrogateescape')).hexdigest()
+    with _lock:
+        if digest in _cache:
+            _cache.move_to_end(digest)
+            return _cache[digest]
+    config_tree = parse(data, digest)
+    with _lock:
+        _cache[digest] = config_tree
+        while CACHE_SIZE < len(_cache):
+            _cache.popitem(last=False)
+    return config_tree
+
+
+def include_path(cfg_path, name, root):
+    """
+    Locate a file referred to by a config file. Absolute names are
+    relative to the root of the ISO, others to the directory of the
+    config file.
+    :param root: Directory the ISO is extracted to
+    :return: Full path, None if the file does not exist
+    """
+    name = name.replace('\\', '/')
+    candidates = [os.path.join(root, *name.lstrip('/').split('/'))]
+    if not name.startswith('/'):
+        candidates.insert(0, os.path.join(os.path.dirname(cfg_path),
+                                          *name.split('/')))
+    for candidate in candidates:
+        if pathindex.exists(candidate):
+            return candidate
+    return None
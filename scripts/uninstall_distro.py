@@ -7,11 +7,12 @@
 # under the terms of GNU General Public License, v.2 or above
 
 import os
-import re
 import shutil
 import threading
 import platform
 from .usb import *
+from . import bootmenu
+from . import manifest
 from . import config
 from . import gen
 
@@ -67,16 +68,17 @@ def delete_frm_file_list(iso_file_list, uninstall_distro_dir_name):
 
     usb_mount = usb_details['mount_point']
     if iso_file_list is not None:
+        if iso_file_list and \
+                os.path.exists(os.path.join(usb_mount, "ldlinux.sys")):
+            try:
+                os.chmod(os.path.join(usb_mount, "ldlinux.sys"), 0o777)
+                os.unlink(os.path.join(usb_mount, "ldlinux.sys"))
+            except:
+                gen.log('Could not remove ldlinux.sys')
         for f in iso_file_list:
             f = f.replace('\n', '').strip("/")
             if platform.system() == "Windows":
                 f = f.replace("/", "\\")
-            if os.path.exists(os.path.join(usb_mount, "ldlinux.sys")):
-                try:
-                    os.chmod(os.path.join(usb_mount, "ldlinux.sys"), 0o777)
-                    os.unlink(os.path.join(usb_mount, "ldlinux.sys"))
-                except:
-                    gen.log('Could not remove ldlinux.sys')
 
             if os.path.exists(os.path.join(usb_mount, f)):
 
@@ -103,20 +105,13 @@ def delete_frm_file_list(iso_file_list, uninstall_distro_dir_name):
 
 
 
-def do_uninstall_distro(target_distro, uninstall_distro_dir_name):
+def remove_without_manifest(target_distro, uninstall_distro_dir_name,
+                            usb_mount):
     """
-    Uninstall selected distro from selected USB disk.
-    :param target_distro: Generic name applied to distro to be uninstalled
-    :param uninstall_distro_dir_name: Directory where the distro is installed
+    Remove a distro installed before install manifests were written, going
+    through the listing of its ISO.
     :return:
     """
-    try:
-        usb_details = details(config.usb_disk)
-    except PartitionNotMounted as e:
-        log(str(e))
-        return
-    usb_mount = usb_details['mount_point']
-
     if platform.system() == 'Linux':
         # remove 'immutable' from files on ext2/3/4 fs
         if usb_mount:
@@ -162,8 +157,43 @@ def do_uninstall_distro(target_distro, uninstall_distro_dir_name):
 
     delete_frm_file_list(iso_file_list, uninstall_distro_dir_name)
 
-    update_sys_cfg_file(uninstall_distro_dir_name)
-    update_grub_cfg_file(uninstall_distro_dir_name)
+
+def do_uninstall_distro(target_distro, uninstall_distro_dir_name):
+    """
+    Uninstall selected distro from selected USB disk.
+    :param target_distro: Generic name applied to distro to be uninstalled
+    :param uninstall_distro_dir_name: Directory where the distro is installed
+    :return:
+    """
+    try:
+        usb_details = details(config.usb_disk)
+    except PartitionNotMounted as e:
+        log(str(e))
+        return
+    usb_mount = usb_details['mount_point']
+
+    uninstall_distro_dir_name_fullpath = os.path.join(
+        usb_mount, "multibootusb", uninstall_distro_dir_name)
+    entries = manifest.load(uninstall_distro_dir_name_fullpath)
+    if entries is not None:
+        # Installed along with a manifest of what got created.
+        if platform.system() == 'Linux' and entries:
+            # remove 'immutable' from files on ext2/3/4 fs
+            try:
+                subprocess.call(['chattr', '-i', '-R'] +
+                                [os.path.join(usb_mount, rel)
+                                 for rel, is_dir in entries],
+                                stderr=subprocess.DEVNULL)
+            except OSError:
+                pass
+        manifest.remove(usb_mount, entries)
+    else:
+        remove_without_manifest(target_distro, uninstall_distro_dir_name,
+                                usb_mount)
+
+    with bootmenu.transaction():
+        update_sys_cfg_file(uninstall_distro_dir_name)
+        update_grub_cfg_file(uninstall_distro_dir_name)
 
     # Check if bootx64.efi is replaced by distro
     efi_grub_img = os.path.join(config.usb_mount, 'EFI', 'BOOT', 'bootx64.efi')
@@ -191,14 +221,7 @@ def update_sys_cfg_file(uninstall_distro_dir_name):
         gen.log("syslinux.cfg file not found for updating changes.")
     else:
         gen.log("Updating syslinux.cfg file...")
-        string = open(sys_cfg_file).read()
-        string = re.sub(r'#start ' + re.escape(uninstall_distro_dir_name)
-                        + '.*?' + '#end '
-                        + re.escape(uninstall_distro_dir_name)
-                        + r'\s*', '', string, flags=re.DOTALL)
-        config_file = open(sys_cfg_file, "w")
-        config_file.write(string)
-        config_file.close()
+        bootmenu.remove(sys_cfg_file, uninstall_distro_dir_name)
 
 
 def update_grub_cfg_file(uninstall_distro_dir_name):
@@ -213,14 +236,7 @@ def update_grub_cfg_file(uninstall_distro_dir_name):
         gen.log("grub.cfg file not found for updating changes.")
     else:
         gen.log("Updating grub.cfg file...")
-        string = open(grub_cfg_file).read()
-        string = re.sub(r'#start ' + re.escape(uninstall_distro_dir_name)
-                        + '.*?' + '#end '
-                        + re.escape(uninstall_distro_dir_name)
-                        + r'\s*', '', string, flags=re.DOTALL)
-        config_file = open(grub_cfg_file, "w")
-        config_file.write(string)
-        config_file.close()
+        bootmenu.remove(grub_cfg_file, uninstall_distro_dir_name)
 
 
 def uninstall_progress():
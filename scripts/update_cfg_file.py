@@ -6,23 +6,32 @@
 # Licence:  This file is a part of multibootusb package. You can redistribute it or modify
 # under the terms of GNU General Public License, v.2 or above
 
+import collections
+import concurrent.futures
 import os
 import re
 import shutil
+import threading
+import time
 from functools import partial
 
 from .usb import *
 from .gen import *
 from .iso import *
+from . import bootmenu
 from . import config
 from . import grub
 from . import menus
+from . import pathindex
 
 from .param_rewrite import add_tokens, remove_tokens, replace_token, \
     add_or_replace_kv, replace_kv, remove_keys, \
     always, contains_token, contains_all_tokens, contains_any_token, \
-    contains_key, contains_all_keys, contains_any_key, starter_is_either, _not
+    contains_key, contains_all_keys, contains_any_key, starter_is_either, _not, \
+    rewrite_param_lines
 
+# Slowest files logged after rewriting the config files of a distro.
+CFG_TIMINGS_LOGGED = 5
 
 def dont_require_tweaking(fname, content, match_start, match_end):
     # Avoid fixing a path on a comment line
@@ -54,12 +63,12 @@ def fix_abspath_r(pattern, string, install_dir, iso_name, kept_paths):
     # See if a path that has 'boot/' prepended is a better choice.
     # E.g. Debian debian-live-9.4.0-amd64-cinnamon has a loopback.cfg
     # which contains "source /grub/grub.cfg".
-    specified_path_exists = os.path.exists(
+    specified_path_exists = pathindex.exists(
         os.path.join(install_dir, specified_path))
     if specified_path_exists:
         # Confidently accept what is specified.
         selected_path, fixed = specified_path, False
-    elif os.path.exists(os.path.join(install_dir, 'boot', specified_path)):
+    elif pathindex.exists(os.path.join(install_dir, 'boot', specified_path)):
         selected_path, fixed = ('boot/' + specified_path,
                                 "Prepended '/boot/' to %s" % specified_path)
     # A path specified by 'preseed/file=' or 'file=' is utilized
@@ -71,7 +80,7 @@ def fix_abspath_r(pattern, string, install_dir, iso_name, kept_paths):
     #    # ubuntu-14.04.5-desktop-amd64.iso for an example of this case.
     #    selected_path, fixed = specified_path[6:], "Removed '/cdrom/'"
     elif specified_path.endswith('.efi') and \
-         os.path.exists(os.path.join(install_dir, specified_path[:-4])):
+         pathindex.exists(os.path.join(install_dir, specified_path[:-4])):
         # Avira-RS provides boot/grub/loopback.cfg which points
         # to non-existent /boot/grub/vmlinuz.efi.
         selected_path, fixed = (specified_path[:-4],
@@ -121,9 +130,287 @@ def fix_abspath(string, install_dir, iso_name, config_fname):
             log("  %s [%d]" % (op_desc, len(sub_chunks)))
         return ''.join([c[0] for c in chunks])
 
-def update_distro_cfg_files(iso_link, usb_disk, distro, persistence=0):
+def is_distro_cfg_file(fname):
+    """
+    :return: True for the config files update_distro_cfg_files() rewrites
+    """
+    return fname.endswith(('.cfg', '.CFG', '.lst', '.conf'))
+
+
+def walk_distro_files(install_dir, only=None):
+    """
+    os.walk() of install_dir, or of the files of 'only' if given.
+    :param only: Full paths to restrict to
+    :return: List of (directory, [], file names)
+    """
+    if only is None:
+        return os.walk(install_dir)
+    by_dir = collections.OrderedDict()
+    for path in sorted(only):
+        dirpath, fname = os.path.split(path)
+        by_dir.setdefault(dirpath, []).append(fname)
+    return [(dirpath, [], fnames) for dirpath, fnames in by_dir.items()]
+
+
+def _sub(pattern, repl, flags=0):
+    """
+    Step of a rewrite plan replacing pattern, compiled once, by repl.
+    """
+    regex = re.compile(pattern, flags)
+    return lambda string, cfg_file: regex.sub(repl, string)
+
+
+def _sub_unless(marker, pattern, repl):
+    """
+    Step of a rewrite plan like _sub(), skipping contents containing marker.
+    """
+    regex = re.compile(pattern)
+    return lambda string, cfg_file: \
+        string if marker in string else regex.sub(repl, string)
+
+
+def distro_rewrite_plan(distro, iso_link, usb_uuid, usb_label, usb_mount,
+                        install_dir, tweaker=None):
+    """
+    Compile the rewrites update_distro_cfg_files() applies to the config
+    files of a distro into an ordered plan, built once per install with the
+    patterns compiled and the substitutions bound to the distro.
+    :param tweaker: ConfigTweaker instance of the distro, if it has one
+    :return: List of steps, callables taking the content and the path of a
+             config file and returning the new content
+    """
+    _iso_name = iso_basename(iso_link)
+    _iso_fname = iso_name(iso_link)
+    subdir = '/multibootusb/' + _iso_name
+    commentout_gfxboot_step = lambda string, cfg_file: commentout_gfxboot(string)
+    plan = []
+    if not distro == "generic":
+        plan.append(lambda string, cfg_file: fix_abspath(
+            string, install_dir, _iso_name, cfg_file))
+        plan.append(_sub(r'linuxefi', 'linux'))
+        plan.append(_sub(r'initrdefi', 'initrd'))
+    if tweaker:
+        plan.append(lambda string, cfg_file: tweaker.tweak(string))
+
+    elif distro == 'grml':
+        plan.append(_sub(r'live-media-path=', 'ignore_bootid live-media-path='))
+    elif distro == "ubuntu-server":
+        plan.append(_sub(r'file',
+                         'cdrom-detect/try-usb=true floppy.allowed_drive_mask=0 ignore_uuid ignore_bootid root=UUID=' +
+                         usb_uuid + ' file'))
+    elif distro == 'kaspersky':
+        # Steps run concurrently, see rewrite_cfg_files().
+        kaspersky_lock = threading.Lock()
+
+        def write_kaspersky_cfg(string, cfg_file):
+            kaspersky_cfg = os.path.join(usb_mount, 'multibootusb', _iso_name, 'kaspersky.cfg')
+            with kaspersky_lock:
+                if os.path.exists(kaspersky_cfg):
+                    return string
+                shutil.copyfile(resource_path(os.path.join('data', 'multibootusb', 'syslinux.cfg')),
+                                kaspersky_cfg)
+                config_string = kaspersky_config('kaspersky')
+                config_string = config_string.replace('$INSTALL_DIR', subdir)
+                config_string = re.sub(r'root=live:UUID=', 'root=live:UUID=' + usb_uuid, config_string)
+                with open(kaspersky_cfg, "a") as f:
+                    f.write(config_string)
+            return string
+        plan.append(write_kaspersky_cfg)
+    elif distro == "parted-magic":
+        plan += [
+            _sub(r'append', 'append directory=' + subdir, re.I),
+            _sub(r'initrd=', 'directory=' + subdir + '/ initrd='),
+            _sub(r'linux_64=\"', 'linux_64=\"' + subdir, re.I),
+            _sub(r'linux_32=\"', 'linux_32=\"' + subdir, re.I),
+            _sub(r'initrd_img=\"', 'initrd_img=\"' + subdir, re.I),
+            _sub(r'initrd_img32=\"', 'initrd_img32=\"' + subdir, re.I),
+            _sub(r'default_settings=\"', 'default_settings=\"directory=' + subdir + ' ', re.I),
+            _sub(r'live_settings=\"', 'live_settings=\"directory=' + subdir + ' ', re.I),
+        ]
+    elif distro == "ubcd":
+        plan.append(_sub(r'iso_filename=\S*', 'directory=' + subdir, re.I))
+    elif distro == 'f4ubcd':
+        plan.append(_sub_unless('multibootusb', r'/HBCD', subdir + '/HBCD'))
+        plan.append(_sub_unless('multibootusb', r'/F4UBCD', subdir + '/F4UBCD'))
+    elif distro == "ipcop":
+        plan.append(_sub(r'ipcopboot=cdrom\S*', 'ipcopboot=usb'))
+    elif distro == "puppy":
+        pmedia = _sub(r'pmedia=cd\S*',
+                      'pmedia=usbflash psubok=TRUE psubdir=' + subdir + '/')
+        rootfstype = _sub(r'rootfstype',
+                          'pmedia=usbflash psubok=TRUE psubdir=' + subdir + '/ rootfstype')
+
+        def puppy_media(string, cfg_file):
+            if 'pmedia=cd' in string:
+                return pmedia(string, cfg_file)
+            elif 'rootfstype' in string:
+                return rootfstype(string, cfg_file)
+            return string
+        plan.append(puppy_media)
+    elif distro == "slax":
+        plan.append(_sub(r'initrd=',
+                         r'from=' + subdir + '/slax changes=' + subdir + '/slax fromusb initrd='))
+    elif distro == "finnix":
+        plan.append(_sub(r'initrd=', r'finnixdir=' + subdir + '/finnix initrd='))
+    elif distro == "knoppix":
+        plan.append(_sub(r'initrd=', 'knoppix_dir=' + subdir + '/KNOPPIX initrd='))
+    elif distro == "systemrescuecd":
+        append_dashes = re.compile(r'append.*--.*', re.I)
+        append_dashes_parts = re.compile(r'(append)(.*)--(.*)', re.I)
+        append = re.compile(r'(append)', re.I)
+        label_rescue = re.compile(r'label rescue(32|64)_1', re.I)
+
+        def systemrescuecd_subdir(string, cfg_file):
+            rows = []
+            for line in string.splitlines(True):
+                addline = True
+                if append_dashes.match(line):
+                    line = append_dashes_parts.sub(r'\1\2subdir=' + subdir + r' --\3 subdir=' + subdir, line)
+                elif append.match(line):
+                    line = append.sub(r'\1 subdir=' + subdir, line)
+                elif label_rescue.match(line):
+                    rows.append(line)
+                    rows.append('append subdir=%s\n' % (subdir,))
+                    addline = False
+
+                if addline:
+                    rows.append(line)
+
+            return ''.join(rows)
+        plan.append(systemrescuecd_subdir)
+    elif distro in ["arch", "chakra"]:
+        def create_miso(string, cfg_file):
+            if 'manjaro' in string:
+                if not os.path.exists(os.path.join(usb_mount, '.miso')):
+                    with open(os.path.join(usb_mount, '.miso'), "w") as f:
+                        f.write('')
+            return string
+        plan += [
+            _sub(r'isolabel=\S*', 'isodevice=/dev/disk/by-uuid/' + usb_uuid, re.I),
+            _sub(r'isobasedir=', 'isobasedir=' + subdir + '/', re.I),
+            commentout_gfxboot_step,
+            lambda string, cfg_file: string.replace('%INSTALL_DIR%', 'arch'),
+            create_miso,
+        ]
+    elif distro == "kaos":
+        plan += [
+            _sub(r'kdeosisolabel=\S*', 'kdeosisodevice=/dev/disk/by-uuid/' + usb_uuid, re.I),
+            _sub(r'append', 'append kdeosisobasedir=' + subdir + '/kdeos/', re.I),
+            commentout_gfxboot_step,
+        ]
+    elif distro in ["suse", "opensuse"]:
+        opensuse_12 = re.compile(r'opensuse_12', re.I)
+        isofrom_system = _sub(r'append',
+                              'append loader=syslinux isofrom_system=/dev/disk/by-uuid/' + usb_uuid + ":/" +
+                              _iso_fname, re.I)
+        isofrom_device = _sub(r'append',
+                              'append loader=syslinux isofrom_device=/dev/disk/by-uuid/' + usb_uuid +
+                              ' isofrom_system=' + subdir + '/' + _iso_fname, re.I)
+        plan.append(lambda string, cfg_file:
+                    (isofrom_system if opensuse_12.search(string)
+                     else isofrom_device)(string, cfg_file))
+    elif distro == 'opensuse-install':
+        plan.append(_sub(r'splash=silent', 'splash=silent install=hd:/dev/disk/by-uuid/'
+                         + usb_uuid + subdir))
+    elif distro == "pclinuxos":
+        plan += [
+            _sub(r'livecd=', 'fromusb livecd=' + subdir + '/'),
+            _sub(r'prompt', '#prompt'),
+            commentout_gfxboot_step,
+            _sub(r'timeout', '#timeout'),
+        ]
+    elif distro == "porteus":
+        plan += [
+            _sub(r'APPEND', 'APPEND from=' + subdir + ' noauto'),
+            _sub(r'vmlinuz2', 'vmlinuz2 from=multibootusb/' + _iso_name + ' noauto'),
+        ]
+    elif distro == "hbcd":
+        plan.append(_sub_unless('multibootusb', r'/HBCD', subdir + '/HBCD'))
+    elif distro == "zenwalk":
+        plan.append(_sub(r'initrd=', 'from=' + subdir + '/' + _iso_fname + ' initrd='))
+    elif distro == "mageialive":
+        plan.append(_sub(r'LABEL=\S*', 'UUID=' + usb_uuid + ' mgalive.basedir=' + subdir))
+    elif distro == "solydx":
+        plan.append(_sub(r'live-media-path=', 'live-media-path=' + subdir))
+    elif distro == 'alt-linux':
+        plan.append(_sub(r':cdrom', ':disk'))
+    elif distro == 'fsecure':
+        plan.append(_sub(r'APPEND ramdisk_size', 'APPEND noprompt ' + 'knoppix_dir=' + subdir
+                         + '/KNOPPIX ramdisk_size'))
+    elif distro == 'alpine':
+        plan.append(_sub(r'modules', 'alpine_dev=usbdisk:vfat modules'))
+    elif distro == 'trinity-rescue':
+        # USB disk must have volume label to work properly
+        plan.append(_sub(r'initrd=', 'vollabel=' + usb_label + ' initrd='))
+        plan.append(_sub(r'root=\S*', 'root=/dev/ram0', re.I))
+    return plan
+
+
+def rewrite_cfg_file(cfg_file, plan):
+    """
+    Stream the content of a config file through a rewrite plan.
+    :param plan: List from distro_rewrite_plan()
+    :return: Tuple of (new content, True if it differs from the file's),
+             None if the file could not be read
+    """
+    try:
+        with open(cfg_file, errors='ignore') as config_file:
+            original = config_file.read()
+    except IOError:
+        return None
+    string = original
+    for step in plan:
+        string = step(string, cfg_file)
+    return string, string != original
+
+
+def rewrite_cfg_files(cfg_files, plan, workers=None):
+    """
+    Rewrite config files through a plan with a thread pool, the rewrites
+    being mostly file I/O and regular expressions on large strings.
+    Files the plan doesn't change are left untouched. Writes to the same
+    directory are serialized by a lock per directory.
+    :param workers: Threads rewriting files, config.cfg_rewrite_workers by default
+    :return: List of (path, True if rewritten, seconds spent on it), slowest first
+    """
+    start = time.time()
+    dir_locks = dict((os.path.dirname(cfg_file), threading.Lock())
+                     for cfg_file in cfg_files)
+
+    def rewrite(cfg_file):
+        file_start = time.time()
+        result = rewrite_cfg_file(cfg_file, plan)
+        if result is None:
+            log("Unable to read %s" % cfg_file)
+        elif result[1]:
+            with dir_locks[os.path.dirname(cfg_file)]:
+                with open(cfg_file, "w") as config_file:
+                    config_file.write(result[0])
+        return (cfg_file, result is not None and result[1],
+                time.time() - file_start)
+
+    with concurrent.futures.ThreadPoolExecutor(
+            max_workers=workers or config.cfg_rewrite_workers) as pool:
+        timings = list(pool.map(rewrite, cfg_files))
+    timings.sort(key=lambda timing: timing[2], reverse=True)
+    log('Rewrote %d of %d config files in %.2f seconds.'
+        % (sum(1 for timing in timings if timing[1]), len(timings),
+           time.time() - start))
+    for cfg_file, rewritten, seconds in timings[:CFG_TIMINGS_LOGGED]:
+        log('  %.3fs %s%s' % (seconds, cfg_file,
+                              '' if rewritten else ' (unchanged)'))
+    return timings
+
+
+def update_distro_cfg_files(iso_link, usb_disk, distro, persistence=0,
+                            menus=True, only=None):
     """
     Main function to modify/update distro specific strings on distro config files.
+    :param menus: Also add the distro to the syslinux.cfg and grub.cfg menus,
+                  otherwise update_menus() has to be called later on.
+    :param only: Full paths of the files to update, the ones written by an
+                 update (see install.update_distro()). All files of the
+                 distro by default.
     :return:
     """
     try:
@@ -160,182 +447,20 @@ def update_distro_cfg_files(iso_link, usb_disk, distro, persistence=0):
         'wifislax'       : WifislaxConfigTweaker,
         }
     tweaker_class = tweaker_class_dict.get(distro)
-
-    for dirpath, dirnames, filenames in os.walk(install_dir):
-        for f in filenames:
-            if f.endswith(".cfg") or f.endswith('.CFG') or f.endswith('.lst') or f.endswith('.conf'):
-                cfg_file = os.path.join(dirpath, f)
-                try:
-                    string = open(cfg_file, errors='ignore').read()
-                except IOError:
-                    log("Unable to read %s" % cfg_file)
-                else:
-                    if not distro == "generic":
-                        string = fix_abspath(string, install_dir, _iso_name,
-                                             os.path.join(dirpath, f))
-                        string = re.sub(r'linuxefi', 'linux', string)
-                        string = re.sub(r'initrdefi', 'initrd', string)
-                if tweaker_class:
-                    tweaker = tweaker_class(distro, tweaker_params)
-                    string = tweaker.tweak(string)
-
-                elif distro == 'grml':
-                    string = re.sub(r'live-media-path=', 'ignore_bootid live-media-path=', string)
-                elif distro == "ubuntu-server":
-                    string = re.sub(r'file',
-                                    'cdrom-detect/try-usb=true floppy.allowed_drive_mask=0 ignore_uuid ignore_bootid root=UUID=' +
-                                    usb_uuid + ' file', string)
-                elif distro == 'kaspersky':
-                    if not os.path.exists(os.path.join(usb_mount, 'multibootusb', iso_basename(iso_link), 'kaspersky.cfg')):
-                        shutil.copyfile(resource_path(os.path.join('data', 'multibootusb', 'syslinux.cfg')),
-                                        os.path.join(usb_mount, 'multibootusb', iso_basename(iso_link), 'kaspersky.cfg'))
-                        config_string = kaspersky_config('kaspersky')
-                        config_string = config_string.replace('$INSTALL_DIR', '/multibootusb/' + iso_basename(iso_link))
-                        config_string = re.sub(r'root=live:UUID=', 'root=live:UUID=' + usb_uuid, config_string)
-                        with open(os.path.join(usb_mount, 'multibootusb', iso_basename(iso_link), 'kaspersky.cfg'), "a") as f:
-                            f.write(config_string)
-                elif distro == "parted-magic":
-                    if re.search(r'append', string, re.I):
-                        string = re.sub(r'append', 'append directory=/multibootusb/' + iso_basename(iso_link), string,
-                                        flags=re.I)
-                    string = re.sub(r'initrd=', 'directory=/multibootusb/' + iso_basename(iso_link) + '/ initrd=',
-                                    string)
-                    string = re.sub(r'linux_64=\"', 'linux_64=\"/multibootusb/' + iso_basename(iso_link), string,
-                                        flags=re.I)
-                    string = re.sub(r'linux_32=\"', 'linux_32=\"/multibootusb/' + iso_basename(iso_link), string,
-                                        flags=re.I)
-                    string = re.sub(r'initrd_img=\"', 'initrd_img=\"/multibootusb/' + iso_basename(iso_link), string,
-                                        flags=re.I)
-                    string = re.sub(r'initrd_img32=\"', 'initrd_img32=\"/multibootusb/' + iso_basename(iso_link), string,
-                                        flags=re.I)
-                    string = re.sub(r'default_settings=\"', 'default_settings=\"directory=/multibootusb/' + iso_basename(iso_link) + ' ', string,
-                                        flags=re.I)
-                    string = re.sub(r'live_settings=\"', 'live_settings=\"directory=/multibootusb/' + iso_basename(iso_link) + ' ', string,
-                                        flags=re.I)
-                elif distro == "ubcd":
-                    string = re.sub(r'iso_filename=\S*', 'directory=/multibootusb/' + iso_basename(iso_link),
-                                    string, flags=re.I)
-                elif distro == 'f4ubcd':
-                    if not 'multibootusb' in string:
-                        string = re.sub(r'/HBCD', '/multibootusb/' + iso_basename(iso_link) + '/HBCD', string)
-                    if not 'multibootusb' in string:
-                        string = re.sub(r'/F4UBCD', '/multibootusb/' + iso_basename(iso_link) + '/F4UBCD', string)
-                elif distro == "ipcop":
-                    string = re.sub(r'ipcopboot=cdrom\S*', 'ipcopboot=usb', string)
-                elif distro == "puppy":
-                    if 'pmedia=cd' in string:
-                        string = re.sub(r'pmedia=cd\S*',
-                                        'pmedia=usbflash psubok=TRUE psubdir=/multibootusb/' + iso_basename(iso_link) + '/',
-                                        string)
-                    elif 'rootfstype' in string:
-                        string = re.sub(r'rootfstype',
-                                        'pmedia=usbflash psubok=TRUE psubdir=/multibootusb/' + iso_basename(iso_link) + '/ rootfstype',
-                                        string)
-                elif distro == "slax":
-                    string = re.sub(r'initrd=',
-                                    r'from=/multibootusb/' + iso_basename(iso_link) + '/slax changes=/multibootusb/' + iso_basename(iso_link) + '/slax fromusb initrd=', string)
-                elif distro == "finnix":
-                    string = re.sub(r'initrd=',
-                                    r'finnixdir=/multibootusb/' + iso_basename(iso_link) + '/finnix initrd=', string)
-                elif distro == "knoppix":
-                    string = re.sub(r'initrd=', 'knoppix_dir=/multibootusb/' + iso_basename(iso_link) + '/KNOPPIX initrd=', string)
-                elif distro == "systemrescuecd":
-                    rows = []
-                    subdir = '/multibootusb/' + iso_basename(iso_link)
-                    for line in string.splitlines(True):
-                        addline = True
-                        if re.match(r'append.*--.*', line, flags=re.I):
-                            line = re.sub(r'(append)(.*)--(.*)', r'\1\2subdir=' + subdir + r' --\3 subdir=' + subdir,
-                                          line, flags=re.I)
-                        elif re.match(r'append', line, flags=re.I):
-                            line = re.sub(r'(append)', r'\1 subdir=' + subdir, line, flags=re.I)
-                        elif re.match(r'label rescue(32|64)_1', line, flags=re.I):
-                            rows.append(line)
-                            rows.append('append subdir=%s\n' % (subdir,))
-                            addline = False
-
-                        if addline:
-                            rows.append(line)
-
-                    string = ''.join(rows)
-                elif distro in ["arch", "chakra"]:
-                    string = re.sub(r'isolabel=\S*',
-                                    'isodevice=/dev/disk/by-uuid/' + usb_uuid, string, flags=re.I)
-                    string = re.sub(r'isobasedir=',
-                                    'isobasedir=/multibootusb/' + iso_basename(iso_link) + '/', string, flags=re.I)
-                    string = commentout_gfxboot(string)
-                    string = string.replace('%INSTALL_DIR%', 'arch')
-                    if 'manjaro' in string:
-                        if not os.path.exists(os.path.join(usb_mount, '.miso')):
-                            with open(os.path.join(usb_mount, '.miso'), "w") as f:
-                                f.write('')
-                elif distro == "kaos":
-                    string = re.sub(r'kdeosisolabel=\S*',
-                                    'kdeosisodevice=/dev/disk/by-uuid/' + usb_uuid, string, flags=re.I)
-                    string = re.sub(r'append',
-                                    'append kdeosisobasedir=/multibootusb/' + iso_basename(iso_link) + '/kdeos/', string, flags=re.I)
-                    string = commentout_gfxboot(string)
-                elif distro in ["suse", "opensuse"]:
-                    if re.search(r'opensuse_12', string, re.I):
-                        string = re.sub(r'append',
-                                        'append loader=syslinux isofrom_system=/dev/disk/by-uuid/' + usb_uuid + ":/" +
-                                        iso_name(iso_link), string, flags=re.I)
-                    else:
-                        string = re.sub(r'append',
-                                        'append loader=syslinux isofrom_device=/dev/disk/by-uuid/' + usb_uuid +
-                                        ' isofrom_system=/multibootusb/' + iso_basename(iso_link) + '/' + iso_name(iso_link),
-                                        string, flags=re.I)
-                elif distro == 'opensuse-install':
-                    string = re.sub(r'splash=silent', 'splash=silent install=hd:/dev/disk/by-uuid/'
-                                    + config.usb_uuid + '/multibootusb/' + iso_basename(iso_link), string)
-                elif distro == "pclinuxos":
-                    string = re.sub(r'livecd=',
-                                    'fromusb livecd=' + '/multibootusb/' + iso_basename(iso_link) + '/',
-                                    string)
-                    string = re.sub(r'prompt', '#prompt', string)
-                    string = commentout_gfxboot(string)
-                    string = re.sub(r'timeout', '#timeout', string)
-                elif distro == "wifislax":
-                    string = re.sub(r'vmlinuz',
-                                    'vmlinuz from=multibootusb/' + iso_basename(iso_link) + ' noauto', string)
-                    string = re.sub(r'vmlinuz2',
-                                    'vmlinuz2 from=multibootusb/' + iso_basename(iso_link) + ' noauto', string)
-                elif distro == "porteus":
-                    string = re.sub(r'APPEND',
-                                    'APPEND from=/multibootusb/' + iso_basename(iso_link) + ' noauto', string)
-                    string = re.sub(r'vmlinuz2',
-                                    'vmlinuz2 from=multibootusb/' + iso_basename(iso_link) + ' noauto', string)
-                elif distro == "hbcd":
-                    if not 'multibootusb' in string:
-                        string = re.sub(r'/HBCD', '/multibootusb/' + iso_basename(iso_link) + '/HBCD', string)
-                elif distro == "zenwalk":
-                    string = re.sub(r'initrd=',
-                                    'from=/multibootusb/' + iso_basename(iso_link) + '/' + iso_name(iso_link) + ' initrd=',
-                                    string)
-                elif distro == "mageialive":
-                    string = re.sub(r'LABEL=\S*', 'UUID=' + usb_uuid + ' mgalive.basedir=/multibootusb/' + iso_basename(iso_link),
-                                    string)
-                elif distro == "solydx":
-                    string = re.sub(r'live-media-path=', 'live-media-path=/multibootusb/' + iso_basename(iso_link),
-                                    string)
-                elif distro == 'alt-linux':
-                    string = re.sub(r':cdrom', ':disk', string)
-                elif distro == 'fsecure':
-                    string = re.sub(r'APPEND ramdisk_size', 'APPEND noprompt ' + 'knoppix_dir=/multibootusb/' + iso_basename(iso_link)
-                                    + '/KNOPPIX ramdisk_size', string)
-                elif distro == 'alpine':
-                    string = re.sub(r'modules', 'alpine_dev=usbdisk:vfat modules', string)
-                elif config.distro == 'trinity-rescue':
-                    # USB disk must have volume label to work properly
-                    string = re.sub(r'initrd=', 'vollabel=' + config.usb_label + ' initrd=', string)
-                    string = re.sub(r'root=\S*', 'root=/dev/ram0', string, flags=re.I)
-
-                config_file = open(cfg_file, "w")
-                config_file.write(string)
-                config_file.close()
-
-    update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro)
-    grub.mbusb_update_grub_cfg()
+    cfg_files = [os.path.join(dirpath, f)
+                 for dirpath, dirnames, filenames
+                 in walk_distro_files(install_dir, only)
+                 for f in filenames if is_distro_cfg_file(f)]
+    # Paths found in the config files are looked up in an index of the
+    # install directory rather than on the USB disk.
+    with pathindex.indexed(install_dir, pathindex.ignores_case(usb_fs_type)):
+        plan = distro_rewrite_plan(
+            distro, iso_link, usb_uuid, usb_label, usb_mount, install_dir,
+            tweaker_class and tweaker_class(distro, tweaker_params))
+        rewrite_cfg_files(cfg_files, plan)
+
+    if menus:
+        update_menus(iso_link, usb_disk, distro)
 
     # copy isolinux.cfg file to syslinux.cfg for grub to boot.
     def copy_to_syslinux_cfg_callback(dir_, fname):
@@ -392,19 +517,12 @@ def update_distro_cfg_files(iso_link, usb_disk, distro, persistence=0):
         partial(fix_desktop_image_in_thema_callback, install_dir_for_grub),
     ]
     # Now visit the tree.
-    for dirpath, dirnames, filenames in os.walk(install_dir):
+    for dirpath, dirnames, filenames in walk_distro_files(install_dir, only):
         for f in filenames:
             for callback in visitor_callbacks:
                 callback(dirpath, f)
 
 
-    # Assertain if the entry is made..
-    sys_cfg_file = os.path.join(config.usb_mount, "multibootusb", "syslinux.cfg")
-    if gen.check_text_in_file(sys_cfg_file, iso_basename(config.image_path)):
-        log('Updated entry in syslinux.cfg...')
-    else:
-        log('Unable to update entry in syslinux.cfg...')
-
     # Check if bootx64.efi is replaced by distro
     efi_grub_img = os.path.join(config.usb_mount, 'EFI', 'BOOT', 'bootx64.efi')
     if not os.path.exists(efi_grub_img):
@@ -425,10 +543,40 @@ def update_distro_cfg_files(iso_link, usb_disk, distro, persistence=0):
         gen.log('multibootusb EFI image already exist. Not copying...')
 
 
+def update_menus(iso_link, usb_disk, distro):
+    """
+    Add an installed distro to the main syslinux.cfg and grub.cfg menus.
+    Expects config.image_path, config.distro and config.syslinux_version to
+    be the ones of the distro.
+    :return:
+    """
+    try:
+        usb_details = details(usb_disk)
+    except PartitionNotMounted as e:
+        log(str(e))
+        return
+    install_dir = os.path.join(usb_details['mount_point'], 'multibootusb',
+                               iso_basename(iso_link))
+    with bootmenu.transaction(), pathindex.indexed(
+            install_dir, pathindex.ignores_case(usb_details['file_system'])):
+        update_mbusb_cfg_file(iso_link, usb_details['uuid'],
+                              usb_details['mount_point'], distro)
+        grub.mbusb_update_grub_cfg()
+
+    # Assertain if the entry is made..
+    sys_cfg_file = os.path.join(config.usb_mount, "multibootusb", "syslinux.cfg")
+    if iso_basename(config.image_path) in bootmenu.load(sys_cfg_file):
+        log('Updated entry in syslinux.cfg...')
+    else:
+        log('Unable to update entry in syslinux.cfg...')
+
+
 # Bug in the isolinux package
+GFXBOOT_UI = re.compile(r'(ui\s+.*?gfxboot\.c32.*)$', flags=re.I | re.MULTILINE)
+
+
 def commentout_gfxboot(input_text):
-    return re.sub(r'(ui\s+.*?gfxboot\.c32.*)$', r'# \1', input_text,
-                  flags=re.I | re.MULTILINE)
+    return GFXBOOT_UI.sub(r'# \1', input_text)
 
 def update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro):
     """
@@ -452,7 +600,7 @@ def update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro):
                 string = re.sub(r'/HBCD', '/multibootusb/' + name_from_iso + '/HBCD', _config_file)
                 config_file.write(string)
                 config_file.close()
-            with open(sys_cfg_file, "a") as f:
+            with bootmenu.open_append(sys_cfg_file) as f:
                 f.write("#start " + iso_basename(config.image_path) + "\n")
                 f.write("LABEL " + label + "\n")
                 f.write("MENU LABEL " + label + "\n")
@@ -460,7 +608,7 @@ def update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro):
                 f.write("#end " + iso_basename(config.image_path) + "\n")
         elif distro == "Windows":
             if os.path.exists(sys_cfg_file):
-                config_file = open(sys_cfg_file, "a")
+                config_file = bootmenu.open_append(sys_cfg_file)
                 config_file.write("#start " + name_from_iso + "\n")
                 config_file.write("LABEL " + label + "\n")
                 config_file.write("MENU LABEL " + label + "\n")
@@ -469,7 +617,7 @@ def update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro):
                 config_file.close()
         elif distro == 'f4ubcd':
             if os.path.exists(sys_cfg_file):
-                config_file = open(sys_cfg_file, "a")
+                config_file = bootmenu.open_append(sys_cfg_file)
                 config_file.write("#start " + name_from_iso + "\n")
                 config_file.write("LABEL " + label + "\n")
                 config_file.write("MENU LABEL " + label + "\n")
@@ -479,7 +627,7 @@ def update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro):
                 config_file.close()
         elif distro == 'kaspersky':
             if os.path.exists(sys_cfg_file):
-                config_file = open(sys_cfg_file, "a")
+                config_file = bootmenu.open_append(sys_cfg_file)
                 config_file.write("#start " + name_from_iso + "\n")
                 config_file.write("LABEL " + label + "\n")
                 config_file.write("MENU LABEL " + label + "\n")
@@ -491,7 +639,7 @@ def update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro):
         elif distro == 'grub4dos_iso':
             update_grub4dos_iso_menu()
         else:
-            config_file = open(sys_cfg_file, "a")
+            config_file = bootmenu.open_append(sys_cfg_file)
             config_file.write("#start " + name_from_iso + "\n")
             config_file.write("LABEL " + label + "\n")
             config_file.write("MENU LABEL " + label + "\n")
@@ -564,10 +712,8 @@ def update_mbusb_cfg_file(iso_link, usb_uuid, usb_mount, distro):
                                       'Please boot via GRUB\n')
                     config_file.write('ENDTEXT\n')
             config_file.write("#end " + name_from_iso + "\n")
+            # extlinux.cfg gets saved along with syslinux.cfg
             config_file.close()
-            # Update extlinux.cfg file by copying updated syslinux.cfg
-            shutil.copy(os.path.join(usb_mount, 'multibootusb', 'syslinux.cfg'),
-                        os.path.join(usb_mount, 'multibootusb', 'extlinux.cfg'))
 
 
 def kaspersky_config(distro):
@@ -590,7 +736,7 @@ def update_menu_lst():
     sys_cfg_file = os.path.join(config.usb_mount, "multibootusb", "syslinux.cfg")
 #     install_dir = os.path.join(config.usb_mount, "multibootusb", iso_basename(config.image_path))
     menu_lst = iso_menu_lst_path(config.image_path).replace("\\", "/")
-    with open(sys_cfg_file, "a") as f:
+    with bootmenu.open_append(sys_cfg_file) as f:
         f.write("#start " + iso_basename(config.image_path) + "\n")
         f.write("LABEL " + iso_basename(config.image_path) + "\n")
         f.write("MENU LABEL " + iso_basename(config.image_path) + "\n")
@@ -614,7 +760,7 @@ def update_grub4dos_iso_menu():
             f.write("map --hook" + "\n")
             f.write("chainloader (hd32)")
 
-        with open(sys_cfg_file, "a") as f:
+        with bootmenu.open_append(sys_cfg_file) as f:
             f.write("#start " + iso_basename(config.image_path) + "\n")
             f.write("LABEL " + iso_basename(config.image_path) + "\n")
             f.write("MENU LABEL " + iso_basename(config.image_path) + "\n")
@@ -645,52 +791,22 @@ class ConfigTweaker:
         self.disto_type = distro_type
         self.setup_params = setup_params
 
-    def tweak_first_match(self, content, kernel_param_line_pattern,
+    def tweak_param_lines(self, content, kernel_param_line_pattern,
                           apply_persistence_to_all_lines,
                           param_operations,
                           param_operations_for_persistence):
-        """Perofrm specified parameter modification to the first maching
-        line and return the concatination of the string leading up to the
-        match and the tweaked paramer line. If no match is found,
-        unmodified 'content' is returned.
+        """Perform specified parameter modification to every matching
+        line of 'content' in a single pass and return the result. If no
+        match is found, unmodified 'content' is returned.
         """
-        m = kernel_param_line_pattern.search(content)
-        if m is None:
-            return content
-
-        start, end = m.span()
-        upto_match, rest_of_content = content[:start], content[end:]
-        starter_part, starter_token, params_part = [
-            m.group(i) for i in [1,2,3]]
-        params = params_part.split(' ')
-        if apply_persistence_to_all_lines or \
-          self.has_persistency_param(params):
-            ops_to_apply = param_operations + \
-              param_operations_for_persistence
-        else:
-            ops_to_apply = param_operations
-        for op_or_op_list, precondition in ops_to_apply:
-            if not precondition(starter_token, params):
-                continue
-            try:
-                iter(op_or_op_list)
-                op_list = op_or_op_list
-            except TypeError:
-                op_list = [op_or_op_list]
-            for op in op_list:
-                params = op(params)
-
-        # I see something special about this param. Place it at the end.
-        three_dashes = '---'
-        if three_dashes in params:
-            params.remove(three_dashes)
-            params.append(three_dashes)
-
-        return upto_match + starter_part + ' '.join(params) + \
-               self.tweak_first_match(
-                   rest_of_content, kernel_param_line_pattern,
-                   apply_persistence_to_all_lines,
-                   param_operations, param_operations_for_persistence)
+        def operations_for(starter_token, params):
+            if apply_persistence_to_all_lines or \
+              self.has_persistency_param(params):
+                return param_operations + param_operations_for_persistence
+            return param_operations
+
+        return rewrite_param_lines(content, kernel_param_line_pattern,
+                                   operations_for)
 
     def legacy_tweak(self, content):
         return None
@@ -706,7 +822,7 @@ class ConfigTweaker:
         kernel_parameter_line_pattern = re.compile(
             matching_re,
             flags = re.I | re.MULTILINE)
-        out = self.tweak_first_match(
+        out = self.tweak_param_lines(
             content,
             kernel_parameter_line_pattern,
             apply_persistence_to_all_lines,
@@ -726,7 +842,7 @@ class ConfigTweaker:
         for candidate in candidate_relative_path_list:
             relpath = os.path.join(self.setup_params.distro_path[1:],
                                     candidate)
-            if os.path.exists(os.path.join(
+            if pathindex.exists(os.path.join(
                     self.setup_params.usb_mount, relpath)):
                 normalized_relpath = '/' + relpath.replace('\\','/')
                 op_list.append((op_creator_func(key, normalized_relpath),
@@ -739,7 +855,7 @@ class ConfigTweaker:
                             subpath).replace('/', os.sep)
 
     def file_is_installed(self, subpath):
-        return os.path.exists(self.fullpath(subpath))
+        return pathindex.exists(self.fullpath(subpath))
 
     def file_content(self, subpath):
         fp = self.fullpath(subpath)
@@ -1308,3 +1424,45 @@ def test_abspath_rewrite():
         do_test_abspath_rewrite()
     finally:
         os.path.exists = saved
+
+
+def test_rewrite_plan():
+    plan = distro_rewrite_plan(
+        'puppy', 'g:/puppy-8.0.iso', 'UUID', 'LABEL', 'g:',
+        'g:/multibootusb/puppy-8.0')
+    string = 'append pmedia=cdrom rootfstype=ext4\n'
+    for step in plan:
+        string = step(string, 'isolinux.cfg')
+    assert string == 'append pmedia=usbflash psubok=TRUE ' \
+        'psubdir=/multibootusb/puppy-8.0/ rootfstype=ext4\n'
+
+    # Files of generic distros are left as they are.
+    assert distro_rewrite_plan('generic', 'g:/x.iso', 'UUID', 'LABEL', 'g:',
+                               'g:/multibootusb/x') == []
+
+
+def test_rewrite_cfg_files():
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        cfg_files = []
+        for i in range(20):
+            sub_dir = os.path.join(tmp_dir, 'dir%d' % (i % 3))
+            os.makedirs(sub_dir, exist_ok=True)
+            cfg_files.append(os.path.join(sub_dir, 'f%d.cfg' % i))
+            with open(cfg_files[-1], 'w') as f:
+                f.write('timeout 50\n' if i % 2 else 'prompt 1\n')
+        os.utime(cfg_files[1], (0, 0))
+        plan = [_sub(r'prompt', '#prompt')]
+        timings = rewrite_cfg_files(cfg_files, plan, workers=4)
+        assert sorted(t[0] for t in timings) == sorted(cfg_files)
+        assert [t[2] for t in timings] == sorted(
+            (t[2] for t in timings), reverse=True)
+        for i, cfg_file in enumerate(cfg_files):
+            with open(cfg_file) as f:
+                assert f.read() == ('timeout 50\n' if i % 2 else '#prompt 1\n')
+            assert dict((t[0], t[1]) for t in timings)[cfg_file] == (i % 2 == 0)
+        # Unchanged files are not written.
+        assert os.path.getmtime(cfg_files[1]) == 0
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -66,6 +66,7 @@ setup(
                 ('/usr/share/multibootusb/data/tools', ["data/tools/mbr.bin"]),
                 ('/usr/share/multibootusb/data/tools', ["data/tools/gptmbr.bin"]),
                 ('/usr/share/multibootusb/data', ["data/version.txt"]),
+                ('/usr/share/multibootusb/data', ["data/distro_rules.json"]),
                 ('/usr/share/multibootusb/data/tools', ["data/tools/multibootusb.png"]),
                 ('/usr/share/multibootusb/data/tools/dd', ["data/tools/dd/dd.exe"]),
                 ('/usr/share/multibootusb/data/tools/dd', ["data/tools/dd/diskio.dll"]),
@@ -0,0 +1,131 @@
+""" Boot parameter rewriting benchmark and regression check.
+
+Rewrites large synthetic syslinux menus with operations like the ones of
+the distro config tweakers, once with param_rewrite.rewrite_param_lines()
+and once with a reference implementation of the previous rewriter, which
+recursed once per boot line and ran every operation as a pass over a list
+of params. Reports the time of both per menu size.
+
+Fails (exit status 1) when the outputs differ, or when the reference is
+faster on menus of 300 entries or more. Sizes past the recursion limit
+are reported as a RecursionError of the reference.
+
+Run from the tests directory:
+    python3 bench-cmdline.py [--entries N ...] [--repeat N]
+"""
+
+import argparse
+import re
+import sys
+import time
+
+sys.path = ['..'] + sys.path
+from scripts.param_rewrite import add_tokens, add_or_replace_kv, \
+    always, contains_token, remove_keys, remove_tokens, replace_kv, \
+    rewrite_param_lines, starter_is_either
+
+LINE_PATTERN = re.compile(r'^(\s*(kernel|append|linux)\s*)(.*)$',
+                          flags=re.I | re.MULTILINE)
+
+ENTRY_TEMPLATE = '''label live-%(i)d
+  menu label Live system %(i)d
+  kernel /casper/vmlinuz
+  append boot=casper initrd=/casper/initrd.lz root=/dev/sr0 live-media=/dev/sr0 cdroot_hash=%(i)d aufs quiet splash --- locale=en_US
+'''
+
+OPERATIONS = [
+    ([add_tokens('ignore_bootid'),
+      add_or_replace_kv('live-media-path=', '/multibootusb/ubuntu/casper'),
+      add_or_replace_kv('cdrom-detect/try-usb=', 'true'),
+      add_or_replace_kv('floppy.allowed_drive_mask=', '0'),
+      add_tokens('ignore_uuid'),
+      add_or_replace_kv('root=UUID=', '1234-ABCD')],
+     contains_token('boot=casper')),
+    (replace_kv('live-media=', '/dev/disk/by-uuid/1234-ABCD'), always),
+    ([remove_keys('cdroot_hash='), remove_tokens('aufs'),
+      add_tokens('overlayfs')],
+     starter_is_either('append', 'linux')),
+    ]
+
+
+def menu(entries):
+    return 'default vesamenu.c32\ntimeout 100\n\n' + ''.join(
+        ENTRY_TEMPLATE % {'i': i} for i in range(entries))
+
+
+def reference_rewrite(content, line_pattern, operations):
+    """ The rewriter before rewrite_param_lines(). """
+    m = line_pattern.search(content)
+    if m is None:
+        return content
+    start, end = m.span()
+    starter_part, starter_token, params_part = m.group(1, 2, 3)
+    params = params_part.split(' ')
+    for op_or_op_list, precondition in operations:
+        if not precondition(starter_token, params):
+            continue
+        try:
+            iter(op_or_op_list)
+            op_list = op_or_op_list
+        except TypeError:
+            op_list = [op_or_op_list]
+        for op in op_list:
+            params = op(params)
+    if '---' in params:
+        params.remove('---')
+        params.append('---')
+    return content[:start] + starter_part + ' '.join(params) + \
+        reference_rewrite(content[end:], line_pattern, operations)
+
+
+def best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--entries', type=int, nargs='+',
+                        default=[10, 100, 300, 3000],
+                        help='menu entries of the synthetic menus')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs per menu, the best one counts')
+    args = parser.parse_args()
+
+    failures = []
+    print('%8s %8s %12s %12s' % ('entries', 'lines', 'batch ms',
+                                 'reference ms'))
+    for entries in args.entries:
+        content = menu(entries)
+        batch_time, out = best_time(
+            lambda: rewrite_param_lines(content, LINE_PATTERN,
+                                        lambda starter, params: OPERATIONS),
+            args.repeat)
+        try:
+            reference_time, expected = best_time(
+                lambda: reference_rewrite(content, LINE_PATTERN, OPERATIONS),
+                args.repeat)
+        except RecursionError:
+            reference_time = expected = None
+        print('%8d %8d %12.2f %12s' % (
+            entries, content.count('\n'), batch_time * 1000,
+            'RecursionError' if reference_time is None
+            else '%.2f' % (reference_time * 1000)))
+        if expected is None:
+            continue
+        if out != expected:
+            failures.append('%d entries: output differs' % entries)
+        elif reference_time < batch_time and 300 <= entries:
+            failures.append('%d entries: slower than the reference' % entries)
+    for failure in failures:
+        print('FAIL ' + failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
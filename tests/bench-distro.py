@@ -0,0 +1,205 @@
+""" Distro detection benchmark and regression check.
+
+Builds a small ISO9660 image for every rule of data/distro_rules.json and
+runs detection on each of them the way the GUI and the CLI do: listing,
+cfg extraction and keyword scan. Reports the time spent in each stage and
+the number of 7z processes spawned.
+
+Fails (exit status 1) when
+  - a detected distro differs from what a plain evaluation of the rules
+    expects,
+  - 7z gets spawned for these plain ISO9660 images,
+  - a stage is slower than --max-ms per image on average, or slower than
+    the --baseline timings by more than --tolerance.
+
+Run from the tests directory:
+    python3 bench-distro.py [--repeat N] [--save FILE] [--baseline FILE]
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest.mock import MagicMock as MM, patch
+
+sys.path = ['..'] + sys.path
+from scripts import _7zip
+from scripts import distro
+from scripts import distro_rules
+from scripts import gen
+from scripts import iso
+import isogen
+
+STAGES = ['listing', 'extraction', 'scan']
+
+CFG_TEMPLATE = '''default vesamenu.c32
+timeout 100
+menu title Boot menu
+
+label live
+  menu label Start %(keyword)s
+  kernel /live/vmlinuz
+  append initrd=/live/initrd.img %(keyword)s quiet splash
+
+label memtest
+  menu label Memory test
+  kernel /live/memtest
+'''
+
+
+def rules_file():
+    with open(gen.resource_path(os.path.join('data', 'distro_rules.json'))) as f:
+        return json.load(f)
+
+
+def corpus():
+    """ Yield (name, {path: bytes}) for one image per rule. """
+    rules = rules_file()
+    for i, rule in enumerate(rules['strict']):
+        yield ('strict-%02d-%s' % (i, rule['distro']), {
+            rule['file']: ('\n%s\n' % rule['contains']).encode(),
+            'live/vmlinuz': b'kernel'})
+    for i, rule in enumerate(rules['file_list']):
+        yield ('file_list-%02d-%s' % (i, rule['distro']), dict(
+            [('%s/%s.bin' % (n, n), b'x') for n in rule['names']] +
+            [('boot/vmlinuz', b'kernel')]))
+    for i, rule in enumerate(rules['keywords']):
+        keyword = ' '.join(group[0] for group in rule['contains'])
+        files = {'isolinux/isolinux.cfg':
+                 (CFG_TEMPLATE % {'keyword': keyword}).encode(),
+                 'live/vmlinuz': b'kernel'}
+        if rule.get('isolinux_bin'):
+            files['isolinux/isolinux.bin'] = b'\0ISOLINUX 6.03\0'
+        yield ('keywords-%02d-%s' % (i, rule['distro']), files)
+
+
+def expected_distro(files):
+    """ Plain, index free evaluation of the rules, in distro() order. """
+    rules = rules_file()
+    listing = [p.lower() for p in files]
+    for rule in rules['strict']:
+        data = files.get(rule['file'])
+        if data is not None and rule['contains'].lower().encode() in data.lower():
+            return rule['distro']
+    for rule in rules['file_list']:
+        if all(any(n.lower() in p for p in listing) for n in rule['names']):
+            return rule['distro']
+    isolinux_bin = any('isolinux.bin' in p for p in listing)
+    for path, data in sorted(files.items()):
+        if not path.lower().endswith(tuple(rules['scan_suffixes'])):
+            continue
+        text = data.decode().lower()
+        for rule in rules['keywords']:
+            if not all(any(k.lower() in text for k in group)
+                       for group in rule['contains']):
+                continue
+            if 'isolinux_bin' in rule and rule['isolinux_bin'] != isolinux_bin:
+                continue
+            if rule.get('unless_file') in listing:
+                continue
+            return rule['distro']
+    return 'memdisk_iso'
+
+
+def detect(iso_path, cfg_dir):
+    """ Run detection stage by stage. Return (distro, {stage: seconds}). """
+    timings = {}
+    iso._file_list_cache.clear()
+    gen.clean_iso_cfg_ext_dir(cfg_dir)
+    start = time.perf_counter()
+    iso.iso_file_list(iso_path)
+    timings['listing'] = time.perf_counter() - start
+    start = time.perf_counter()
+    iso.extract_cfg_file(iso_path)
+    timings['extraction'] = time.perf_counter() - start
+    start = time.perf_counter()
+    result = distro.distro(cfg_dir, iso_path)
+    timings['scan'] = time.perf_counter() - start
+    return result, timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='detection runs per image, the best one counts')
+    parser.add_argument('--max-ms', type=float, default=50.0,
+                        help='limit of the average time of a stage per image')
+    parser.add_argument('--baseline', help='timings saved earlier with --save')
+    parser.add_argument('--tolerance', type=float, default=0.5,
+                        help='allowed slow down relative to --baseline')
+    parser.add_argument('--save', help='file to save the timings to')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    cfg_dir = os.path.join(work_dir, 'iso_cfg_ext_dir')
+    os.makedirs(cfg_dir)
+    failures = []
+    totals = dict((s, 0.0) for s in STAGES)
+    count = 0
+    _7zip.reset_spawn_count()
+    try:
+        with patch('scripts.gen.multibootusb_host_dir',
+                   MM(return_value=work_dir)), \
+                patch('scripts.iso._iso_cfg_ext_dir', cfg_dir):
+            distro_rules.get_rules()
+            for name, files in corpus():
+                iso_path = isogen.IsoImage(files, joliet=True).write(
+                    os.path.join(work_dir, name + '.iso'))
+                best = None
+                for _ in range(args.repeat):
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        result, timings = detect(iso_path, cfg_dir)
+                    if best is None or sum(timings.values()) < \
+                            sum(best.values()):
+                        best = timings
+                expected = expected_distro(files)
+                status = 'ok'
+                if result != expected:
+                    status = 'FAIL (expected %s)' % expected
+                    failures.append('%s detected as %s instead of %s'
+                                    % (name, result, expected))
+                print('%-36s %-16s %s %s' % (
+                    name, result, ' '.join('%7.2fms' % (best[s] * 1000)
+                                           for s in STAGES), status))
+                for s in STAGES:
+                    totals[s] += best[s]
+                count += 1
+                os.remove(iso_path)
+    finally:
+        shutil.rmtree(work_dir)
+
+    averages = dict((s, totals[s] / count * 1000) for s in STAGES)
+    print('\n%d images, average per image: %s' % (count, ', '.join(
+        '%s %.2fms' % (s, averages[s]) for s in STAGES)))
+    print('7z processes spawned: %d' % _7zip.spawn_count)
+
+    if _7zip.spawn_count:
+        failures.append('7z was spawned %d time(s)' % _7zip.spawn_count)
+    for s in STAGES:
+        if averages[s] > args.max_ms:
+            failures.append('%s takes %.2fms per image, more than %.2fms'
+                            % (s, averages[s], args.max_ms))
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        for s in STAGES:
+            limit = baseline[s] * (1 + args.tolerance)
+            if averages[s] > limit:
+                failures.append('%s regressed: %.2fms against %.2fms'
+                                % (s, averages[s], baseline[s]))
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(averages, f, indent=2)
+
+    if failures:
+        print('\n' + '\n'.join(failures))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+""" Minimal ISO9660 image writer used by the test suite.
+
+Builds small images with an optional Joliet supplementary volume and
+optional Rock Ridge (RRIP) alternate names so that isodump3 can be
+exercised without xorriso/genisoimage being installed.
+"""
+
+import struct
+
+BLOCK = 2048
+
+
+def both16(v):
+    return struct.pack('<H', v) + struct.pack('>H', v)
+
+
+def both32(v):
+    return struct.pack('<L', v) + struct.pack('>L', v)
+
+
+class _Node:
+    def __init__(self, name, parent=None, data=None):
+        self.name = name
+        self.parent = parent
+        self.data = data            # None for directories
+        self.children = []
+        self.extent = {}            # per volume
+        self.size = {}
+
+    @property
+    def is_dir(self):
+        return self.data is None
+
+
+def _primary_name(name, is_dir):
+    n = name.upper()
+    return n if is_dir else n + ';1'
+
+
+def _joliet_name(name, is_dir):
+    return (name if is_dir else name + ';1').encode('utf-16-be')
+
+
+def _record(name_bytes, extent, size, flags, susp=b''):
+    len_fi = len(name_bytes)
+    pad = b'\0' if len_fi % 2 == 0 else b''
+    body = struct.pack('B', 0) + both32(extent) + both32(size) + \
+        bytes([118, 1, 1, 0, 0, 0, 0]) + struct.pack('B', flags) + \
+        b'\0\0' + both16(1) + struct.pack('B', len_fi) + name_bytes + pad + \
+        susp
+    if len(body) % 2 == 0:
+        body += b'\0'
+    return struct.pack('B', len(body) + 1) + body
+
+
+def _nm(name):
+    raw = name.encode()
+    return b'NM' + bytes([5 + len(raw), 1, 0]) + raw
+
+
+SP_ENTRY = b'SP' + bytes([7, 1, 0xBE, 0xEF, 0])
+
+
+class IsoImage:
+    """ Build an image from {'path/in/iso': bytes}. Directories are
+    created implicitly. Extra empty directories can be given as paths
+    ending with '/'.
+    """
+
+    def __init__(self, files, joliet=False, rockridge=False,
+                 volume_id='MBUSB_TEST'):
+        self.joliet = joliet
+        self.rockridge = rockridge
+        self.volume_id = volume_id
+        self.root = _Node('')
+        for path, data in sorted(files.items()):
+            parts = [p for p in path.split('/') if p]
+            node = self.root
+            for i, part in enumerate(parts):
+                last = (i == len(parts) - 1)
+                is_dir = not last or path.endswith('/')
+                found = [c for c in node.children if c.name == part]
+                if found:
+                    node = found[0]
+                    continue
+                child = _Node(part, node, None if is_dir else data)
+                node.children.append(child)
+                node = child
+
+    def _dirs_bfs(self):
+        out, queue = [], [self.root]
+        while queue:
+            d = queue.pop(0)
+            out.append(d)
+            queue.extend(sorted([c for c in d.children if c.is_dir],
+                                key=lambda c: c.name))
+        return out
+
+    def _name(self, vol, node):
+        if vol == 'joliet':
+            return _joliet_name(node.name, node.is_dir)
+        return _primary_name(node.name, node.is_dir).encode()
+
+    def _sorted_children(self, vol, d):
+        return sorted(d.children, key=lambda c: self._name(vol, c))
+
+    def _dir_records(self, vol, d):
+        rr = self.rockridge and vol == 'primary'
+        parent = d.parent or d
+        recs = [
+            _record(b'\0', d.extent[vol], d.size.get(vol, 0), 2,
+                    SP_ENTRY if (rr and d is self.root) else b''),
+            _record(b'\1', parent.extent[vol], parent.size.get(vol, 0), 2)]
+        for c in self._sorted_children(vol, d):
+            recs.append(_record(
+                self._name(vol, c), c.extent[vol],
+                c.size[vol] if c.is_dir else len(c.data),
+                2 if c.is_dir else 0, _nm(c.name) if rr else b''))
+        return recs
+
+    def _layout_dir_size(self, vol, d):
+        for c in d.children:
+            c.extent.setdefault(vol, 0)
+            c.size.setdefault(vol, 0)
+        d.extent.setdefault(vol, 0)
+        (d.parent or d).extent.setdefault(vol, 0)
+        used, blocks = 0, 1
+        for r in self._dir_records(vol, d):
+            if used + len(r) > BLOCK:
+                blocks += 1
+                used = 0
+            used += len(r)
+        return blocks * BLOCK
+
+    def _path_table(self, vol, dirs, big_endian):
+        number = {}
+        out = b''
+        fmt_l, fmt_h = ('>L', '>H') if big_endian else ('<L', '<H')
+        for i, d in enumerate(dirs, 1):
+            number[id(d)] = i
+            if d is self.root:
+                ident, parent = b'\0', 1
+            else:
+                ident = self._name(vol, d)
+                parent = number[id(d.parent)]
+            out += struct.pack('B', len(ident)) + b'\0' + \
+                struct.pack(fmt_l, d.extent[vol]) + \
+                struct.pack(fmt_h, parent) + ident
+            if len(ident) % 2:
+                out += b'\0'
+        return out
+
+    def _volume_descriptor(self, vol, vtype, total_blocks, pt_size, pt_l,
+                           pt_m):
+        vd = bytearray(BLOCK)
+        vd[0] = vtype
+        vd[1:6] = b'CD001'
+        vd[6] = 1
+        ident = self.volume_id
+        if vol == 'joliet':
+            vd[8:40] = ' '.encode('utf-16-be') * 16
+            vid = ident.encode('utf-16-be')[:32]
+            vd[40:72] = vid + ' '.encode('utf-16-be') * ((32 - len(vid)) // 2)
+            vd[88:91] = b'%/E'
+        else:
+            vd[8:40] = b' ' * 32
+            vd[40:72] = ident.encode().ljust(32)[:32]
+        vd[80:88] = both32(total_blocks)
+        vd[120:124] = both16(1)
+        vd[124:128] = both16(1)
+        vd[128:132] = both16(BLOCK)
+        vd[132:140] = both32(pt_size)
+        vd[140:144] = struct.pack('<L', pt_l)
+        vd[148:152] = struct.pack('>L', pt_m)
+        root = _record(b'\0', self.root.extent[vol], self.root.size[vol], 2)
+        vd[156:156 + len(root)] = root
+        vd[881] = 1
+        return bytes(vd)
+
+    def build(self):
+        vols = ['primary'] + (['joliet'] if self.joliet else [])
+        dirs = self._dirs_bfs()
+        next_block = 16 + len(vols) + 1
+        tables = {}
+        for vol in vols:
+            # Path table sizes don't depend on extents.
+            for d in dirs:
+                d.extent[vol] = 0
+            size = len(self._path_table(vol, dirs, False))
+            blocks = (size + BLOCK - 1) // BLOCK
+            tables[vol] = (size, next_block, next_block + blocks)
+            next_block += 2 * blocks
+        for vol in vols:
+            for d in dirs:
+                d.size[vol] = self._layout_dir_size(vol, d)
+            for d in dirs:
+                d.extent[vol] = next_block
+                next_block += d.size[vol] // BLOCK
+        files = []
+
+        def collect(d):
+            for c in sorted(d.children, key=lambda c: c.name):
+                if c.is_dir:
+                    collect(c)
+                else:
+                    files.append(c)
+        collect(self.root)
+        for f in files:
+            blocks = max(1, (len(f.data) + BLOCK - 1) // BLOCK)
+            for vol in vols:
+                f.extent[vol] = next_block
+                f.size[vol] = len(f.data)
+            next_block += blocks
+        total = next_block
+
+        image = bytearray(total * BLOCK)
+        for i, vol in enumerate(vols):
+            size, pt_l, pt_m = tables[vol]
+            image[(16 + i) * BLOCK:(17 + i) * BLOCK] = \
+                self._volume_descriptor(vol, 1 if vol == 'primary' else 2,
+                                        total, size, pt_l, pt_m)
+            lt = self._path_table(vol, dirs, False)
+            mt = self._path_table(vol, dirs, True)
+            image[pt_l * BLOCK:pt_l * BLOCK + len(lt)] = lt
+            image[pt_m * BLOCK:pt_m * BLOCK + len(mt)] = mt
+            for d in dirs:
+                pos = d.extent[vol] * BLOCK
+                used = 0
+                for r in self._dir_records(vol, d):
+                    if used + len(r) > BLOCK:
+                        pos += BLOCK - used
+                        used = 0
+                    image[pos:pos + len(r)] = r
+                    pos += len(r)
+                    used += len(r)
+        term = 16 + len(vols)
+        image[term * BLOCK:term * BLOCK + 7] = b'\xffCD001\x01'
+        for f in files:
+            pos = f.extent['primary'] * BLOCK
+            image[pos:pos + len(f.data)] = f.data
+        return bytes(image)
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(self.build())
+        return path
@@ -0,0 +1,153 @@
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path = ['..'] + sys.path
+from scripts import bootmenu
+
+SYSLINUX_CFG = '''# multibootusb menu
+UI vesamenu.c32
+TIMEOUT 300
+
+#start debian-live
+LABEL debian-live
+MENU LABEL debian-live
+BOOT /multibootusb/debian-live/isolinux/linux.bs
+#end debian-live
+
+#start memtest
+LABEL memtest
+kernel /multibootusb/memtest/BOOT/MEMTEST.IMG
+#end memtest
+'''
+
+
+def block(name, line='BOOT /multibootusb/%s/isolinux/linux.bs'):
+    return '#start %s\nLABEL %s\n%s\n#end %s\n' % (
+        name, name, line % name, name)
+
+
+def regex_remove(text, name):
+    # What uninstall did before.
+    return re.sub(r'#start ' + re.escape(name) + '.*?' + '#end '
+                  + re.escape(name) + r'\s*', '', text, flags=re.DOTALL)
+
+
+class MenuFileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, 'syslinux.cfg')
+        with open(self.path, 'w') as f:
+            f.write(SYSLINUX_CFG)
+
+    def read(self, name='syslinux.cfg'):
+        with open(os.path.join(self.dir, name)) as f:
+            return f.read()
+
+    def test_parse(self):
+        menu = bootmenu.MenuFile(self.path)
+        assert menu.names() == ['debian-live', 'memtest']
+        assert menu.text() == SYSLINUX_CFG
+        assert not menu.dirty
+
+    def test_remove_like_regex(self):
+        for name in ['debian-live', 'memtest']:
+            menu = bootmenu.MenuFile(self.path)
+            assert menu.remove(name)
+            assert menu.text() == regex_remove(SYSLINUX_CFG, name)
+        assert not bootmenu.MenuFile(self.path).remove('missing')
+
+    def test_repeated_block(self):
+        text = SYSLINUX_CFG + '\n' + block('debian-live', 'KERNEL /%s/x')
+        with open(self.path, 'w') as f:
+            f.write(text)
+        menu = bootmenu.MenuFile(self.path)
+        # Saved as it was read, blocks in file order.
+        assert menu.text() == text
+        assert menu.names() == ['debian-live', 'memtest']
+        assert menu.remove('debian-live')
+        assert menu.text() == regex_remove(text, 'debian-live')
+        menu = bootmenu.MenuFile(self.path)
+        menu.append(block('debian-live'))
+        assert menu.names() == ['memtest', 'debian-live']
+        assert menu.text().count('#start debian-live') == 1
+
+    def test_unterminated_block_is_text(self):
+        with open(self.path, 'a') as f:
+            f.write('#start broken\nLABEL broken\n')
+        menu = bootmenu.MenuFile(self.path)
+        assert 'broken' not in menu
+        assert menu.text().endswith('LABEL broken\n')
+
+    def test_append_without_transaction(self):
+        with bootmenu.open_append(self.path) as f:
+            f.write(block('arch'))
+        assert self.read() == SYSLINUX_CFG + block('arch')
+        # syslinux.cfg is mirrored to extlinux.cfg
+        assert self.read('extlinux.cfg') == self.read()
+
+    def test_append_replaces_block(self):
+        with bootmenu.open_append(self.path) as f:
+            f.write(block('debian-live', 'KERNEL /%s/vmlinuz'))
+        menu = bootmenu.MenuFile(self.path)
+        assert menu.names() == ['memtest', 'debian-live']
+        assert menu.text().count('#start debian-live') == 1
+        assert 'KERNEL /debian-live/vmlinuz' in menu.text()
+
+    def test_failed_append_is_dropped(self):
+        with self.assertRaises(ValueError):
+            with bootmenu.open_append(self.path) as f:
+                f.write('#start arch\n')
+                raise ValueError
+        assert self.read() == SYSLINUX_CFG
+        assert not os.path.exists(os.path.join(self.dir, 'extlinux.cfg'))
+
+    def test_transaction_writes_once(self):
+        names = ['distro%02d' % i for i in range(20)]
+        with patch('os.replace', wraps=os.replace) as replace:
+            with bootmenu.transaction():
+                for name in names:
+                    with bootmenu.open_append(self.path) as f:
+                        f.write(block(name))
+                    assert name in bootmenu.load(self.path)
+                with bootmenu.transaction():
+                    bootmenu.remove(self.path, 'memtest')
+                assert self.read() == SYSLINUX_CFG
+            # syslinux.cfg and extlinux.cfg
+            assert replace.call_count == 2
+        expected = regex_remove(SYSLINUX_CFG, 'memtest') + \
+            ''.join(block(name) for name in names)
+        assert self.read() == expected
+        assert self.read('extlinux.cfg') == expected
+        assert not [f for f in os.listdir(self.dir) if f.endswith('.tmp')]
+
+        with patch('os.replace', wraps=os.replace) as replace:
+            with bootmenu.transaction():
+                for name in names:
+                    bootmenu.remove(self.path, name)
+            assert replace.call_count == 2
+        assert self.read() == regex_remove(SYSLINUX_CFG, 'memtest')
+
+    def test_unchanged_menu_not_written(self):
+        with patch('os.replace') as replace:
+            with bootmenu.transaction():
+                bootmenu.remove(self.path, 'missing')
+            assert not replace.called
+
+    def test_grub_cfg_not_mirrored(self):
+        path = os.path.join(self.dir, 'grub.cfg')
+        with bootmenu.open_append(path) as f:
+            f.write(block('arch', '     menuentry %s {configfile /x}'))
+        assert self.read('grub.cfg') == block(
+            'arch', '     menuentry %s {configfile /x}')
+        assert not os.path.exists(os.path.join(self.dir, 'extlinux.cfg'))
+
+
+if __name__ == '__main__':
+    unittest.main()
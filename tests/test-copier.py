@@ -0,0 +1,275 @@
+import errno
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from unittest.mock import MagicMock as MM, patch
+
+sys.path = ['..'] + sys.path
+from scripts import checksum
+from scripts import config
+from scripts import copier
+from scripts import rawwrite
+
+
+def read_backs():
+    return [t for t in threading.enumerate()
+            if isinstance(t, checksum.ReadBack)]
+
+
+class LargeFileCopy(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.src = os.path.join(self.dir, 'distro.iso')
+        self.data = os.urandom(300 * 1000 + 123)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        self.dst = os.path.join(self.dir, 'usb')
+        os.makedirs(self.dst)
+
+    def check_copied(self):
+        with open(os.path.join(self.dst, 'distro.iso'), 'rb') as f:
+            assert f.read() == self.data
+
+    def test_progress_follows_flushes(self):
+        flushed = []
+        reports = []
+        with patch('os.fdatasync', MM(side_effect=os.fdatasync)) as sync:
+            copier.copy_file(self.src, self.dst, chunk_size=4096,
+                             sync_size=100 * 1000, progress=flushed.append,
+                             report=reports.append)
+        self.check_copied()
+        assert sum(flushed) == len(self.data)
+        assert len(flushed) == sync.call_count == 3
+        assert len(reports) == 3
+
+    def test_buffered_fallback(self):
+        unsupported = MM(side_effect=OSError(errno.ENOSYS, 'unsupported'))
+        with patch('os.copy_file_range', unsupported, create=True), \
+                patch('os.sendfile', unsupported, create=True):
+            copier.copy_file(self.src, self.dst, chunk_size=64 * 1024)
+        self.check_copied()
+
+    def test_verify(self):
+        result = copier.copy_file(self.src, self.dst, chunk_size=4096,
+                                  sync_size=64 * 1024, verify=True)
+        self.check_copied()
+        assert result.digest == hashlib.sha256(self.data).hexdigest()
+        assert result.verified is True
+
+    def test_verify_detects_corruption(self):
+        real_readv = os.readv
+
+        def bad_media(fd, buffers):
+            n = real_readv(fd, buffers)
+            buffers[0][0] ^= 0xff
+            return n
+
+        with patch('os.readv', bad_media):
+            result = copier.copy_file(self.src, self.dst, chunk_size=4096,
+                                      verify=True)
+        self.check_copied()
+        assert result.verified is False
+
+    def test_copy_error(self):
+        # The read back thread must not be left waiting for data.
+        real_copy_hashed = copier._copy_hashed
+        calls = []
+
+        def copy_hashed(*args):
+            calls.append(args)
+            if len(calls) > 2:
+                raise OSError(errno.ENOSPC, 'full')
+            real_copy_hashed(*args)
+
+        with patch('scripts.copier._copy_hashed', copy_hashed):
+            with self.assertRaises(OSError):
+                copier.copy_file(self.src, self.dst, chunk_size=4096,
+                                 sync_size=4096, verify=True)
+        assert not read_backs()
+
+    def test_read_back(self):
+        read_back = checksum.ReadBack(self.src)
+        read_back.advance(100 * 1000)
+        assert read_back.finish(len(self.data)) == \
+            hashlib.sha256(self.data).hexdigest()
+        with patch('scripts.config.verify_hash', 'blake2b'):
+            read_back = checksum.ReadBack(self.src, direct=False)
+            assert read_back.finish(1000) == \
+                hashlib.blake2b(self.data[:1000]).hexdigest()
+
+    def test_read_back_cancel(self):
+        # Waiting for data that is never written.
+        read_back = checksum.ReadBack(self.src)
+        read_back.advance(8192)
+        read_back.cancel()
+        assert not read_back.is_alive()
+        read_back = checksum.ReadBack(os.path.join(self.dir, 'missing'))
+        read_back.cancel()
+        assert not read_back.is_alive()
+
+    def test_chunk_size_per_device(self):
+        with patch('scripts.config.copy_chunk_sizes', {'/dev/sdb1': 4096}):
+            assert copier.chunk_size_for('/dev/sdb1') == 4096
+            assert copier.chunk_size_for('/dev/sdc1') == \
+                config.copy_chunk_size
+
+
+class RawWrite(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.src = os.path.join(self.dir, 'distro.iso')
+        self.data = os.urandom(1000 * 1000 + 123)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        # Stands for the device, which is larger than the image.
+        self.dst = os.path.join(self.dir, 'sdz')
+        with open(self.dst, 'wb') as f:
+            f.write(b'\xaa' * 2 * len(self.data))
+
+    def test_write_image(self):
+        written = []
+        result = rawwrite.write_image(self.src, self.dst, block_size=64 * 1024,
+                                      progress=written.append, verify=True)
+        assert sum(written) == len(self.data)
+        assert result.verified is True
+        with open(self.dst, 'rb') as f:
+            assert f.read(len(self.data)) == self.data
+            assert f.read(1) == b'\xaa'
+
+    def test_zero_blocks_skipped(self):
+        block = 64 * 1024
+        data = os.urandom(block) + bytes(3 * block) + os.urandom(100)
+        with open(self.src, 'wb') as f:
+            f.write(data)
+        written = []
+        result = rawwrite.write_image(self.src, self.dst, block_size=block,
+                                      progress=written.append, verify=True,
+                                      discard_first=True)
+        assert result.skipped == 3 * block
+        assert sum(written) == len(data)
+        assert result.verified is True
+        with open(self.dst, 'rb') as f:
+            assert f.read(len(data)) == data
+
+    def test_discard_odd_targets(self):
+        # Empty or not a multiple of the alignment, zeros are not skipped
+        # where they can't be read back.
+        for size in [0, 3 * 4096 + 100]:
+            with open(self.dst, 'wb') as f:
+                f.write(b'\xaa' * size)
+            result = rawwrite.write_image(self.src, self.dst,
+                                          block_size=64 * 1024, verify=True,
+                                          discard_first=True)
+            assert result.verified is True
+            with open(self.dst, 'rb') as f:
+                assert f.read() == self.data
+
+    def test_trailing_zeros_on_empty_file(self):
+        block = 64 * 1024
+        data = os.urandom(block) + bytes(3 * block + 100)
+        with open(self.src, 'wb') as f:
+            f.write(data)
+        open(self.dst, 'wb').close()
+        result = rawwrite.write_image(self.src, self.dst, block_size=block,
+                                      verify=True, discard_first=True)
+        assert result.skipped == 3 * block + 100
+        assert result.verified is True
+        with open(self.dst, 'rb') as f:
+            assert f.read() == data
+
+    def test_zero_blocks_written_without_discard(self):
+        with open(self.src, 'wb') as f:
+            f.write(bytes(256 * 1024))
+        with patch('scripts.rawwrite.discard', MM(return_value=False)):
+            result = rawwrite.write_image(self.src, self.dst,
+                                          block_size=64 * 1024,
+                                          discard_first=True)
+        assert result.skipped is None
+        with open(self.dst, 'rb') as f:
+            assert f.read(256 * 1024) == bytes(256 * 1024)
+
+    def test_write_error(self):
+        # The reader thread must not be left blocked on a full queue.
+        with patch('os.write', MM(side_effect=OSError(errno.ENOSPC, 'full'))):
+            with self.assertRaises(OSError):
+                rawwrite.write_image(self.src, self.dst, block_size=4096)
+            # Nor the read back thread waiting for data.
+            with self.assertRaises(OSError):
+                rawwrite.write_image(self.src, self.dst, block_size=4096,
+                                     verify=True)
+        assert not read_backs()
+
+
+class FanOut(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.src = os.path.join(self.dir, 'distro.iso')
+        self.data = os.urandom(1000 * 1000 + 123)
+        with open(self.src, 'wb') as f:
+            f.write(self.data)
+        self.dsts = []
+        for name in ['sdx', 'sdy', 'sdz']:
+            path = os.path.join(self.dir, name)
+            with open(path, 'wb') as f:
+                f.write(b'\xaa' * 2 * len(self.data))
+            self.dsts.append(path)
+
+    def test_write_images(self):
+        written = dict((d, 0) for d in self.dsts)
+
+        def progress(dst, n):
+            written[dst] += n
+
+        digest, results = rawwrite.write_images(
+            self.src, self.dsts, block_size=64 * 1024, progress=progress,
+            verify=True)
+        assert digest == hashlib.sha256(self.data).hexdigest()
+        for dst in self.dsts:
+            assert results[dst].error is None
+            assert results[dst].verified is True
+            assert written[dst] == len(self.data)
+            with open(dst, 'rb') as f:
+                assert f.read(len(self.data)) == self.data
+
+    def test_failing_target(self):
+        bad = os.path.join(self.dir, 'missing', 'sdw')
+        dropped = []
+        digest, results = rawwrite.write_images(
+            self.src, [bad] + self.dsts, block_size=64 * 1024,
+            on_error=lambda dst, e: dropped.append(dst))
+        assert isinstance(results[bad].error, OSError)
+        assert dropped == [bad]
+        for dst in self.dsts:
+            assert results[dst].error is None
+            with open(dst, 'rb') as f:
+                assert f.read(len(self.data)) == self.data
+
+    def test_write_error(self):
+        real_write = os.write
+
+        def write(fd, data):
+            if os.path.basename(os.readlink('/proc/self/fd/%d' % fd)) == 'sdy':
+                raise OSError(errno.EIO, 'unplugged')
+            return real_write(fd, data)
+
+        with patch('os.write', write):
+            digest, results = rawwrite.write_images(
+                self.src, self.dsts, block_size=64 * 1024, verify=True)
+        assert isinstance(results[self.dsts[1]].error, OSError)
+        assert results[self.dsts[0]].verified is True
+        # The read back of the failed disk is not left waiting for data.
+        assert not read_backs()
+
+
+if __name__ == '__main__':
+    unittest.main()
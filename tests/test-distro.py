@@ -1,13 +1,25 @@
+import os
+import shutil
 import sys
+import tempfile
 import unittest
 from unittest.mock import MagicMock as MM, patch, mock_open
 
 sys.path = ['..'] + sys.path
+from scripts import detect_cache
 from scripts import distro
+from scripts import distro_rules
 from scripts import gen
+from scripts import iso
+from scripts import isodump3
+import isogen
 
 class DistoDetection(unittest.TestCase):
 
+    def setUp(self):
+        # Load the rules before open() gets mocked.
+        distro_rules.get_rules()
+
     def distro(self, isobin_exists, filelist_in_iso, input_text):
         mock_isobin_exists = MM(return_value=isobin_exists)
         mock_iso_list = MM(return_value=filelist_in_iso)
@@ -141,6 +153,128 @@ class DistoDetection(unittest.TestCase):
             assert fn(['bootwiz.cfg', 'bootmenu_logo.png']) == \
                 'grub4dos_iso'
         _()
-    
+
+
+    def test_keyword_matcher(self):
+        matcher = distro_rules.KeywordMatcher(
+            ['slack', 'minimal slackware', 'slackware-howto', 'live', 'x'])
+        assert matcher.find('see the minimal slackware-howto live') == \
+            {'slack', 'minimal slackware', 'slackware-howto', 'live'}
+        assert matcher.find('nothing here') == set()
+
+    def test_rule_priority(self):
+        # Both 'debian' and 'ubuntu' keywords are present. The rule listed
+        # first wins.
+        assert self.distro(True, [], 'boot=casper boot=live') == 'debian'
+        assert self.distro(False, [], 'boot=casper boot=live') == 'ubuntu'
+
+
+    def test_user_rules(self):
+        host_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, host_dir)
+        with open(os.path.join(host_dir, 'distro_rules.json'), 'w') as f:
+            f.write('{"keywords": [{"distro": "site-os", '
+                    '"contains": [["boot=live"], ["site-os"]]}]}')
+        with patch('scripts.gen.multibootusb_host_dir',
+                   MM(return_value=host_dir)):
+            rules = distro_rules.load_rules()
+        assert rules.detect_from_text('boot=live site-os', [], True) == \
+            'site-os'
+        assert rules.detect_from_text('boot=live', [], True) == 'debian'
+        assert rules.detect_from_file_list(['SOURCES/BOOT.WIM']) == 'Windows'
+
+
+class DetectionCache(unittest.TestCase):
+
+    files = {
+        'isolinux/isolinux.bin': b'\0ISOLINUX 6.03 \0' + b'\x90' * 2000,
+        'isolinux/isolinux.cfg': b'default live\n',
+        'live/vmlinuz': b'kernel',
+    }
+
+    def setUp(self):
+        self.host_dir = tempfile.mkdtemp()
+        self.cfg_dir = os.path.join(self.host_dir, 'iso_cfg_ext_dir')
+        os.makedirs(self.cfg_dir)
+        self.iso_path = os.path.join(self.host_dir, 'live.iso')
+        isogen.IsoImage(self.files, joliet=True).write(self.iso_path)
+        iso._file_list_cache.clear()
+        iso._isolinux_cache.clear()
+
+    def tearDown(self):
+        iso._file_list_cache.clear()
+        iso._isolinux_cache.clear()
+        shutil.rmtree(self.host_dir)
+
+    def detect(self):
+        spy = MM(wraps=distro.distro)
+        with patch('scripts.gen.multibootusb_host_dir',
+                   MM(return_value=self.host_dir)), \
+                patch('scripts.iso._iso_cfg_ext_dir', self.cfg_dir), \
+                patch('scripts.distro.distro', spy):
+            return distro.detect_distro(self.iso_path), spy.call_count
+
+    def test_result_is_reused(self):
+        first = self.detect()
+        assert first[1] == 1
+        iso._file_list_cache.clear()
+        iso._isolinux_cache.clear()
+        with patch('scripts._7zip.list_iso') as mock_list_iso:
+            assert self.detect() == (first[0], 0)
+        assert mock_list_iso.call_count == 0
+        # The syslinux version is cached along, nothing gets extracted.
+        assert os.listdir(self.cfg_dir) == []
+        assert iso.isolinux_bin_dir(self.iso_path) == 'isolinux'
+        assert iso.iso_syslinux_version(self.iso_path) == '6'
+
+    def test_lookups_do_not_write(self):
+        with patch('scripts.gen.multibootusb_host_dir',
+                   MM(return_value=self.host_dir)):
+            detect_cache.store('a.iso', 'debian', '', '', ['a'], key='a')
+            detect_cache.store('b.iso', 'ubuntu', '', '', ['b'], key='b')
+            with patch('scripts.detect_cache._save') as save:
+                assert detect_cache.lookup('a.iso', 'a')['distro'] == 'debian'
+                assert not save.called
+            # 'a' was used last, 'b' is the one to go.
+            with patch('scripts.config.detect_cache_size', 2):
+                detect_cache.store('c.iso', 'fedora', '', '', ['c'], key='c')
+            assert detect_cache.lookup('b.iso', 'b') is None
+            assert detect_cache.lookup('a.iso', 'a')['distro'] == 'debian'
+
+    def test_fingerprint(self):
+        assert detect_cache.fingerprint(self.iso_path)
+        img_path = os.path.join(self.host_dir, 'disk.img')
+        with open(img_path, 'wb') as f:
+            f.write(b'\0' * 40960)
+        with patch.object(isodump3.ISO9660, '__init__') as init:
+            assert detect_cache.fingerprint(img_path) is None
+        assert not init.called
+
+    def test_modified_iso_is_detected_again(self):
+        self.detect()
+        with open(self.iso_path, 'ab') as f:
+            f.write(b'\0' * 2048)
+        assert self.detect()[1] == 1
+
+    def test_staging_dir(self):
+        staging_dir = os.path.join(self.host_dir, 'iso_cfg_staging', '0')
+        with patch('scripts.gen.multibootusb_host_dir',
+                   MM(return_value=self.host_dir)):
+            assert gen.iso_cfg_staging_dir(0) == staging_dir
+            distro.detect_distro(self.iso_path, cfg_dir=staging_dir)
+            assert os.listdir(self.cfg_dir) == []
+            assert os.path.exists(
+                os.path.join(staging_dir, 'isolinux', 'isolinux.cfg'))
+            gen.activate_iso_cfg_staging_dir(staging_dir)
+        assert not os.path.exists(staging_dir)
+        assert os.path.exists(
+            os.path.join(self.cfg_dir, 'isolinux', 'isolinux.cfg'))
+
+    def test_no_cache(self):
+        with patch('scripts.config.detect_cache', False):
+            self.detect()
+            assert self.detect()[1] == 1
+
+
 if __name__ == '__main__':
     unittest.main()
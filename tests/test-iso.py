@@ -0,0 +1,434 @@
+import errno
+import hashlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import MagicMock as MM, patch
+
+sys.path = ['..'] + sys.path
+from scripts import iso
+from scripts import isodump3
+from scripts import _7zip
+from scripts import config
+from scripts import progress
+import isogen
+
+
+class IsoFileListCache(unittest.TestCase):
+
+    def setUp(self):
+        iso._file_list_cache.clear()
+        fd, self.iso_path = tempfile.mkstemp(suffix='.iso')
+        os.write(fd, b'\0' * 4096)
+        os.close(fd)
+
+    def tearDown(self):
+        iso._file_list_cache.clear()
+        os.remove(self.iso_path)
+
+    def test_listing_is_reused(self):
+        mock_list_iso = MM(return_value=['isolinux', 'isolinux/isolinux.bin',
+                                         'boot/grub/menu.lst'])
+        @patch('scripts._7zip.list_iso', mock_list_iso)
+        def _():
+            # Listed as by detection.
+            assert len(iso.iso_file_list(self.iso_path)) == 3
+            assert iso.isolinux_bin_exist(self.iso_path)
+            assert iso.isolinux_bin_dir(self.iso_path) == 'isolinux'
+            assert iso.isolinux_bin_path(self.iso_path) == \
+                'isolinux/isolinux.bin'
+            assert iso.iso_menu_lst_path(self.iso_path) == \
+                'boot/grub/menu.lst'
+            assert iso.iso_file_path(self.iso_path, 'menu.lst') == \
+                'boot/grub/menu.lst'
+            assert iso.get_file_list(
+                self.iso_path, lambda f: f.endswith('.bin')) == \
+                ['isolinux/isolinux.bin']
+        _()
+        assert mock_list_iso.call_count == 1
+
+    def test_modified_iso_is_listed_again(self):
+        mock_list_iso = MM(side_effect=[['a.cfg'], ['a.cfg', 'b.cfg']])
+        @patch('scripts._7zip.list_iso', mock_list_iso)
+        def _():
+            assert iso.iso_file_list(self.iso_path) == ['a.cfg']
+            with open(self.iso_path, 'ab') as f:
+                f.write(b'\0' * 2048)
+            assert iso.iso_file_list(self.iso_path) == ['a.cfg', 'b.cfg']
+            assert iso.iso_file_list(self.iso_path) == ['a.cfg', 'b.cfg']
+        _()
+        assert mock_list_iso.call_count == 2
+        assert len(iso._file_list_cache) == 1
+
+    def test_lookup_stops_early(self):
+        listed = []
+
+        def iter_iso(iso_link):
+            for path in ['boot', 'isolinux', 'isolinux/isolinux.bin', 'live']:
+                listed.append(path)
+                yield _7zip.IsoEntry(path, 0, False, 0)
+
+        with patch('scripts._7zip.iter_iso', iter_iso), \
+                patch('scripts._7zip.list_iso') as mock_list_iso:
+            assert iso.isolinux_bin_path(self.iso_path) == \
+                'isolinux/isolinux.bin'
+            assert listed == ['boot', 'isolinux', 'isolinux/isolinux.bin']
+            assert iso.first_iso_path(self.iso_path,
+                                      lambda f: f == 'missing') is None
+            # The complete listing gets remembered.
+            assert iso.iso_file_list(self.iso_path) == \
+                ['boot', 'isolinux', 'isolinux/isolinux.bin', 'live']
+        assert mock_list_iso.call_count == 0
+
+    def test_failure_is_not_remembered(self):
+        mock_list_iso = MM(side_effect=[[], ['a.cfg']])
+        @patch('scripts._7zip.list_iso', mock_list_iso)
+        def _():
+            assert iso.iso_file_list(self.iso_path) == []
+            assert iso.iso_file_list(self.iso_path) == ['a.cfg']
+        _()
+
+
+class NativeIndex(unittest.TestCase):
+
+    files = {
+        'isolinux/isolinux.cfg': b'default linux\n',
+        'isolinux/isolinux.bin': b'\x90' * 5000,
+        'boot/grub/grub.cfg': b'menuentry x {}\n',
+        'README.txt': b'readme',
+        'EFI/': b'',
+    }
+
+    def build(self, **kw):
+        fd, path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        return isogen.IsoImage(self.files, **kw).write(path)
+
+    def test_plain_names(self):
+        index = isodump3.iso9660_index(self.build())
+        assert list(index) == [
+            'BOOT', 'BOOT/GRUB', 'BOOT/GRUB/GRUB.CFG', 'EFI', 'ISOLINUX',
+            'ISOLINUX/ISOLINUX.BIN', 'ISOLINUX/ISOLINUX.CFG', 'README.TXT']
+        assert index['ISOLINUX/ISOLINUX.BIN'][1] == 5000
+        assert index['EFI'][2] & 0x02
+
+    def test_joliet_names(self):
+        index = isodump3.iso9660_index(self.build(joliet=True))
+        assert sorted(index) == sorted(
+            ['isolinux', 'boot', 'boot/grub', 'EFI'] +
+            [f for f in self.files if not f.endswith('/')])
+
+    def test_rockridge_names(self):
+        index = isodump3.iso9660_index(self.build(rockridge=True))
+        assert 'isolinux/isolinux.bin' in index
+        assert 'README.txt' in index
+
+    def test_list_iso_skips_7z(self):
+        path = self.build(joliet=True)
+        _7zip.reset_spawn_count()
+        with patch('subprocess.check_output') as mock_check_output:
+            assert 'isolinux/isolinux.cfg' in _7zip.list_iso(path)
+        assert mock_check_output.call_count == 0
+        assert _7zip.spawn_count == 0
+
+    def test_not_iso9660(self):
+        fd, path = tempfile.mkstemp(suffix='.iso')
+        os.write(fd, b'\0' * 40960)
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        assert isodump3.iso9660_index(path) is None
+
+
+class NativeExtraction(unittest.TestCase):
+
+    files = {
+        'isolinux/isolinux.cfg': b'default linux\n',
+        'live/filesystem.squashfs': bytes(range(256)) * 40,
+        'empty.txt': b'',
+        'EFI/': b'',
+    }
+
+    def setUp(self):
+        fd, self.iso_path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        isogen.IsoImage(self.files, joliet=True).write(self.iso_path)
+        self.dest = tempfile.mkdtemp()
+
+    def tearDown(self):
+        os.remove(self.iso_path)
+        shutil.rmtree(self.dest)
+
+    def check_extracted(self):
+        for path, data in self.files.items():
+            target = os.path.join(self.dest, *path.split('/'))
+            if path.endswith('/'):
+                assert os.path.isdir(target)
+            else:
+                with open(target, 'rb') as f:
+                    assert f.read() == data, path
+
+    def test_iso_extract_full(self):
+        with patch('scripts._7zip.extract_iso') as mock_extract_iso:
+            iso.iso_extract_full(self.iso_path, self.dest)
+        assert mock_extract_iso.call_count == 0
+        self.check_extracted()
+
+    def test_buffered_fallback(self):
+        unsupported = MM(side_effect=OSError(errno.ENOSYS, 'unsupported'))
+        with patch('os.copy_file_range', unsupported, create=True), \
+                patch('os.sendfile', unsupported, create=True), \
+                patch('scripts.isodump3.COPY_BUFFER_SIZE', 1000):
+            assert isodump3.extract_iso9660(self.iso_path, self.dest)
+        self.check_extracted()
+
+    def test_preallocate(self):
+        path = os.path.join(self.dest, 'big')
+        with open(path, 'wb') as f:
+            # Never posix_fallocate(), which may write zeros.
+            with patch('os.posix_fallocate', create=True) as posix_fallocate:
+                isodump3.preallocate(f.fileno(), 1024 * 1024)
+            assert not posix_fallocate.called
+            assert os.fstat(f.fileno()).st_size == 0
+        # File systems without fallocate() support.
+        unsupported = MM(return_value=-1)
+        with patch('scripts.isodump3._fallocate',
+                   MM(return_value=unsupported)), \
+                patch('scripts.isodump3.get_errno',
+                      MM(return_value=errno.EOPNOTSUPP)), \
+                open(path, 'wb') as f:
+            isodump3.preallocate(f.fileno(), 1024 * 1024)
+        assert unsupported.call_args[0][1] == isodump3.FALLOC_FL_KEEP_SIZE
+
+    def test_thread_pool(self):
+        config.percentage = 0
+        tracker = progress.Progress()
+        tracker.start(sum(len(d) for d in self.files.values()))
+        reported = []
+        tracker.subscribe(lambda pct, text: reported.append(pct))
+        with patch('scripts.config.extract_large_file_size', 4096):
+            assert isodump3.ISO9660(self.iso_path).extractAll(
+                self.dest, workers=3, tracker=tracker) == isodump3.E_SUCCESS
+        self.check_extracted()
+        assert tracker.done == tracker.total
+        assert config.percentage == 100
+        assert reported == sorted(reported) and reported[-1] == 100
+
+
+class PatternExtraction(unittest.TestCase):
+
+    files = {
+        'isolinux/isolinux.cfg': b'default linux\n',
+        'isolinux/isolinux.bin': b'\x90' * 3000,
+        'isolinux/vesamenu.c32': b'c32',
+        'boot/grub/grub.cfg': b'menuentry x {}\n',
+        'boot/grub/menu.lst': b'title x\n',
+        'README.TXT': b'readme',
+        'live/vmlinuz': b'kernel',
+    }
+
+    def test_match_path(self):
+        assert _7zip.match_path('boot/grub/grub.cfg', '*.cfg')
+        assert _7zip.match_path('README.TXT', '*.txt')
+        assert _7zip.match_path('ISOLINUX/ISOLINUX.BIN', '*isolinux.bin')
+        assert _7zip.match_path('boot/grub/grub.cfg', 'grub/*.cfg')
+        assert not _7zip.match_path('boot/grub/grub.cfg', 'boot/*.cfg')
+        assert not _7zip.match_path('live/vmlinuz', '*.cfg')
+        assert _7zip.select_paths(['efi', 'efi/boot', 'efi/boot/x.efi', 'y'],
+                                  ['efi']) == \
+            ['efi', 'efi/boot', 'efi/boot/x.efi']
+
+    def test_exclusions(self):
+        paths = ['Packages', 'Packages/a.rpm', 'isolinux', 'isolinux/vmlinuz',
+                 'rescue', 'live', 'live/rescue', 'live/rescue/x', 'live/fs']
+        assert _7zip.select_paths(paths, ['-xr-!Packages']) == \
+            ['isolinux', 'isolinux/vmlinuz', 'rescue', 'live', 'live/rescue',
+             'live/rescue/x', 'live/fs']
+        assert _7zip.select_paths(paths, ['-xr!*rescue']) == \
+            ['Packages', 'Packages/a.rpm', 'isolinux', 'isolinux/vmlinuz',
+             'live', 'live/fs']
+        assert _7zip.select_paths(paths, ['live', '-xr!rescue']) == \
+            ['live', 'live/fs']
+
+    def test_iso_extract_file(self):
+        fd, iso_path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        self.addCleanup(os.remove, iso_path)
+        isogen.IsoImage(self.files, joliet=True).write(iso_path)
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        tracker = progress.Progress()
+        with patch('scripts.progress.tracker', tracker), \
+                patch('scripts._7zip.extract_iso') as mock_extract_iso:
+            iso.iso_extract_file(iso_path, dest, '-xr!boot')
+        assert mock_extract_iso.call_count == 0
+        assert not os.path.exists(os.path.join(dest, 'boot'))
+        assert os.path.exists(os.path.join(dest, 'live', 'vmlinuz'))
+        assert tracker.done == sum(len(d) for p, d in self.files.items()
+                                   if not p.startswith('boot/'))
+
+    def test_extract_cfg_file(self):
+        fd, iso_path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        self.addCleanup(os.remove, iso_path)
+        isogen.IsoImage(self.files, rockridge=True).write(iso_path)
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        with patch('scripts.iso._iso_cfg_ext_dir', dest), \
+                patch('scripts._7zip.extract_iso') as mock_extract_iso:
+            iso.extract_cfg_file(iso_path)
+        assert mock_extract_iso.call_count == 0
+        extracted = sorted(
+            os.path.relpath(os.path.join(d, f), dest).replace(os.sep, '/')
+            for d, _, fs in os.walk(dest) for f in fs)
+        assert extracted == ['README.TXT', 'boot/grub/grub.cfg',
+                             'boot/grub/menu.lst', 'isolinux/isolinux.bin',
+                             'isolinux/isolinux.cfg']
+        with open(os.path.join(dest, 'isolinux', 'isolinux.bin'), 'rb') as f:
+            assert f.read() == self.files['isolinux/isolinux.bin']
+
+    def test_background(self):
+        fd, iso_path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        self.addCleanup(os.remove, iso_path)
+        isogen.IsoImage(self.files, joliet=True).write(iso_path)
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        tracker = progress.Progress()
+        tracker.start(100, 'Installing...')
+        _7zip.reset_spawn_count()
+        with patch('scripts.progress.tracker', tracker), \
+                patch('subprocess.call'), \
+                patch('scripts.config.status_text', 'Installing...'):
+            with progress.background() as staging:
+                iso.extract_cfg_file(iso_path, dest)
+                iso.iso_extract_file(iso_path, dest, 'live')
+                _7zip.extract_iso(iso_path, dest)
+            assert config.status_text == 'Installing...'
+            assert staging.done == len(self.files['live/vmlinuz'])
+            assert tracker.done == 0
+            assert _7zip.spawn_count == 0
+            # In the foreground.
+            _7zip.extract_iso(iso_path, dest)
+            assert config.status_text.startswith('Status: Extracting')
+        assert _7zip.spawn_count == 1
+
+    def test_single_7z_call(self):
+        with patch('scripts.isodump3.open_iso9660', MM(return_value=None)), \
+                patch('scripts._7zip.extract_iso') as mock_extract_iso:
+            iso.extract_cfg_file('dummy.iso')
+        assert mock_extract_iso.call_count == 1
+
+    def test_iso_extract_paths(self):
+        fd, iso_path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        self.addCleanup(os.remove, iso_path)
+        isogen.IsoImage(self.files, joliet=True).write(iso_path)
+        dest = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, dest)
+        paths = ['boot/grub/grub.cfg', 'live/vmlinuz']
+        with patch('scripts._7zip.extract_iso') as mock_extract_iso:
+            iso.iso_extract_paths(iso_path, dest, paths,
+                                  tracker=progress.Progress())
+        assert mock_extract_iso.call_count == 0
+        extracted = sorted(
+            os.path.relpath(os.path.join(d, f), dest).replace(os.sep, '/')
+            for d, _, fs in os.walk(dest) for f in fs)
+        assert extracted == paths
+        with patch('scripts.isodump3.open_iso9660', MM(return_value=None)), \
+                patch('scripts._7zip.extract_iso') as mock_extract_iso:
+            iso.iso_extract_paths(iso_path, dest, paths)
+        mock_extract_iso.assert_called_once_with(iso_path, dest, pattern=paths)
+
+    def test_iso_file_digests(self):
+        fd, iso_path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        self.addCleanup(os.remove, iso_path)
+        isogen.IsoImage(self.files, joliet=True).write(iso_path)
+        digests = iso.iso_file_digests(
+            iso_path, ['isolinux/isolinux.bin', 'README.TXT', 'missing'])
+        assert digests == dict(
+            (p, hashlib.new(config.verify_hash, self.files[p]).hexdigest())
+            for p in ['isolinux/isolinux.bin', 'README.TXT'])
+        with patch('scripts.isodump3.open_iso9660', MM(return_value=None)):
+            assert iso.iso_file_digests(iso_path, ['README.TXT']) is None
+
+
+class StreamingLister(unittest.TestCase):
+
+    slt_output = b'''
+7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov : 2016-05-21
+
+Listing archive: my distro.iso
+
+--
+Path = my distro.iso
+Type = Iso
+Physical Size = 1048576
+
+----------
+Path = boot
+Folder = +
+Size = 0
+Packed Size = 0
+Modified = 2018-01-02 03:04:05
+
+Path = boot/grub/my grub.cfg
+Folder = -
+Size = 1234
+Packed Size = 1234
+Modified = 2018-01-02 03:04:05
+
+Path = isolinux/isolinux.bin
+Folder = -
+Size = 24576
+Packed Size = 24576
+Modified = 
+
+'''
+
+    def fake_popen(self):
+        proc = MM()
+        proc.stdout = io.BytesIO(self.slt_output)
+        proc.wait.return_value = 0
+        proc.poll.return_value = 0
+        return MM(return_value=proc)
+
+    def test_slt_records(self):
+        with patch('scripts.isodump3.iso9660_index', MM(return_value=None)), \
+                patch('subprocess.Popen', self.fake_popen()):
+            entries = list(_7zip.iter_iso('my distro.iso'))
+        assert [e.path for e in entries] == [
+            'boot', 'boot/grub/my grub.cfg', 'isolinux/isolinux.bin']
+        assert [e.is_dir for e in entries] == [True, False, False]
+        assert entries[1].size == 1234
+        assert entries[1].mtime > 0 and entries[2].mtime == 0
+
+    def test_early_stop_kills_7z(self):
+        popen = self.fake_popen()
+        popen.return_value.poll.return_value = None
+        with patch('scripts.isodump3.iso9660_index', MM(return_value=None)), \
+                patch('subprocess.Popen', popen):
+            for entry in _7zip.iter_iso('my distro.iso'):
+                if entry.path.endswith('.cfg'):
+                    break
+        assert popen.return_value.kill.call_count == 1
+
+    def test_native_records(self):
+        fd, iso_path = tempfile.mkstemp(suffix='.iso')
+        os.close(fd)
+        self.addCleanup(os.remove, iso_path)
+        isogen.IsoImage({'isolinux/isolinux.bin': b'\x90' * 5000},
+                        joliet=True).write(iso_path)
+        entries = list(_7zip.iter_iso(iso_path))
+        assert entries[0] == _7zip.IsoEntry('isolinux', 2048, True,
+                                            entries[0].mtime)
+        assert entries[1].path == os.path.join('isolinux', 'isolinux.bin')
+        assert entries[1].size == 5000 and not entries[1].is_dir
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,144 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path = ['..'] + sys.path
+from scripts import manifest
+
+
+def touch(path, data=b'x'):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class ManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.usb_mount = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.usb_mount)
+        self.install_dir = os.path.join(self.usb_mount, 'multibootusb',
+                                        'debian-live')
+        # Present on the USB disk before the install.
+        touch(os.path.join(self.usb_mount, 'multibootusb', 'syslinux.cfg'))
+        touch(os.path.join(self.usb_mount, 'EFI', 'BOOT', 'bootx64.efi'))
+        touch(os.path.join(self.usb_mount, 'notes.txt'))
+
+    def join(self, *parts):
+        return os.path.join(self.usb_mount, *parts)
+
+    def install(self):
+        """ Install the way run_install_steps() records it. """
+        record = manifest.Manifest(self.usb_mount, self.install_dir)
+        os.makedirs(self.install_dir)
+        record.add(self.install_dir)
+        paths = ['EFI', 'EFI/BOOT', 'EFI/BOOT/grubx64.efi', 'EFI/BOOT/bootx64.efi',
+                 'live', 'live/vmlinuz', 'live/initrd.img', 'notes.txt',
+                 'readme.txt']
+        # Extraction to the install directory is covered by it.
+        assert record.new_paths(self.install_dir, paths) == []
+        created = record.new_paths(self.usb_mount, paths)
+        assert created == [self.join('EFI', 'BOOT', 'grubx64.efi'),
+                           self.join('live'), self.join('readme.txt')]
+        for path in paths:
+            full_path = self.join(*path.split('/'))
+            if path in ('EFI', 'EFI/BOOT', 'live'):
+                os.makedirs(full_path, exist_ok=True)
+            else:
+                touch(full_path)
+        for path in created:
+            record.add(path)
+        touch(os.path.join(self.install_dir, 'isolinux', 'ldlinux.sys'))
+        os.chmod(os.path.join(self.install_dir, 'isolinux', 'ldlinux.sys'),
+                 0o444)
+        record.save()
+
+    def test_save_load(self):
+        self.install()
+        assert manifest.load(self.install_dir) == [
+            ('multibootusb/debian-live', True),
+            ('EFI/BOOT/grubx64.efi', False),
+            ('live', True),
+            ('readme.txt', False)]
+        # Entries are not added twice when installing again.
+        record = manifest.Manifest(self.usb_mount, self.install_dir)
+        record.add(self.join('live', 'vmlinuz'))
+        record.add(self.join('readme.txt'))
+        assert len(record.entries) == 4
+
+    def test_files(self):
+        record = manifest.Manifest(self.usb_mount, self.install_dir)
+        os.makedirs(self.install_dir)
+        record.add(self.install_dir)
+        record.add_file(os.path.join(self.install_dir, 'live', 'vmlinuz'),
+                        6, 1500000000.5)
+        record.add_file(os.path.join(self.install_dir, 'trk3', 'trk3.gz'),
+                        100, 1500000001)
+        record.add_file(os.path.join(self.install_dir, 'name with spaces.cfg'),
+                        7, 0)
+        # Relocated by DirectoryRelocator
+        record.move(os.path.join(self.install_dir, 'trk3'),
+                    self.join('trk3'))
+        os.makedirs(self.join('trk3'))
+        record.add(self.join('trk3'))
+        record.save()
+        # Files don't count as entries to uninstall.
+        assert manifest.load(self.install_dir) == [
+            ('multibootusb/debian-live', True), ('trk3', True)]
+
+        renamed_dir = os.path.join(self.usb_mount, 'multibootusb',
+                                   'debian-live-2')
+        os.rename(self.install_dir, renamed_dir)
+        record = manifest.Manifest(self.usb_mount, renamed_dir)
+        record.move(self.install_dir, renamed_dir)
+        assert list(record.files.items()) == [
+            ('multibootusb/debian-live-2/live/vmlinuz', (6, 1500000000)),
+            ('trk3/trk3.gz', (100, 1500000001)),
+            ('multibootusb/debian-live-2/name with spaces.cfg', (7, 0))]
+        assert list(record.entries) == ['multibootusb/debian-live-2', 'trk3']
+        record.save()
+        assert manifest.Manifest(self.usb_mount, renamed_dir).files == \
+            record.files
+
+    def test_prune(self):
+        self.install()
+        record = manifest.Manifest(self.usb_mount, self.install_dir)
+        os.makedirs(os.path.join(self.install_dir, 'boot', 'grub', 'fonts'))
+        touch(os.path.join(self.install_dir, 'boot', 'vmlinuz'))
+        record.prune(os.path.join(self.install_dir, 'boot', 'grub', 'fonts'))
+        assert not os.path.exists(os.path.join(self.install_dir, 'boot',
+                                               'grub'))
+        assert os.path.exists(os.path.join(self.install_dir, 'boot'))
+        # Directories of the manifest and the ones it doesn't cover stay.
+        os.remove(self.join('live', 'vmlinuz'))
+        os.remove(self.join('live', 'initrd.img'))
+        record.prune(self.join('live'))
+        assert os.path.isdir(self.join('live'))
+        os.remove(self.join('EFI', 'BOOT', 'bootx64.efi'))
+        os.remove(self.join('EFI', 'BOOT', 'grubx64.efi'))
+        record.prune(self.join('EFI', 'BOOT'))
+        assert os.path.isdir(self.join('EFI', 'BOOT'))
+
+    def test_no_manifest(self):
+        assert manifest.load(self.install_dir) is None
+
+    def test_remove(self):
+        self.install()
+        entries = manifest.load(self.install_dir)
+        assert manifest.remove(self.usb_mount, entries, workers=3) == 6
+        left = sorted(os.path.relpath(os.path.join(d, f), self.usb_mount)
+                      for d, _, files in os.walk(self.usb_mount)
+                      for f in files)
+        assert left == sorted([os.path.join('EFI', 'BOOT', 'bootx64.efi'),
+                               os.path.join('multibootusb', 'syslinux.cfg'),
+                               'notes.txt'])
+        assert not os.path.exists(self.install_dir)
+        assert not os.path.exists(self.join('live'))
+        # Removing again is harmless.
+        assert manifest.remove(self.usb_mount, entries) == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path = ['..'] + sys.path
+from scripts import pathindex
+
+
+def touch(path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(b'x')
+
+
+class PathIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.install_dir = os.path.join(self.root, 'multibootusb', 'ubuntu')
+        touch(os.path.join(self.install_dir, 'casper', 'vmlinuz'))
+        touch(os.path.join(self.install_dir, 'boot', 'grub', 'grub.cfg'))
+        touch(os.path.join(self.root, 'EFI', 'BOOT', 'bootx64.efi'))
+
+    def join(self, *parts):
+        return os.path.join(self.install_dir, *parts)
+
+    def test_lookup(self):
+        index = pathindex.PathIndex(self.install_dir)
+        assert index.lookup(self.join('casper', 'vmlinuz'))
+        assert index.lookup(self.join('boot', 'grub'))
+        assert index.lookup(self.install_dir)
+        # As joined by fix_abspath_r()
+        assert index.lookup(os.path.join(self.install_dir, 'boot',
+                                         'grub/grub.cfg'))
+        assert index.lookup(self.join('casper', 'vmlinuz.efi')) is False
+        assert index.lookup(self.join('CASPER', 'VMLINUZ')) is False
+        assert index.lookup(self.install_dir + '-2') is None
+        assert index.lookup(os.path.join(self.root, 'EFI')) is None
+
+    def test_ignore_case(self):
+        index = pathindex.PathIndex(self.install_dir, ignore_case=True)
+        assert index.lookup(self.join('CASPER', 'VMLINUZ'))
+        assert index.lookup(self.join('Boot', 'Grub', 'grub.CFG'))
+        assert index.lookup(self.join('casper', 'initrd')) is False
+        assert pathindex.ignores_case('vfat')
+        assert pathindex.ignores_case('FAT32')
+
+    def test_symlinks_not_indexed(self):
+        os.symlink(self.join('casper'), self.join('live'))
+        index = pathindex.PathIndex(self.install_dir)
+        assert index.lookup(self.join('live'))
+        assert index.lookup(self.join('live', 'vmlinuz')) is None
+
+    def test_exists_without_syscalls(self):
+        outside = os.path.join(self.root, 'EFI', 'BOOT', 'bootx64.efi')
+        with pathindex.indexed(self.install_dir):
+            with patch('os.path.exists', wraps=os.path.exists) as exists:
+                assert pathindex.exists(self.join('casper', 'vmlinuz'))
+                assert not pathindex.exists(self.join('casper', 'initrd'))
+                assert not exists.called
+                # Paths outside the index are looked up on disk.
+                assert pathindex.exists(outside)
+                assert exists.call_count == 1
+        with patch('os.path.exists', wraps=os.path.exists) as exists:
+            assert pathindex.exists(self.join('casper', 'vmlinuz'))
+            assert exists.called
+
+    def test_index_is_not_refreshed(self):
+        with pathindex.indexed(self.install_dir):
+            touch(self.join('casper', 'initrd'))
+            assert not pathindex.exists(self.join('casper', 'initrd'))
+        assert pathindex.exists(self.join('casper', 'initrd'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest.mock import patch
+
+sys.path = ['..'] + sys.path
+from scripts import syslinux_cfg
+
+ISOLINUX_CFG = '''default vesamenu.c32
+include stdmenu.txt
+timeout 50
+
+label live
+  menu label ^Start Debian Live
+  kernel /live/vmlinuz
+  append initrd=/live/initrd.img boot=live quiet
+
+menu begin advanced
+  menu title Advanced options
+LABEL failsafe
+  MENU LABEL Failsafe (x86_64)
+  linux /live/vmlinuz
+  initrd=/live/initrd.img
+  append boot=live noapic
+menu end
+  label indented
+label
+CONFIG /boot/isolinux/other.cfg
+'''
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_entries(self):
+        config_tree = syslinux_cfg.parse(ISOLINUX_CFG)
+        assert [e.labels for e in config_tree.entries] == [
+            [('label', 'live'), ('menu label', '^Start Debian Live')],
+            [('LABEL', 'failsafe'), ('MENU LABEL', 'Failsafe (x86_64)'),
+             ('label', 'indented')],
+            [('label', '')]]
+        assert config_tree.entries[0].boot_lines == [
+            ('kernel', '/live/vmlinuz'),
+            ('append', 'initrd=/live/initrd.img boot=live quiet')]
+        assert config_tree.entries[1].boot_lines == [
+            ('linux', '/live/vmlinuz'), ('initrd', '/live/initrd.img'),
+            ('append', 'boot=live noapic')]
+        assert [e.menu for e in config_tree.entries] == [
+            (), ('advanced',), ()]
+        assert config_tree.includes == ['stdmenu.txt',
+                                        '/boot/isolinux/other.cfg']
+
+    def test_no_label(self):
+        config_tree = syslinux_cfg.parse('kernel /vmlinuz\nui menu.c32\n')
+        assert config_tree.entries == []
+
+
+class FileTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.cfg_path = os.path.join(self.root, 'isolinux', 'isolinux.cfg')
+        os.makedirs(os.path.join(self.root, 'isolinux'))
+        os.makedirs(os.path.join(self.root, 'boot', 'isolinux'))
+        for path in [self.cfg_path,
+                     os.path.join(self.root, 'isolinux', 'stdmenu.txt'),
+                     os.path.join(self.root, 'boot', 'isolinux', 'other.cfg')]:
+            with open(path, 'w') as f:
+                f.write(ISOLINUX_CFG)
+
+    def test_parse_file_cache(self):
+        config_tree = syslinux_cfg.parse_file(self.cfg_path)
+        assert len(config_tree.entries) == 3
+        # Files of the same content are parsed once.
+        with patch('scripts.syslinux_cfg.parse') as parse:
+            other = os.path.join(self.root, 'boot', 'isolinux', 'other.cfg')
+            assert syslinux_cfg.parse_file(other) is config_tree
+            assert not parse.called
+
+    def test_include_path(self):
+        assert syslinux_cfg.include_path(
+            self.cfg_path, 'stdmenu.txt', self.root) == \
+            os.path.join(self.root, 'isolinux', 'stdmenu.txt')
+        assert syslinux_cfg.include_path(
+            self.cfg_path, '/boot/isolinux/other.cfg', self.root) == \
+            os.path.join(self.root, 'boot', 'isolinux', 'other.cfg')
+        # Relative to the root when not next to the config file.
+        assert syslinux_cfg.include_path(
+            self.cfg_path, 'boot/isolinux/other.cfg', self.root) == \
+            os.path.join(self.root, 'boot', 'isolinux', 'other.cfg')
+        assert syslinux_cfg.include_path(
+            self.cfg_path, 'missing.cfg', self.root) is None
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+import os
+import re
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path = ['..'] + sys.path
+from scripts import update_cfg_file
+from scripts.gen import resource_path
+from scripts.iso import iso_basename, iso_name
+
+SAMPLES = [
+    """UI gfxboot.c32 bootlogo
+prompt 1
+timeout 50
+label rescue64_1
+  kernel /boot/vmlinuz
+LABEL live
+  kernel /boot/vmlinuz
+  append initrd=/boot/initrd.img pmedia=cdrom rootfstype=ext4 -- nomodeset
+APPEND ramdisk_size=1 iso_filename=x.iso
+label rescue32_1
+  linux_64="/pmagic/bzImage64" linux_32="/pmagic/bzImage" initrd_img="/pmagic/initrd.img" initrd_img32="/pmagic/initrd32.img" default_settings="edd=off" live_settings="quiet"
+  kernel /HBCD/memdisk /F4UBCD/grub.exe
+""",
+    """menuentry "openSUSE" {
+	linuxefi /boot/x86_64/loader/linux rootfstype=ext4 opensuse_12
+	initrdefi /boot/x86_64/loader/initrd
+}
+""",
+    "append multibootusb /HBCD /F4UBCD\n",
+    "label x\n  append rootfstype=ext4 quiet\n",
+    ]
+
+
+def reference_rewrite(distro, string, iso_link, usb_uuid, usb_mount,
+                      install_dir, cfg_file):
+    # The chain of re.sub() calls update_distro_cfg_files() ran before
+    # distro_rewrite_plan(), for the distros compared below.
+    string = update_cfg_file.fix_abspath(string, install_dir,
+                                         iso_basename(iso_link), cfg_file)
+    string = re.sub(r'linuxefi', 'linux', string)
+    string = re.sub(r'initrdefi', 'initrd', string)
+    if distro == 'kaspersky':
+        if not os.path.exists(os.path.join(usb_mount, 'multibootusb', iso_basename(iso_link), 'kaspersky.cfg')):
+            shutil.copyfile(resource_path(os.path.join('data', 'multibootusb', 'syslinux.cfg')),
+                            os.path.join(usb_mount, 'multibootusb', iso_basename(iso_link), 'kaspersky.cfg'))
+            config_string = update_cfg_file.kaspersky_config('kaspersky')
+            config_string = config_string.replace('$INSTALL_DIR', '/multibootusb/' + iso_basename(iso_link))
+            config_string = re.sub(r'root=live:UUID=', 'root=live:UUID=' + usb_uuid, config_string)
+            with open(os.path.join(usb_mount, 'multibootusb', iso_basename(iso_link), 'kaspersky.cfg'), "a") as f:
+                f.write(config_string)
+    elif distro == "parted-magic":
+        if re.search(r'append', string, re.I):
+            string = re.sub(r'append', 'append directory=/multibootusb/' + iso_basename(iso_link), string,
+                            flags=re.I)
+        string = re.sub(r'initrd=', 'directory=/multibootusb/' + iso_basename(iso_link) + '/ initrd=',
+                        string)
+        string = re.sub(r'linux_64=\"', 'linux_64=\"/multibootusb/' + iso_basename(iso_link), string,
+                        flags=re.I)
+        string = re.sub(r'linux_32=\"', 'linux_32=\"/multibootusb/' + iso_basename(iso_link), string,
+                        flags=re.I)
+        string = re.sub(r'initrd_img=\"', 'initrd_img=\"/multibootusb/' + iso_basename(iso_link), string,
+                        flags=re.I)
+        string = re.sub(r'initrd_img32=\"', 'initrd_img32=\"/multibootusb/' + iso_basename(iso_link), string,
+                        flags=re.I)
+        string = re.sub(r'default_settings=\"', 'default_settings=\"directory=/multibootusb/' + iso_basename(iso_link) + ' ', string,
+                        flags=re.I)
+        string = re.sub(r'live_settings=\"', 'live_settings=\"directory=/multibootusb/' + iso_basename(iso_link) + ' ', string,
+                        flags=re.I)
+    elif distro == 'f4ubcd':
+        if not 'multibootusb' in string:
+            string = re.sub(r'/HBCD', '/multibootusb/' + iso_basename(iso_link) + '/HBCD', string)
+        if not 'multibootusb' in string:
+            string = re.sub(r'/F4UBCD', '/multibootusb/' + iso_basename(iso_link) + '/F4UBCD', string)
+    elif distro == "puppy":
+        if 'pmedia=cd' in string:
+            string = re.sub(r'pmedia=cd\S*',
+                            'pmedia=usbflash psubok=TRUE psubdir=/multibootusb/' + iso_basename(iso_link) + '/',
+                            string)
+        elif 'rootfstype' in string:
+            string = re.sub(r'rootfstype',
+                            'pmedia=usbflash psubok=TRUE psubdir=/multibootusb/' + iso_basename(iso_link) + '/ rootfstype',
+                            string)
+    elif distro == "systemrescuecd":
+        rows = []
+        subdir = '/multibootusb/' + iso_basename(iso_link)
+        for line in string.splitlines(True):
+            addline = True
+            if re.match(r'append.*--.*', line, flags=re.I):
+                line = re.sub(r'(append)(.*)--(.*)', r'\1\2subdir=' + subdir + r' --\3 subdir=' + subdir,
+                              line, flags=re.I)
+            elif re.match(r'append', line, flags=re.I):
+                line = re.sub(r'(append)', r'\1 subdir=' + subdir, line, flags=re.I)
+            elif re.match(r'label rescue(32|64)_1', line, flags=re.I):
+                rows.append(line)
+                rows.append('append subdir=%s\n' % (subdir,))
+                addline = False
+
+            if addline:
+                rows.append(line)
+
+        string = ''.join(rows)
+    elif distro in ["suse", "opensuse"]:
+        if re.search(r'opensuse_12', string, re.I):
+            string = re.sub(r'append',
+                            'append loader=syslinux isofrom_system=/dev/disk/by-uuid/' + usb_uuid + ":/" +
+                            iso_name(iso_link), string, flags=re.I)
+        else:
+            string = re.sub(r'append',
+                            'append loader=syslinux isofrom_device=/dev/disk/by-uuid/' + usb_uuid +
+                            ' isofrom_system=/multibootusb/' + iso_basename(iso_link) + '/' + iso_name(iso_link),
+                            string, flags=re.I)
+    elif distro == "pclinuxos":
+        string = re.sub(r'livecd=',
+                        'fromusb livecd=' + '/multibootusb/' + iso_basename(iso_link) + '/',
+                        string)
+        string = re.sub(r'prompt', '#prompt', string)
+        string = update_cfg_file.commentout_gfxboot(string)
+        string = re.sub(r'timeout', '#timeout', string)
+    return string
+
+
+class RewritePlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.usb_mount = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.usb_mount)
+        self.iso_link = os.path.join(self.usb_mount, 'distro-1.0.iso')
+        open(self.iso_link, 'w').close()
+        self.install_dir = os.path.join(self.usb_mount, 'multibootusb',
+                                        'distro-1.0')
+        os.makedirs(os.path.join(self.install_dir, 'boot'))
+
+    def test_same_as_reference(self):
+        cfg_file = os.path.join(self.install_dir, 'boot', 'isolinux.cfg')
+        kaspersky_cfg = os.path.join(self.install_dir, 'kaspersky.cfg')
+        for distro in ['parted-magic', 'systemrescuecd', 'puppy', 'suse',
+                       'opensuse', 'f4ubcd', 'kaspersky', 'pclinuxos']:
+            plan = update_cfg_file.distro_rewrite_plan(
+                distro, self.iso_link, 'UUID1', 'LABEL', self.usb_mount,
+                self.install_dir)
+
+            def run_plan(string):
+                for step in plan:
+                    string = step(string, cfg_file)
+                return string
+
+            def run_reference(string):
+                return reference_rewrite(distro, string, self.iso_link,
+                                         'UUID1', self.usb_mount,
+                                         self.install_dir, cfg_file)
+            written = []
+            for rewrite in [run_plan, run_reference]:
+                written.append([rewrite(s) for s in SAMPLES])
+                if os.path.exists(kaspersky_cfg):
+                    with open(kaspersky_cfg) as f:
+                        written[-1].append(f.read())
+                    os.remove(kaspersky_cfg)
+            assert written[0] == written[1], distro
+            assert (len(written[0]) > len(SAMPLES)) == \
+                (distro == 'kaspersky')
+
+
+if __name__ == '__main__':
+    unittest.main()